@@ -0,0 +1,544 @@
+#! /usr/bin/python
+
+"""
+fakes.py file contains in-process stand-ins for the Spark REST API, the Case, RMA and Bug APIs and SSO,
+and for a Redis server used as the shared cache
+
+Each HTTP fake runs a threaded HTTP server on a free local port, can inject latency and
+errors, and counts every call it receives by route.  RecordedUpstream instead answers with
+the responses and latencies of a capture (see bot/capture.py).
+"""
+
+import fnmatch
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urlparse import urlparse, parse_qs
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Base class for a local upstream stand-in
+class FakeUpstream(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, prefix=""):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.prefix = prefix
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self._random = random.Random(0)
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self.thread = None
+        super(FakeUpstream, self).__init__()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}{}".format(self.server.server_address[1], self.prefix)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls.clear()
+
+    # Apply injected latency and errors, then dispatch to the route handler
+    def dispatch(self, method, path, query, body):
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if path.startswith(self.prefix):
+            path = path[len(self.prefix):]
+        parts = [p for p in path.split("/") if p]
+
+        route, status, payload = self.handle(method, parts, query, body)
+        with self.lock:
+            self.calls["{} {}".format(method, route)] += 1
+            failed = self.error_rate and self._random.random() < self.error_rate
+        if failed:
+            return 500, {"message": "Injected error"}
+        return status, payload
+
+    # Subclasses return (route label, status code, json payload)
+    def handle(self, method, parts, query, body):
+        raise NotImplementedError
+
+
+# Build a request handler class bound to a fake
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def _respond(self):
+            parsed = urlparse(self.path)
+            query = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length).decode("utf-8") if length else ""
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = dict((k, v[0]) for k, v in parse_qs(raw).items())
+
+            status, payload = fake.dispatch(self.command, parsed.path, query, body)
+            data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def _new_id():
+    return uuid.uuid4().hex
+
+
+# Stand-in for the Spark REST API (messages, people, rooms, memberships, webhooks)
+class FakeSpark(FakeUpstream):
+    def __init__(self, bot_email="bot@sparkbot.io", **kwargs):
+        super(FakeSpark, self).__init__(prefix="/v1/", **kwargs)
+        self.people = {}
+        self.rooms = {}
+        self.memberships = {}
+        self.messages = {}
+        self.webhooks = {}
+        self.bot_id = self.add_person(bot_email, "TAC Bot")
+
+    def add_person(self, email, name=None):
+        person_id = _new_id()
+        self.people[person_id] = {"id": person_id, "emails": [email], "displayName": name or email}
+        return person_id
+
+    def add_room(self, title, members=(), room_type="group"):
+        room_id = _new_id()
+        self.rooms[room_id] = {"id": room_id, "title": title, "type": room_type}
+        for person_id in (self.bot_id,) + tuple(members):
+            self.add_membership(room_id, person_id)
+        return room_id
+
+    def add_membership(self, room_id, person_id=None, email=None):
+        if person_id is None:
+            person_id = self.person_by_email(email) or self.add_person(email)
+        membership_id = _new_id()
+        self.memberships[membership_id] = {"id": membership_id, "roomId": room_id, "personId": person_id,
+                                           "personEmail": self.people[person_id]["emails"][0]}
+        return self.memberships[membership_id]
+
+    def add_message(self, room_id, person_id, text):
+        message_id = _new_id()
+        self.messages[message_id] = {"id": message_id, "roomId": room_id, "personId": person_id,
+                                     "personEmail": self.people[person_id]["emails"][0], "text": text}
+        return message_id
+
+    def person_by_email(self, email):
+        for p in self.people.values():
+            if email in p["emails"]:
+                return p["id"]
+        return None
+
+    def handle(self, method, parts, query, body):
+        resource = parts[0] if parts else ""
+        item = parts[1] if len(parts) > 1 else None
+        route = resource + ("/{id}" if item else "")
+        if item == "me":
+            route = "people/me"
+            item = self.bot_id
+
+        handler = getattr(self, "_" + resource, None)
+        if handler is None:
+            return route, 404, {"message": "Unknown resource"}
+        status, payload = handler(method, item, query, body)
+        return route, status, payload
+
+    def _items(self, values, query, fields):
+        items = [v for v in list(values) if all(v.get(f) == query[f] for f in fields if f in query)]
+        return 200, {"items": items}
+
+    def _people(self, method, item, query, body):
+        if item:
+            if item not in self.people:
+                return 404, {"message": "Person not found"}
+            return 200, self.people[item]
+        email = query.get("email")
+        return 200, {"items": [p for p in list(self.people.values()) if email in p["emails"]]}
+
+    def _rooms(self, method, item, query, body):
+        if method == "POST":
+            room_id = self.add_room(body.get("title"))
+            return 200, self.rooms[room_id]
+        if item:
+            if item not in self.rooms:
+                return 404, {"message": "Room not found"}
+            return 200, self.rooms[item]
+        return self._items(self.rooms.values(), query, ["type"])
+
+    def _memberships(self, method, item, query, body):
+        if method == "POST":
+            room_id = body.get("roomId")
+            person_id = body.get("personId") or self.person_by_email(body.get("personEmail"))
+            for m in list(self.memberships.values()):
+                if m["roomId"] == room_id and m["personId"] == person_id:
+                    return 409, {"message": "Person is already in the room"}
+            return 200, self.add_membership(room_id, person_id, body.get("personEmail"))
+        if method == "DELETE":
+            self.memberships.pop(item, None)
+            return 204, None
+        return self._items(self.memberships.values(), query, ["roomId", "personId", "personEmail"])
+
+    def _messages(self, method, item, query, body):
+        if method == "POST":
+            message_id = _new_id()
+            message = dict(body, id=message_id, personId=self.bot_id,
+                           personEmail=self.people[self.bot_id]["emails"][0])
+            return 200, message
+        if item not in self.messages:
+            return 404, {"message": "Message not found"}
+        return 200, self.messages[item]
+
+    def _webhooks(self, method, item, query, body):
+        if method == "POST":
+            webhook_id = _new_id()
+            self.webhooks[webhook_id] = dict(body, id=webhook_id)
+            return 200, self.webhooks[webhook_id]
+        if method == "PUT":
+            self.webhooks[item].update(body)
+            return 200, self.webhooks[item]
+        if method == "DELETE":
+            self.webhooks.pop(item, None)
+            return 204, None
+        if item:
+            return 200, self.webhooks[item]
+        return 200, {"items": list(self.webhooks.values())}
+
+
+# Build the Case API CASE_DETAIL record for a case number
+def case_detail(case_number):
+    r = random.Random(int(case_number))
+    return {
+        "CASE_ID": str(case_number),
+        "TITLE": "Fake case {}".format(case_number),
+        "PROBLEM_DESC": "Interface flaps on core router after upgrade",
+        "STATUS": r.choice(["Customer Pending", "Cisco Pending", "Customer Updated", "Closed"]),
+        "SEVERITY": str(r.randint(1, 4)),
+        "CONTRACT_ID": str(r.randint(10000000, 99999999)),
+        "SERIAL_NUMBER": "FOC{}".format(r.randint(1000000, 9999999)),
+        "DEVICE_NAME": "core-rtr-{}".format(r.randint(1, 99)),
+        "CREATION_DATE": "2016-0{}-1{}T10:00:00Z".format(r.randint(1, 9), r.randint(0, 9)),
+        "UPDATED_DATE": "2016-1{}-0{}T12:30:00Z".format(r.randint(0, 2), r.randint(1, 9)),
+        "OWNER_USER_ID": "cse{}".format(r.randint(1, 20)),
+        "OWNER_FIRST_NAME": "Case",
+        "OWNER_LAST_NAME": "Owner",
+        "OWNER_EMAIL_ADDRESS": "cse{}@cisco.com".format(r.randint(1, 20)),
+        "CONTACT_USER_ID": "customer",
+        "CONTACT_USER_FIRST_NAME": "Customer",
+        "CONTACT_USER_LAST_NAME": "Contact",
+        "CONTACT_EMAIL_IDS": {"ID": "customer@example.com"},
+        "RMAS": {"ID": [str(r.randint(80000000, 89999999)) for _ in range(r.randint(0, 3))]},
+        "BUGS": {"ID": ["CSCu{}{}".format(chr(97 + r.randint(0, 25)), r.randint(10000, 99999))
+                        for _ in range(r.randint(0, 3))]}
+    }
+
+
+# Deterministic fake RMA API record for an RMA number
+def rma_detail(rma_number):
+    r = random.Random(int(rma_number))
+    shipped = r.random() < 0.7
+    return {
+        "rmaNo": str(rma_number),
+        "status": r.choice(["Booked", "Shipped", "Delivered"]) if shipped else "Booked",
+        "shipDate": "2016-1{}-0{}".format(r.randint(0, 2), r.randint(1, 9)) if shipped else None,
+        "carrier": r.choice(["UPS", "DHL", "FedEx"]) if shipped else None,
+        "trackingNumber": "1Z{}".format(r.randint(100000000, 999999999)) if shipped else None
+    }
+
+
+# Deterministic fake Bug API record for a bug ID
+def bug_detail(bug_id):
+    r = random.Random(bug_id)
+    status = r.choice(["O", "F", "F", "T"])
+    return {
+        "bug_id": bug_id,
+        "headline": "Fake defect {}".format(bug_id),
+        "status": status,
+        "severity": str(r.randint(1, 6)),
+        "known_fixed_releases": "15.{}({})M{}".format(r.randint(1, 9), r.randint(1, 4), r.randint(1, 9))
+                                if status == "F" else ""
+    }
+
+
+# Stand-in for the Case, RMA and Bug APIs and the SSO token endpoint; RMA numbers in missing_rmas are not found
+class FakeCaseAPI(FakeUpstream):
+    def __init__(self, **kwargs):
+        super(FakeCaseAPI, self).__init__(**kwargs)
+        self.cases = {}
+        self.page_size = 10
+        self.missing_rmas = set()
+
+    @property
+    def sso_url(self):
+        return self.url + "/as/token.oauth2"
+
+    @property
+    def case_api_url(self):
+        return self.url + "/case/v1.0"
+
+    @property
+    def rma_api_url(self):
+        return self.url + "/return/v1.0/returns/rma_numbers"
+
+    @property
+    def bug_api_url(self):
+        return self.url + "/bug/v2.0/bugs/bug_ids"
+
+    def detail(self, case_number):
+        if case_number not in self.cases:
+            self.cases[case_number] = case_detail(case_number)
+        return self.cases[case_number]
+
+    # One page of the open cases owned by a user; each user owns a fixed, seeded set of cases
+    def user_cases(self, user_id, page_index):
+        r = random.Random(user_id)
+        case_numbers = sorted(str(600000000 + r.randint(0, 9999999)) for _ in range(r.randint(0, 45)))
+        details = [self.detail(c) for c in case_numbers]
+        details = [dict(d, OWNER_USER_ID=user_id) for d in details if d["STATUS"] != "Closed"]
+        last_index = max(1, (len(details) + self.page_size - 1) // self.page_size)
+        page = details[(page_index - 1) * self.page_size:page_index * self.page_size]
+        return {"RESPONSE": {"COUNT": len(page), "CASES": {"CASE_DETAIL": page},
+                             "PAGINATION_RESPONSE_RECORD": {"PAGE_INDEX": page_index, "LAST_INDEX": last_index,
+                                                            "PAGE_RECORDS": self.page_size,
+                                                            "TOTAL_RECORDS": len(details)}}}
+
+    def handle(self, method, parts, query, body):
+        if parts == ["as", "token.oauth2"]:
+            return "sso/token", 200, {"access_token": "fake-access-token", "token_type": "Bearer",
+                                      "expires_in": 3599}
+        if parts[:5] == ["case", "v1.0", "cases", "details", "case_ids"] and len(parts) == 6:
+            details = [self.detail(c) for c in parts[5].split(",") if c]
+            cases = {"CASE_DETAIL": details[0] if len(details) == 1 else details}
+            return "case/details", 200, {"RESPONSE": {"COUNT": len(details), "CASES": cases}}
+        if parts[:5] == ["case", "v1.0", "cases", "users", "user_ids"] and len(parts) == 6:
+            return "case/users", 200, self.user_cases(parts[5], int(query.get("page_index", 1)))
+        if parts[:4] == ["return", "v1.0", "returns", "rma_numbers"] and len(parts) == 5:
+            if parts[4] in self.missing_rmas:
+                return "rma/details", 404, {"message": "RMA {} not found".format(parts[4])}
+            return "rma/details", 200, {"returns": {"RmaRecord": [rma_detail(parts[4])]}}
+        if parts[:4] == ["bug", "v2.0", "bugs", "bug_ids"] and len(parts) == 5:
+            bug_ids = [b for b in parts[4].split(",") if b]
+            if len(bug_ids) > 5:
+                return "bug/details", 400, {"message": "At most 5 bug IDs per request"}
+            return "bug/details", 200, {"bugs": [bug_detail(b) for b in bug_ids]}
+        return "/".join(parts), 404, {"message": "Unknown resource"}
+
+
+# Stand-in for every upstream service, answering with the responses recorded in a capture
+# Each service is served under its own path prefix (/spark/, /sso, /case_api, /rma_api, /bug_api).  A
+# call gets the next recorded response for its method and path, after the recorded latency; once they
+# are used up the last one is repeated.  Webhook registration and people/me are answered for the
+# bot's setup when they were not recorded.
+class RecordedUpstream(FakeUpstream):
+    def __init__(self, records, bot_email="bot@sparkbot.io", latency_scale=1.0):
+        super(RecordedUpstream, self).__init__()
+        self.bot_email = bot_email
+        self.latency_scale = latency_scale
+        self.responses = {}
+        self.unmatched = Counter()
+        self.webhooks = {}
+        for record in records:
+            for call in record.get("calls", []):
+                if "status" in call:
+                    key = (call["service"], call["method"], call["path"])
+                    self.responses.setdefault(key, deque()).append(call)
+
+    def service_url(self, service):
+        return self.url + "/" + service + ("/" if service == "spark" else "")
+
+    def handle(self, method, parts, query, body):
+        service = parts[0] if parts else ""
+        path = "/".join(parts[1:])
+        if query:
+            path += "?" + "&".join("{}={}".format(k, v) for k, v in sorted(query.items()))
+        route = "/".join([service] + ["{id}" if any(c.isdigit() for c in p) else p for p in parts[1:]])
+
+        with self.lock:
+            recorded = self.responses.get((service, method, path))
+            call = (recorded.popleft() if len(recorded) > 1 else recorded[0]) if recorded else None
+        if call is None:
+            if service == "spark" and parts[1:2] in [["webhooks"], ["people"]]:
+                status, payload = self._setup(method, parts[1:], body)
+                return route, status, payload
+            with self.lock:
+                self.unmatched["{} {}".format(method, route)] += 1
+            return route, 404, {"message": "Not in the capture"}
+
+        time.sleep(call["duration"] * self.latency_scale)
+        return route, call["status"], call.get("body", call.get("text"))
+
+    def _setup(self, method, parts, body):
+        if parts == ["people", "me"]:
+            return 200, {"id": "replay-bot", "emails": [self.bot_email], "displayName": "TAC Bot"}
+        if parts[0] != "webhooks":
+            return 404, {"message": "Not in the capture"}
+        with self.lock:
+            if method == "POST":
+                webhook_id = _new_id()
+                self.webhooks[webhook_id] = dict(body, id=webhook_id)
+                return 200, self.webhooks[webhook_id]
+            if method == "PUT":
+                self.webhooks[parts[-1]].update(body)
+                return 200, self.webhooks[parts[-1]]
+            if method == "DELETE":
+                self.webhooks.pop(parts[-1], None)
+                return 204, None
+            return 200, {"items": list(self.webhooks.values())}
+
+
+class _ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Stand-in for a Redis server, speaking enough of the Redis protocol for the bot's shared cache:
+# PING, AUTH, SELECT, GET, SET (with EX/PX and NX/XX), DEL and SCAN (with MATCH), with keys expiring on time.
+# EVAL only runs the leader lease's scripts, which PEXPIRE or DEL a key while it holds a given value.
+class FakeRedis(object):
+    def __init__(self, password=None):
+        self.password = password
+        self.data = {}      # key -> (value, expires or None)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = _ThreadingTCPServer(("127.0.0.1", 0), _make_redis_handler(self))
+        self.thread = None
+        super(FakeRedis, self).__init__()
+
+    @property
+    def url(self):
+        auth = ":{}@".format(self.password) if self.password else ""
+        return "redis://{}127.0.0.1:{}/0".format(auth, self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls.clear()
+
+    def _live(self, key, now):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self.data[key]
+            return None
+        return entry
+
+    # Run one command; returns the reply, or an Exception instance for an error reply
+    def execute(self, args, session):
+        name = args[0].decode("utf-8").upper()
+        args = args[1:]
+        now = time.time()
+        with self.lock:
+            self.calls[name] += 1
+            if name == "AUTH":
+                session["authenticated"] = args[0].decode("utf-8") == self.password
+                return "OK" if session["authenticated"] else Exception("WRONGPASS invalid password")
+            if self.password and not session.get("authenticated"):
+                return Exception("NOAUTH Authentication required.")
+            if name in ["PING", "SELECT"]:
+                return "PONG" if name == "PING" else "OK"
+            if name == "GET":
+                entry = self._live(args[0], now)
+                return entry[0] if entry else None
+            if name == "SET":
+                expires = None
+                options = [a.decode("utf-8").upper() for a in args[2:]]
+                if "EX" in options:
+                    expires = now + float(args[3 + options.index("EX")])
+                if "PX" in options:
+                    expires = now + float(args[3 + options.index("PX")]) / 1000
+                exists = self._live(args[0], now) is not None
+                if ("NX" in options and exists) or ("XX" in options and not exists):
+                    return None
+                self.data[args[0]] = (args[1], expires)
+                return "OK"
+            if name == "DEL":
+                return sum(1 for key in args if self._live(key, now) and self.data.pop(key, None))
+            if name == "EVAL":
+                script, key, value = args[0].decode("utf-8"), args[2], args[3]
+                entry = self._live(key, now)
+                if entry is None or entry[0] != value:
+                    return 0
+                if 'redis.call("PEXPIRE"' in script:
+                    self.data[key] = (entry[0], now + float(args[4]) / 1000)
+                    return 1
+                if 'redis.call("DEL"' in script:
+                    del self.data[key]
+                    return 1
+                return Exception("ERR unsupported script")
+            if name == "SCAN":
+                pattern = args[args.index(b"MATCH") + 1] if b"MATCH" in args else b"*"
+                keys = [k for k in list(self.data) if fnmatch.fnmatchcase(k, pattern) and self._live(k, now)]
+                return [b"0", keys]
+            return Exception("ERR unknown command '{}'".format(name))
+
+
+# Build a stream handler class bound to a FakeRedis
+def _make_redis_handler(fake):
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            session = {}
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int(self.rfile.readline()[1:-2])
+                    args.append(self.rfile.read(length + 2)[:-2])
+                self.wfile.write(_encode_reply(fake.execute(args, session)))
+
+    return Handler
+
+
+# Encode a reply in the Redis protocol
+def _encode_reply(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, Exception):
+        return "-{}\r\n".format(reply).encode("utf-8")
+    if isinstance(reply, int):
+        return ":{}\r\n".format(reply).encode("utf-8")
+    if isinstance(reply, list):
+        return "*{}\r\n".format(len(reply)).encode("utf-8") + b"".join(_encode_reply(r) for r in reply)
+    if isinstance(reply, bytes):
+        return "${}\r\n".format(len(reply)).encode("utf-8") + reply + b"\r\n"
+    return "+{}\r\n".format(reply).encode("utf-8")
@@ -0,0 +1,250 @@
+#! /usr/bin/python
+
+"""
+loadtest.py replays webhook POSTs against the bot's Flask app at a target rate, with the
+Spark REST API, the Case API and SSO replaced by local stand-ins from fakes.py.
+
+    python benchmarks/loadtest.py --rate 20 --duration 30 --latency 50 --error-rate 0.01
+    python benchmarks/loadtest.py --redis        # use a shared cache stand-in (CACHE_URL)
+
+The report shows p50/p95/p99 latency, throughput, and the upstream calls made per command.
+Latency is measured from the time each request was scheduled, so queueing inside the
+load generator is included.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from fakes import FakeSpark, FakeCaseAPI, FakeRedis
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+
+# Default command mix; "chatter" is a message with no command in it
+DEFAULT_MIX = "/status:3,/title:2,/owner:1,/updated:1,/rma:1,/link:1,/help:1,chatter:2"
+
+
+# Collects finished traces to attribute upstream calls to commands
+class TraceCollector(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.calls = defaultdict(lambda: defaultdict(int))
+        super(TraceCollector, self).__init__()
+
+    def export(self, root):
+        if root.name != "webhook":
+            return
+        command = root.attributes.get("command", "(none)")
+        with self.lock:
+            self.requests[command] += 1
+            for depth, s in root.walk():
+                if depth > 0:
+                    self.calls[command][s.name] += 1
+
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0.0
+    index = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(len(values) - 1, index))]
+
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(","):
+        name, _, weight = item.partition(":")
+        weights.append((name.strip(), float(weight or 1)))
+    return weights
+
+
+# Start the stand-ins, point the bot at them and configure it
+def setup_bot(args):
+    spark_fake = FakeSpark(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0).start()
+    case_fake = FakeCaseAPI(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0).start()
+    redis_fake = FakeRedis().start() if args.redis else None
+    if redis_fake:
+        os.environ["CACHE_URL"] = redis_fake.url
+
+    os.environ.update({
+        "SPARK_API_URL": spark_fake.url,
+        "SSO_URL": case_fake.sso_url,
+        "CASE_API_URL": case_fake.case_api_url,
+        "RMA_API_URL": case_fake.rma_api_url,
+        "BUG_API_URL": case_fake.bug_api_url,
+        "SPARK_BOT_TOKEN": "fake-spark-token",
+        "CASE_API_CLIENT_ID": "fake-client-id",
+        "CASE_API_CLIENT_SECRET": "fake-client-secret",
+        "TRACE_SLOW_THRESHOLD": os.environ.get("TRACE_SLOW_THRESHOLD", "3600"),
+        # A few simulated users send far more than a person would; set these to load test the limits
+        "PERSON_RATE_LIMIT": os.environ.get("PERSON_RATE_LIMIT", "0"),
+        "ROOM_RATE_LIMIT": os.environ.get("ROOM_RATE_LIMIT", "0"),
+    })
+    sys.path.insert(0, os.path.abspath(BOT_DIR))
+    import bot
+    bot.bot_url = "http://127.0.0.1/"
+    bot.bot_app_name = "tac-bot-loadtest"
+    bot.spark_setup("bot@sparkbot.io", "fake-spark-token")
+
+    # Webhook setup runs in the background; wait for the bot to report ready
+    deadline = time.time() + 10
+    while not bot.bot_ready and time.time() < deadline:
+        time.sleep(0.05)
+    return bot, spark_fake, case_fake, redis_fake
+
+
+# Pre-create rooms, users and one message per request in the Spark stand-in
+def build_workload(spark_fake, args):
+    r = random.Random(args.seed)
+    users = [spark_fake.add_person("engineer{}@cisco.com".format(i)) for i in range(args.users)]
+    rooms = []
+    for i in range(args.rooms):
+        case_number = str(611000000 + r.randint(0, 999999))
+        rooms.append(spark_fake.add_room("SR {}: Fake case".format(case_number), members=users))
+
+    mix = parse_mix(args.mix)
+    total_weight = sum(w for _, w in mix)
+    payloads = []
+    for _ in range(int(args.rate * args.duration)):
+        pick = r.uniform(0, total_weight)
+        for name, weight in mix:
+            pick -= weight
+            if pick <= 0:
+                break
+        text = "thanks, looking into it now" if name == "chatter" else name
+        room_id = r.choice(rooms)
+        person_id = r.choice(users)
+        message_id = spark_fake.add_message(room_id, person_id, text)
+        payloads.append({"id": "loadtest", "resource": "messages", "event": "created",
+                         "data": {"id": message_id, "roomId": room_id, "personId": person_id,
+                                  "personEmail": spark_fake.people[person_id]["emails"][0]}})
+    return payloads
+
+
+# Fire payloads at the target rate and collect latencies
+def run(app, payloads, rate, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def fire(payload, due):
+        client = app.test_client()
+        response = client.post("/", data=json.dumps(payload), content_type="application/json")
+        elapsed = time.time() - due
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code != 200:
+                errors[0] += 1
+
+    pool = ThreadPool(concurrency)
+    start = time.time()
+    for i, payload in enumerate(payloads):
+        due = start + i / float(rate)
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        pool.apply_async(fire, (payload, due))
+    pool.close()
+    pool.join()
+    return sorted(latencies), errors[0], time.time() - start
+
+
+def report(latencies, errors, elapsed, collector, fakes):
+    result = {
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": dict((k, round(percentile(latencies, p) * 1000, 2))
+                           for k, p in [("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)]),
+        "upstream_calls_per_command": {},
+        "upstream_calls_by_route": {}
+    }
+    for command, count in collector.requests.items():
+        calls = collector.calls[command]
+        result["upstream_calls_per_command"][command] = {
+            "requests": count,
+            "calls": round(sum(calls.values()) / float(count), 2),
+            "by_call": dict((k, round(v / float(count), 2)) for k, v in calls.items())
+        }
+    for fake in fakes:
+        for route, count in fake.calls.items():
+            if isinstance(fake, FakeRedis):
+                route = "cache " + route
+            result["upstream_calls_by_route"][route] = count
+    return result
+
+
+def print_report(result):
+    print("Requests: {requests} in {elapsed}s ({throughput} req/s), errors: {errors}".format(**result))
+    print("Latency (ms): p50 {p50}  p95 {p95}  p99 {p99}  max {max}".format(**result["latency_ms"]))
+    print("Upstream calls per command:")
+    for command, stats in sorted(result["upstream_calls_per_command"].items()):
+        detail = ", ".join("{}={}".format(k, v) for k, v in sorted(stats["by_call"].items()))
+        print("  {:<12} n={:<5} calls={:<6} ({})".format(command, stats["requests"], stats["calls"], detail))
+    print("Upstream calls by route:")
+    for route, count in sorted(result["upstream_calls_by_route"].items()):
+        print("  {:<28} {}".format(route, count))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the bot against local Spark and Case API stand-ins")
+    parser.add_argument("--rate", type=float, default=10.0, help="target webhooks per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load to generate")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent webhook senders")
+    parser.add_argument("--latency", type=float, default=20.0, help="injected upstream latency (ms)")
+    parser.add_argument("--jitter", type=float, default=10.0, help="random extra upstream latency (ms)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls that fail")
+    parser.add_argument("--rooms", type=int, default=50, help="number of case rooms")
+    parser.add_argument("--users", type=int, default=10, help="number of users sending messages")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted command mix, e.g. /status:3,chatter:1")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the workload")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own log output")
+    parser.add_argument("--redis", action="store_true", help="share the bot's caches through a Redis stand-in")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bot, spark_fake, case_fake, redis_fake = setup_bot(args)
+    fakes = [f for f in (spark_fake, case_fake, redis_fake) if f]
+
+    import tracing
+    collector = TraceCollector()
+    tracing.add_exporter(collector)
+
+    payloads = build_workload(spark_fake, args)
+    for fake in fakes:
+        fake.reset_counts()
+    for fake in (spark_fake, case_fake):
+        fake.error_rate = args.error_rate
+
+    stderr = sys.stderr
+    if not args.verbose:
+        sys.stderr = open(os.devnull, "w")
+    try:
+        latencies, errors, elapsed = run(bot.app, payloads, args.rate, args.concurrency)
+    finally:
+        sys.stderr = stderr
+
+    result = report(latencies, errors, elapsed, collector, fakes)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print_report(result)
+
+    for fake in fakes:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#! /usr/bin/python
+
+"""
+microbench.py times the code run for every incoming message: command matching, case number
+parsing, CaseDetail access and reply formatting.  It runs offline: the upstream calls made by
+bot.py are replaced with fixture payloads from fixtures.json.
+
+    python benchmarks/microbench.py                  # compare against benchmarks/baselines.json
+    python benchmarks/microbench.py --update         # record new baselines
+    python benchmarks/microbench.py --threshold 0.5  # allowed slowdown before failing (default 25%)
+
+Timings are recorded relative to a fixed calibration workload, so baselines recorded on one
+machine can be checked on another.  They do not carry over between interpreters, though:
+baselines.json is recorded with the Python 2.7 the bot runs on, and the script warns when run
+with another version.  The script exits non-zero if any benchmark is slower than its baseline
+by more than the threshold.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.join(BENCH_DIR, "..", "bot")
+FIXTURES = os.path.join(BENCH_DIR, "fixtures.json")
+BASELINES = os.path.join(BENCH_DIR, "baselines.json")
+
+
+# Fixed workload of string, regex and dict operations; benchmark times are reported as multiples of it
+def calibration():
+    pattern = re.compile("([a-z0-9]+)@([a-z]+)\\.com")
+    counts = {}
+    for i in range(200):
+        text = "user{}@example.com sent /status {}".format(i, 612345678 + i)
+        match = pattern.search(text)
+        counts[match.group(2)] = counts.get(match.group(2), 0) + len(text.split())
+    return counts
+
+
+# Number of calls of func taking at least min_time seconds
+def calls_for(timer, min_time):
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            return number
+        number = number * 10 if elapsed < min_time / 10 else int(number * min_time / elapsed) + 1
+
+
+# Best time per call of func, and of the calibration workload, in seconds.  Runs of the two
+# alternate, so a machine slowing down or speeding up during the run affects both alike.
+def measure(func, repeat=20, min_time=0.01):
+    timer = timeit.Timer(func)
+    reference = timeit.Timer(calibration)
+    number = calls_for(timer, min_time)
+    reference_number = calls_for(reference, min_time)
+    best = reference_best = None
+    for _ in range(repeat):
+        elapsed = timer.timeit(number) / number
+        reference_elapsed = reference.timeit(reference_number) / reference_number
+        best = elapsed if best is None else min(best, elapsed)
+        reference_best = reference_elapsed if reference_best is None else min(reference_best, reference_elapsed)
+    return best, reference_best
+
+
+# Import the bot with logging quietened, and replace its upstream calls with fixture payloads
+def load_bot(fixtures):
+    os.environ["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "ERROR")
+    os.environ["TRACE_SLOW_THRESHOLD"] = "3600"
+    sys.path.insert(0, os.path.abspath(BOT_DIR))
+    import bot
+    import utilities
+    from ciscosparkapi import Message
+    from rma import RMADetail
+    from bugs import BugDetail
+
+    messages = {}
+    for name, text in fixtures["texts"].items():
+        message = dict(fixtures["message"])
+        message["id"] = name
+        message["text"] = text
+        messages[name] = Message(message)
+
+    def bug(bug_id):
+        detail = dict(fixtures["bug"])
+        detail["bug_id"] = bug_id
+        return BugDetail(detail)
+
+    bot.get_message = lambda message_id: messages[message_id]
+    bot.get_bot_emails = lambda: ["bot@sparkbot.io"]
+    bot.send_message = lambda **kwargs: None
+    bot.get_email = lambda person_id: fixtures["message"]["personEmail"]
+    bot.get_case_details = lambda case_number: fixtures["case"]
+    bot.get_rmas_details = lambda rmas: dict((str(r), RMADetail(fixtures["rma"])) for r in rmas)
+    bot.get_bugs_details = lambda bugs: dict((b, bug(b)) for b in bugs)
+    utilities.get_room_name = lambda room_id: "SR 612345678: BGP sessions flap"
+    return bot
+
+
+# The benchmarks, as (name, function) pairs
+def benchmarks(bot, fixtures):
+    import utilities
+    from case import CaseDetail
+
+    def webhook(name):
+        return {"id": "microbench", "resource": "messages", "event": "created",
+                "data": {"id": name, "roomId": fixtures["message"]["roomId"],
+                         "personId": fixtures["message"]["personId"]}}
+
+    def case_detail_access():
+        case = CaseDetail(fixtures["case"])
+        return (case.count, case.title, case.description, case.status, case.severity, case.owner_first,
+                case.owner_last, case.owner_email, case.created, case.updated, case.rmas, case.bugs,
+                case.serial, case.hostname, case.customer_email, case.customer_business)
+
+    chatter = fixtures["texts"]["chatter"]
+    status = fixtures["texts"]["title"]
+    result = [
+        ("verify_case_number", lambda: utilities.verify_case_number(status)),
+        ("verify_case_number_miss", lambda: utilities.verify_case_number(chatter)),
+        ("extract_message", lambda: utilities.extract_message("/title", status)),
+        ("check_cisco_user", lambda: utilities.check_cisco_user(fixtures["message"]["personEmail"])),
+        ("case_detail_access", case_detail_access),
+        ("send_help", lambda: bot.send_help(False))
+    ]
+    for name in ["title", "description", "status", "owner", "customer", "contract", "device", "created",
+                 "updated", "rma", "bug", "link"]:
+        func = getattr(bot, {"rma": "send_rma_numbers"}.get(name, "send_" + name))
+        result.append(("send_" + name, lambda func=func, post_data=webhook(name): func(post_data)))
+    for name in ["chatter", "help", "status"]:
+        result.append(("process_message_" + name,
+                       lambda post_data=webhook(name): bot.process_incoming_message(post_data)))
+    return result
+
+
+def run(names=None):
+    with open(FIXTURES) as f:
+        fixtures = json.load(f)
+    bot = load_bot(fixtures)
+    calibration_times = []
+    results = {}
+    for name, func in benchmarks(bot, fixtures):
+        if names and not any(n in name for n in names):
+            continue
+        seconds, calibration_time = measure(func)
+        calibration_times.append(calibration_time)
+        results[name] = {"us": round(seconds * 1e6, 3), "units": round(seconds / calibration_time, 5)}
+    return min(calibration_times or [0]), results
+
+
+# Keep the faster result of each benchmark
+def merge_best(results, more):
+    for name, result in more.items():
+        if name not in results or result["units"] < results[name]["units"]:
+            results[name] = result
+    return results
+
+
+# Compare results with baselines; returns (name, result, baseline units, change) rows and whether any regressed
+def compare(results, baselines, threshold):
+    rows = []
+    regressed = False
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name)
+        change = None
+        if baseline:
+            change = result["units"] / baseline - 1
+            regressed = regressed or change > threshold
+        rows.append((name, result, baseline, change))
+    return rows, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the per-message code paths")
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--update", action="store_true", help="record the results as the new baselines")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown (0.25 = 25%%)")
+    parser.add_argument("--baselines", default=BASELINES, help="baselines file")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    calibration_time, results = run(args.names)
+    baselines = {}
+    recorded_python = None
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            recorded = json.load(f)
+        baselines = recorded.get("benchmarks", {})
+        recorded_python = recorded.get("python")
+
+    if args.update:
+        # Baselines are the median of three runs: the best of three would let one unusually fast run set a
+        # baseline that later checks fail against
+        runs = [results] + [run(args.names)[1] for _ in range(2)]
+        for name in results:
+            units = sorted(r[name]["units"] for r in runs)
+            baselines[name] = units[len(units) // 2]
+        with open(args.baselines, "w") as f:
+            json.dump({"recorded": time.strftime("%Y-%m-%d"), "python": sys.version.split()[0],
+                       "benchmarks": baselines}, f, indent=2, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+        print("Recorded {} baselines in {}".format(len(results), args.baselines))
+        return 0
+
+    # Units differ between interpreter versions, so a comparison across versions is only indicative
+    python = "{}.{}".format(*sys.version_info[:2])
+    if recorded_python and not recorded_python.startswith(python + "."):
+        sys.stderr.write("Warning: baselines were recorded with Python {}, this is Python {}\n".format(
+            recorded_python, sys.version.split()[0]))
+
+    # Benchmarks over the threshold are run up to twice more, and the best result kept, so that a
+    # single noisy run does not fail the check
+    rows, regressed = compare(results, baselines, args.threshold)
+    for _ in range(2):
+        if not regressed:
+            break
+        slow = [name for name, result, baseline, change in rows if change is not None and change > args.threshold]
+        merge_best(results, run(slow)[1])
+        rows, regressed = compare(results, baselines, args.threshold)
+    if args.json:
+        print(json.dumps({"calibration_us": round(calibration_time * 1e6, 3), "results": results,
+                          "baselines": baselines, "regressed": regressed}, indent=2, sort_keys=True))
+    else:
+        print("Calibration: {:.1f}us".format(calibration_time * 1e6))
+        print("{:<28} {:>10} {:>9} {:>9} {:>8}".format("benchmark", "us/call", "units", "baseline", "change"))
+        for name, result, baseline, change in rows:
+            flag = "  REGRESSED" if change is not None and change > args.threshold else ""
+            print("{:<28} {:>10} {:>9} {:>9} {:>8}{}".format(
+                name, result["us"], result["units"], baseline if baseline else "-",
+                "{:+.1%}".format(change) if change is not None else "-", flag))
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
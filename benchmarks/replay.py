@@ -0,0 +1,151 @@
+#! /usr/bin/python
+
+"""
+replay.py replays a webhook capture (see bot/capture.py) against the bot's Flask app, with every
+upstream service replaced by a stand-in answering with the recorded responses after the recorded
+latency.  Webhooks are sent in their recorded order and at their recorded times, so the same
+workload can be compared across code versions.
+
+    # Record, here from a load test, then replay
+    CAPTURE_FILE=/tmp/capture.ndjson python benchmarks/loadtest.py --rate 20 --duration 30
+    PERSON_RATE_LIMIT=0 ROOM_RATE_LIMIT=0 python benchmarks/replay.py /tmp/capture.ndjson --json > before.json
+
+    python benchmarks/replay.py /tmp/capture.ndjson --speed 2      # twice as fast
+    python benchmarks/replay.py /tmp/capture.ndjson --speed 0      # as fast as --concurrency allows
+
+The report is the load test's, with the latency recorded in production alongside, and the upstream
+calls the replayed code made that were not in the capture.  --bot-email must be the address the
+bot had when the capture was made, unless the capture includes the bot's people/me call.  Settings
+such as the rate limits and cache TTLs are read from the environment, as in the bot; set them as
+they were when the capture was made (the load test turns the rate limits off).
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from fakes import RecordedUpstream
+from loadtest import BOT_DIR, TraceCollector, percentile, report, print_report
+
+
+def load_capture(path):
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda r: r["time"])
+
+
+# Point the bot at the recorded upstreams and configure it
+def setup_bot(records, args):
+    sys.path.insert(0, os.path.abspath(BOT_DIR))
+    from capture import mask_emails
+    bot_email = mask_emails(args.bot_email)
+    upstream = RecordedUpstream(records, bot_email, latency_scale=args.latency_scale).start()
+
+    # Replayed traffic is not captured again
+    os.environ.pop("CAPTURE_FILE", None)
+    os.environ.update({
+        "SPARK_API_URL": upstream.service_url("spark"),
+        "SSO_URL": upstream.service_url("sso"),
+        "CASE_API_URL": upstream.service_url("case_api"),
+        "RMA_API_URL": upstream.service_url("rma_api"),
+        "BUG_API_URL": upstream.service_url("bug_api"),
+        "SPARK_BOT_TOKEN": "replay-spark-token",
+        "CASE_API_CLIENT_ID": "replay-client-id",
+        "CASE_API_CLIENT_SECRET": "replay-client-secret",
+        "TRACE_SLOW_THRESHOLD": os.environ.get("TRACE_SLOW_THRESHOLD", "3600"),
+    })
+    import bot
+    bot.bot_url = "http://127.0.0.1/"
+    bot.bot_app_name = "tac-bot-replay"
+    bot.spark_setup(bot_email, "replay-spark-token")
+
+    deadline = time.time() + 10
+    while not bot.bot_ready and time.time() < deadline:
+        time.sleep(0.05)
+    return bot, upstream
+
+
+# Send the recorded webhooks at their recorded offsets, divided by speed; 0 sends them without pauses
+def replay(app, records, speed, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def fire(payload, due):
+        client = app.test_client()
+        response = client.post("/", data=json.dumps(payload), content_type="application/json")
+        elapsed = time.time() - due
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code != 200:
+                errors[0] += 1
+
+    pool = ThreadPool(concurrency)
+    start = time.time()
+    first = records[0]["time"] if records else 0
+    for record in records:
+        due = start + (record["time"] - first) / speed if speed > 0 else time.time()
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        pool.apply_async(fire, (record["payload"], due))
+    pool.close()
+    pool.join()
+    return sorted(latencies), errors[0], time.time() - start
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a webhook capture against recorded upstream responses")
+    parser.add_argument("capture", help="capture file written with CAPTURE_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed; 0 sends webhooks without pauses")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent webhook senders")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="factor applied to recorded latencies")
+    parser.add_argument("--bot-email", default="bot@sparkbot.io", help="bot address when the capture was made")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own log output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    records = load_capture(args.capture)
+    if not records:
+        sys.exit("No webhooks in {}".format(args.capture))
+    bot, upstream = setup_bot(records, args)
+
+    import tracing
+    collector = TraceCollector()
+    tracing.add_exporter(collector)
+    upstream.reset_counts()
+
+    stderr = sys.stderr
+    if not args.verbose:
+        sys.stderr = open(os.devnull, "w")
+    try:
+        latencies, errors, elapsed = replay(bot.app, records, args.speed, args.concurrency)
+    finally:
+        sys.stderr = stderr
+
+    result = report(latencies, errors, elapsed, collector, [upstream])
+    recorded = sorted(r["duration"] for r in records)
+    result["recorded_latency_ms"] = dict((k, round(percentile(recorded, p) * 1000, 2))
+                                         for k, p in [("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)])
+    result["unmatched_calls"] = dict(upstream.unmatched)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print_report(result)
+        print("Recorded latency (ms): p50 {p50}  p95 {p95}  p99 {p99}  max {max}".format(
+            **result["recorded_latency_ms"]))
+        print("Calls not in the capture:")
+        for route, count in sorted(result["unmatched_calls"].items()):
+            print("  {:<28} {}".format(route, count))
+    upstream.stop()
+
+
+if __name__ == '__main__':
+    main()
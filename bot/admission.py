@@ -0,0 +1,167 @@
+#! /usr/bin/python
+
+"""
+admission.py file contains the admission control applied to incoming messages
+
+Messages are admitted by priority class:
+
+    local   - /help and /link need no case data, and are always answered
+    case    - commands that look up case data run at most ADMISSION_CASE_CONCURRENCY at a time;
+              a message waits up to ADMISSION_CASE_WAIT seconds for a slot, with at most
+              ADMISSION_CASE_QUEUE messages waiting, and is shed otherwise
+    chatter - messages without a command are shed while more than ADMISSION_SHED_BACKLOG
+              messages are being processed
+
+A shed message is answered with a short "busy, retry" reply, at most once per room every
+ADMISSION_BUSY_INTERVAL seconds.  Counts by class and the current backlog are served by /metrics.
+
+    export ADMISSION_CASE_CONCURRENCY=8
+    export ADMISSION_CASE_QUEUE=32
+    export ADMISSION_CASE_WAIT=5
+    export ADMISSION_SHED_BACKLOG=16
+    export ADMISSION_BUSY_INTERVAL=60
+"""
+
+import os
+import time
+import threading
+
+case_concurrency = int(os.environ.get("ADMISSION_CASE_CONCURRENCY", "8"))
+case_queue = int(os.environ.get("ADMISSION_CASE_QUEUE", "32"))
+case_wait = float(os.environ.get("ADMISSION_CASE_WAIT", "5"))
+shed_backlog = int(os.environ.get("ADMISSION_SHED_BACKLOG", "16"))
+busy_interval = float(os.environ.get("ADMISSION_BUSY_INTERVAL", "60"))
+
+CLASSES = ["local", "case", "chatter"]
+LOCAL_COMMANDS = ["/help", "/link"]
+
+BUSY_MESSAGE = "Sorry, I'm busy with a burst of requests right now. Please retry in a minute."
+
+
+# Priority class of a command; "" is a message without a command
+def classify(command):
+    if command == "":
+        return "chatter"
+    if command in LOCAL_COMMANDS:
+        return "local"
+    return "case"
+
+
+# Admits or sheds messages by priority class, and counts the outcome
+class AdmissionController(object):
+    def __init__(self, case_concurrency=case_concurrency, case_queue=case_queue, case_wait=case_wait,
+                 shed_backlog=shed_backlog, busy_interval=busy_interval):
+        self.case_concurrency = case_concurrency
+        self.case_queue = case_queue
+        self.case_wait = case_wait
+        self.shed_backlog = shed_backlog
+        self.busy_interval = busy_interval
+        self.backlog = 0            # messages being processed
+        self.case_active = 0
+        self.case_waiting = 0
+        self.admitted = dict((c, 0) for c in CLASSES)
+        self.shed = dict((c, 0) for c in CLASSES)
+        self.case_wait_seconds = 0.0
+        self.busy_replies = 0
+        self._busy_sent = {}        # room id -> time of the last busy reply
+        self._lock = threading.Lock()
+        self._slot_free = threading.Condition(self._lock)
+        super(AdmissionController, self).__init__()
+
+    # Count a message as being processed until leave() is called
+    def enter(self):
+        with self._lock:
+            self.backlog += 1
+
+    def leave(self):
+        with self._lock:
+            self.backlog -= 1
+
+    # Admit a message of the given class; returns False if it is shed.  An admitted case message must
+    # be followed by release("case").
+    def admit(self, priority):
+        if priority == "case":
+            return self._admit_case()
+        with self._lock:
+            if priority == "chatter" and self.backlog > self.shed_backlog:
+                self.shed[priority] += 1
+                return False
+            self.admitted[priority] += 1
+            return True
+
+    def _admit_case(self):
+        with self._lock:
+            if self.case_active < self.case_concurrency:
+                self.case_active += 1
+                self.admitted["case"] += 1
+                return True
+            if self.case_waiting >= self.case_queue:
+                self.shed["case"] += 1
+                return False
+
+            # Wait for a running case command to finish
+            self.case_waiting += 1
+            start = time.time()
+            deadline = start + self.case_wait
+            while self.case_active >= self.case_concurrency and time.time() < deadline:
+                self._slot_free.wait(deadline - time.time())
+            self.case_waiting -= 1
+            self.case_wait_seconds += time.time() - start
+            if self.case_active >= self.case_concurrency:
+                self.shed["case"] += 1
+                return False
+            self.case_active += 1
+            self.admitted["case"] += 1
+            return True
+
+    def release(self, priority):
+        if priority == "case":
+            with self._lock:
+                self.case_active -= 1
+                self._slot_free.notify()
+
+    # Whether a busy reply should be sent to a room; rooms get at most one per busy_interval
+    def should_reply_busy(self, room_id):
+        now = time.time()
+        with self._lock:
+            if now - self._busy_sent.get(room_id, 0) < self.busy_interval:
+                return False
+            if len(self._busy_sent) > 10000:
+                self._busy_sent = dict((r, t) for r, t in self._busy_sent.items() if now - t < self.busy_interval)
+            self._busy_sent[room_id] = now
+            self.busy_replies += 1
+            return True
+
+    # Metrics as (name, help, type, [(labels, value)]) tuples
+    def metrics(self):
+        with self._lock:
+            return [
+                ("tacbot_messages_admitted_total", "Messages admitted, by priority class", "counter",
+                 [({"class": c}, self.admitted[c]) for c in CLASSES]),
+                ("tacbot_messages_shed_total", "Messages shed, by priority class", "counter",
+                 [({"class": c}, self.shed[c]) for c in CLASSES]),
+                ("tacbot_busy_replies_total", "Busy replies sent for shed messages", "counter",
+                 [({}, self.busy_replies)]),
+                ("tacbot_message_backlog", "Messages being processed", "gauge", [({}, self.backlog)]),
+                ("tacbot_case_commands_active", "Case commands running", "gauge", [({}, self.case_active)]),
+                ("tacbot_case_commands_waiting", "Case commands waiting for a slot", "gauge",
+                 [({}, self.case_waiting)]),
+                ("tacbot_case_wait_seconds_total", "Time case commands spent waiting for a slot", "counter",
+                 [({}, round(self.case_wait_seconds, 6))])
+            ]
+
+
+# Format metrics in the Prometheus text exposition format
+def format_metrics(metrics):
+    lines = []
+    for name, help_text, kind, samples in metrics:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+            lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+    return "\n".join(lines) + "\n"
+
+
+# Admission control for this instance
+controller = AdmissionController()
@@ -0,0 +1,232 @@
+#! /usr/bin/python
+
+"""
+aging.py file contains the columnar case store and the case-aging analytics for bot.py
+
+Every case the bot fetches from the Case API is recorded in a set of NumPy arrays, one
+array per attribute (creation time, last update, severity, owner, closed).  Aging reports
+are computed over whole columns at once, so a report over tens of thousands of cases takes
+milliseconds instead of one datetime calculation per case.
+
+    # Open cases not updated for this many days are flagged as stale
+    export AGING_STALE_DAYS=3
+"""
+
+import os
+import time
+import calendar
+import threading
+import numpy as np
+from case import CaseDetail
+
+stale_days = float(os.environ.get("AGING_STALE_DAYS", "3"))
+
+DAY = 86400.0
+
+# Severity labels by severity code; code 0 is used when the severity is missing or not a number
+SEVERITIES = ["unknown", "1", "2", "3", "4", "5", "6"]
+
+
+# Convert a Case API timestamp to epoch seconds, or NaN if it cannot be parsed
+def parse_timestamp(value):
+    try:
+        return float(calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ')))
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+# Array-backed store of case timestamps and attributes, one row per case
+class CaseStore(object):
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.case_numbers = []
+        self.owners = []
+        self._rows = {}
+        self._owner_codes = {}
+        self._lock = threading.Lock()
+        self.created = np.full(capacity, np.nan)
+        self.updated = np.full(capacity, np.nan)
+        self.severity = np.zeros(capacity, dtype=np.int8)
+        self.owner = np.zeros(capacity, dtype=np.int32)
+        self.closed = np.zeros(capacity, dtype=bool)
+        super(CaseStore, self).__init__()
+
+    def __len__(self):
+        return self.size
+
+    # Record or refresh a case from a single-case Case API response
+    def record(self, case_number, json):
+        case = CaseDetail(json)
+        if not case.count:
+            return
+        try:
+            severity = int(case.severity)
+        except (TypeError, ValueError, KeyError):
+            severity = 0
+        if not 0 < severity < len(SEVERITIES):
+            severity = 0
+        created = parse_timestamp(case.created)
+        updated = parse_timestamp(case.updated)
+        closed = "Closed" in (case.status or "")
+        owner = case.owner_email or "unknown"
+
+        with self._lock:
+            row = self._rows.get(str(case_number))
+            if row is None:
+                if self.size == len(self.created):
+                    self._grow()
+                row = self.size
+                self.size += 1
+                self._rows[str(case_number)] = row
+                self.case_numbers.append(str(case_number))
+            if owner not in self._owner_codes:
+                self._owner_codes[owner] = len(self.owners)
+                self.owners.append(owner)
+            self.created[row] = created
+            self.updated[row] = updated
+            self.severity[row] = severity
+            self.owner[row] = self._owner_codes[owner]
+            self.closed[row] = closed
+
+    # Double the capacity of every column
+    def _grow(self):
+        for name in ["created", "updated", "severity", "owner", "closed"]:
+            column = getattr(self, name)
+            grown = np.full(len(column) * 2, np.nan) if column.dtype == np.float64 else \
+                np.zeros(len(column) * 2, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    # Copy the filled part of every column, so a report is not affected by concurrent updates
+    def snapshot(self):
+        with self._lock:
+            n = self.size
+            return {
+                "case_numbers": list(self.case_numbers),
+                "owners": list(self.owners),
+                "created": self.created[:n].copy(),
+                "updated": self.updated[:n].copy(),
+                "severity": self.severity[:n].copy(),
+                "owner": self.owner[:n].copy(),
+                "closed": self.closed[:n].copy()
+            }
+
+    # Aging distributions for open cases, overall and by severity and owner, with stale cases listed
+    def report(self, now=None, limit=10):
+        now = time.time() if now is None else now
+        columns = self.snapshot()
+        closed = columns["closed"]
+        rows = np.flatnonzero(~closed & ~np.isnan(columns["created"]))
+
+        open_days = (now - columns["created"][rows]) / DAY
+        update_days = (now - columns["updated"][rows]) / DAY
+        update_days = np.where(np.isnan(update_days), open_days, update_days)
+        stale = update_days >= stale_days
+        severity = columns["severity"][rows].astype(np.int64)
+        owner = columns["owner"][rows].astype(np.int64)
+
+        # Stale cases, longest since last update first
+        stale_rows = rows[stale]
+        stale_update_days = update_days[stale]
+        order = np.argsort(-stale_update_days, kind="mergesort")[:limit]
+        stale_cases = [{
+            "case_number": columns["case_numbers"][stale_rows[i]],
+            "severity": SEVERITIES[columns["severity"][stale_rows[i]]],
+            "owner": columns["owners"][columns["owner"][stale_rows[i]]],
+            "days_since_update": round(float(stale_update_days[i]), 1)
+        } for i in order.tolist()]
+
+        owners = group_stats(owner, open_days, update_days, stale, columns["owners"])
+        owners.sort(key=lambda g: (-g["stale"], -g["open"]))
+        return {
+            "generated": int(now),
+            "stale_days": stale_days,
+            "cases": len(closed),
+            "open": len(rows),
+            "closed": int(np.count_nonzero(closed)),
+            "stale": int(np.count_nonzero(stale)),
+            "open_days": distribution(open_days),
+            "days_since_update": distribution(update_days),
+            "by_severity": group_stats(severity, open_days, update_days, stale, SEVERITIES),
+            "by_owner": owners,
+            "stale_cases": stale_cases
+        }
+
+
+# Summary statistics of an array of day counts
+def distribution(values):
+    if not len(values):
+        return {"count": 0, "mean": None, "p50": None, "p90": None, "p99": None, "max": None}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "count": len(values),
+        "mean": round(float(values.mean()), 2),
+        "p50": round(float(p50), 2),
+        "p90": round(float(p90), 2),
+        "p99": round(float(p99), 2),
+        "max": round(float(values.max()), 2)
+    }
+
+
+# Per-group counts, medians and stale counts, with groups given as integer codes into labels
+def group_stats(codes, open_days, update_days, stale, labels):
+    counts = np.bincount(codes, minlength=len(labels))
+    stale_counts = np.bincount(codes, weights=stale, minlength=len(labels))
+    starts = np.cumsum(counts) - counts
+    present = np.flatnonzero(counts)
+    if not len(present):
+        return []
+
+    # Sort each column by group and value in one pass, by offsetting every group past the previous
+    # group's range; the median is then the middle of each group's run
+    lower = starts[present] + (counts[present] - 1) // 2
+    upper = starts[present] + counts[present] // 2
+    sorted_codes = np.repeat(np.arange(len(counts)), counts)
+    medians = []
+    for values in (open_days, update_days):
+        low = values.min()
+        width = values.max() - low + 1
+        ordered = np.sort(codes * width + (values - low)) - sorted_codes * width + low
+        medians.append((ordered[lower] + ordered[upper]) / 2.0)
+
+    return [{
+        "group": labels[code],
+        "open": int(counts[code]),
+        "stale": int(stale_counts[code]),
+        "median_open_days": round(float(medians[0][i]), 2),
+        "median_days_since_update": round(float(medians[1][i]), 2)
+    } for i, code in enumerate(present.tolist())]
+
+
+# Format an aging report as a markdown chat reply
+def format_report(report, limit=5):
+    if not report["open"]:
+        return "No open cases tracked yet ({} closed)".format(report["closed"])
+
+    message = "Aging for {} open cases ({} closed):\n".format(report["open"], report["closed"])
+    message = message + "* Open for: median {p50} days, p90 {p90} days, max {max} days\n".format(**report["open_days"])
+    message = message + "* Since last update: median {p50} days, p90 {p90} days, max {max} days\n".format(
+        **report["days_since_update"])
+    message = message + "* **{} cases not updated in {:g}+ days**\n".format(report["stale"], report["stale_days"])
+
+    message = message + "\nBy severity:\n"
+    for group in report["by_severity"]:
+        message = message + "* Sev {group}: {open} open, median open {median_open_days} days, " \
+                            "median since update {median_days_since_update} days, {stale} stale\n".format(**group)
+
+    owners = [g for g in report["by_owner"] if g["stale"]][:limit]
+    if owners:
+        message = message + "\nOwners with the most stale cases:\n"
+        for group in owners:
+            message = message + "* {group}: {stale} stale of {open} open\n".format(**group)
+
+    if report["stale_cases"]:
+        message = message + "\nLongest without an update:\n"
+        for case in report["stale_cases"][:limit]:
+            message = message + "* SR {case_number} (Sev {severity}, {owner}): " \
+                                "{days_since_update} days since update\n".format(**case)
+    return message
+
+
+# Cases seen by this bot instance
+store = CaseStore()
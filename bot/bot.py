@@ -41,22 +41,91 @@
 
     curl http://localhost:5000/config
 
+    The per-person and per-room message rate limits (see ratelimit.py) can be changed the same way,
+    with or without the Spark details, by requests carrying the admin token
+
+    curl -X POST http://localhost:5000/config -H "X-Admin-Token: <ADMIN_TOKEN>" -d "{\"PERSON_RATE_LIMIT\": 0.5, \"PERSON_RATE_BURST\": 10}"
+
+    By default the bot registers filtered webhooks, so that Spark only sends messages in
+    direct rooms and messages that mention the bot in group rooms.  To receive every
+    message in every room instead, set
+
+    export SPARK_WEBHOOK_MODE=firehose
+
 """
 
-from flask import Flask, request
-from ciscosparkapi import CiscoSparkAPI
+from flask import Flask, request, Response
 import os
+import re
 import sys
 import json
+import time
+import hmac
+import functools
+import logging
+import threading
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from utilities import check_cisco_user, verify_case_number, get_case_details, room_exists_for_user, create_membership, \
                         get_email, get_person_id, create_room, get_room_name, extract_message, get_case_number, \
-                        invite_user, check_email_syntax
+                        invite_user, check_email_syntax, get_spark, set_spark_token, get_message, send_message, \
+                        get_bot_emails, get_cases_details, get_rooms_for_cases, get_membership, add_case_observer
 from case import CaseDetail
+from logger import log, log_reply
+from tracing import traced, start_request, annotate, bind
+from health import HealthProber, check_sso, check_case_api, check_spark, webhook_check
+from export import export_rows, to_ndjson, to_csv
+from rma import get_rmas_details, format_status as format_rma_status
+from bugs import get_bugs_details, format_bug
+from leader import elector
+from sharding import router
+from admission import controller, classify, format_metrics, BUSY_MESSAGE
+from quota import accountant, notices, check_limits, LIMITED_MESSAGE, DIMENSIONS
+from capture import record_webhook
+import quota
+import journal
+from digest import scheduler as digest_scheduler
+import utilities
+import memory
+import aging
+import history
+import search
+import mycases
 
 # Create the Flask application that provides the bot foundation
 app = Flask(__name__)
 
+# Retrieve needed details from environment for the bot
+bot_email = os.getenv("SPARK_BOT_EMAIL")
+spark_token = os.getenv("SPARK_BOT_TOKEN")
+bot_url = os.getenv("SPARK_BOT_URL")
+bot_app_name = os.getenv("SPARK_BOT_APP_NAME")
+webhook_mode = os.getenv("SPARK_WEBHOOK_MODE", "filtered")
+bulk_concurrency = int(os.getenv("BULK_CONCURRENCY", "8"))
+invite_concurrency = int(os.getenv("INVITE_CONCURRENCY", "4"))
+
+# Token required by admin endpoints in the X-Admin-Token header; admin endpoints are disabled if unset
+admin_token = os.getenv("ADMIN_TOKEN")
+
+# Placeholders for the webhook and readiness state, set by the background reconciler
+webhooks = []
+bot_ready = False
+reconcile_generation = 0
+_webhook_lock = threading.Lock()
+
+# Dependency health, refreshed in the background and served from cache by /health
+prober = HealthProber([
+    ("sso", check_sso),
+    ("case_api", check_case_api),
+    ("spark", check_spark),
+    ("webhook", webhook_check(lambda: desired_webhooks(bot_app_name), lambda: bot_url))
+])
+
+# Every case fetched from the Case API is recorded for the aging report, the case history and search
+add_case_observer(aging.store.record)
+add_case_observer(history.store.record)
+add_case_observer(search.index.add)
+
 
 # ToDos:
     # todo accept multiple case numbers, loop through cases?
@@ -79,12 +148,16 @@ commands = {
     "/contract": "Get contract number associated with the TAC case.",
     "/customer": "Get customer contact info for the TAC case.",
     "/status": "Get status and severity for the TAC case.",
-    "/rma": "Get list of RMAs associated with TAC case.",
-    "/bug": "Get list of Bugs associated with TAC case.",
+    "/rma": "Get list of RMAs associated with TAC case, with the status, ship date and tracking of each.",
+    "/bug": "Get list of Bugs associated with TAC case, with the headline, status, severity and fixed releases of each.",
     "/device": "Get serial number and hostname for the device on which the TAC case was opened",
     "/created": "Get the date on which the TAC case was created, and calculate the open duration",
     "/updated": "Get the date on which the TAC case was last updated, and calculate the time since last update",
-    "/invite": "Invite new user to room by email (or keywords: cse=case owner)",
+    "/search": "Search the titles, descriptions, bugs and devices of cases in your rooms",
+    "/history": "Get the timeline of status, severity, owner and other changes seen for the TAC case",
+    "/aging": "Get open duration and time since last update across all tracked cases, by severity and owner",
+    "/mycases": "List the open cases you own, longest without an update first",
+    "/invite": "Invite users to room by email, separated by spaces (or keywords: cse=case owner, customer=customer contact)",
     "/link": "Get link to the case in Support Case Manager",
     "/feedback": "Sends feedback to development team; use this to submit feature requests and bugs",
     # "/echo": "Reply back with the same message sent.",
@@ -105,35 +178,103 @@ def after_request(response):
     return response
 
 
+# Whether the request carries the admin token
+def is_admin():
+    provided = request.headers.get("X-Admin-Token") or ""
+    return bool(admin_token) and hmac.compare_digest(str(provided), str(admin_token))
+
+
+# Decorator limiting an endpoint to requests that carry the admin token
+def admin_required(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_admin():
+            return "Forbidden", 403
+        return func(*args, **kwargs)
+    return wrapper
+
+
 # Entry point for Spark Webhooks
 @app.route('/', methods=["POST"])
 def process_webhook():
     # Check if the Spark connection has been made
-    if spark is None:
-        sys.stderr.write("Bot not ready.  \n")
+    if get_spark() is None:
+        log("Bot not ready.", logging.WARNING)
         return "Spark Bot not ready.  "
 
     post_data = request.get_json(force=True)
     # Uncomment to debug
-    # sys.stderr.write("Webhook content:" + "\n")
-    # sys.stderr.write(str(post_data) + "\n")
-
-    # Take the posted data and send to the processing function
-    process_incoming_message(post_data)
+    # log("Webhook content:" + "\n")
+    # log(str(post_data) + "\n")
+
+    # Take the posted data and send to the processing function, traced as one request
+    # Webhooks for rooms owned by another instance are forwarded to it
+    with start_request("webhook", request_id=request.headers.get("X-Request-Id"),
+                       room_id=post_data["data"]["roomId"], person_id=post_data["data"].get("personId")):
+        if router.route(post_data["data"]["roomId"], request.get_data(), request.headers):
+            annotate(forwarded=True)
+            return ""
+        record_webhook(post_data)
+        handle_webhook(post_data, journal.append(post_data))
     return ""
 
 
+# Process a webhook, then mark it done in the journal
+def handle_webhook(post_data, seq=None):
+    try:
+        if within_limits(post_data):
+            process_incoming_message(post_data)
+    finally:
+        journal.done(seq)
+
+
+# Process the webhooks left unprocessed in the journal when the bot last stopped, oldest first
+def replay_journal():
+    for seq, post_data in journal.store.unprocessed():
+        log("Replaying journaled webhook {}".format(seq), logging.WARNING)
+        with start_request("webhook", room_id=post_data["data"]["roomId"],
+                           person_id=post_data["data"].get("personId"), replayed=True):
+            handle_webhook(post_data, seq)
+
+
+# Check an incoming message against the person and room rate limits, before any upstream call is made for it
+# Messages from the bot itself are not limited; a limited room is told at most once per notice interval
+def within_limits(post_data):
+    data = post_data["data"]
+    if data.get("personEmail") and data["personEmail"] in get_bot_emails():
+        return True
+    limited = check_limits(data.get("personId"), data["roomId"])
+    if limited is None:
+        return True
+    annotate(limited=limited)
+    log("Dropped message over the {} rate limit".format(limited), logging.WARNING)
+    if notices.due(data["roomId"]):
+        send_message(roomId=data["roomId"], markdown=LIMITED_MESSAGE)
+    return False
+
+
 # Config Endpoint to set Spark Details
 @app.route('/config', methods=["GET", "POST"])
 def config_bot():
     if request.method == "POST":
         post_data = request.get_json(force=True)
-        # Verify that a token and email were both provided
-        if "SPARK_BOT_TOKEN" not in post_data.keys() or "SPARK_BOT_EMAIL" not in post_data.keys():
+        spark_keys = [k for k in ["SPARK_BOT_TOKEN", "SPARK_BOT_EMAIL"] if k in post_data.keys()]
+        limit_keys = [k for k in quota.limits() if k in post_data.keys()]
+        # Verify that a token and email were both provided, unless only the rate limits are being changed
+        if len(spark_keys) != 2 and (spark_keys or not limit_keys):
             return "Error: POST Requires both 'SPARK_BOT_TOKEN' and 'SPARK_BOT_EMAIL' to be provided."
 
+        # Change the rate limits; admins only, as a limit can turn the bot off
+        if limit_keys:
+            if not is_admin():
+                return "Forbidden", 403
+            error = quota.configure(post_data)
+            if error:
+                return "Error: " + error
+
         # Setup Spark
-        spark_setup(post_data["SPARK_BOT_EMAIL"], post_data["SPARK_BOT_TOKEN"])
+        if spark_keys:
+            spark_setup(post_data["SPARK_BOT_EMAIL"], post_data["SPARK_BOT_TOKEN"])
 
     # Return the config detail to API requests
     config_data = {
@@ -142,12 +283,14 @@ def config_bot():
         "SPARK_BOT_URL": bot_url,
         "SPARKBOT_APP_NAME": bot_app_name
     }
+    config_data.update(quota.limits())
     config_data["SPARK_BOT_TOKEN"] = "REDACTED"     # Used to hide the token from requests.
     return json.dumps(config_data)
 
 
 # Quick REST API to have bot send a message to a user
 @app.route("/hello/<email>", methods=["GET"])
+@traced("hello")
 def message_email(email):
     """
     Kickoff a 1 on 1 chat with a given email
@@ -155,12 +298,12 @@ def message_email(email):
     :return:
     """
     # Check if the Spark connection has been made
-    if spark is None:
-        sys.stderr.write("Bot not ready.  \n")
+    if get_spark() is None:
+        log("Bot not ready.", logging.WARNING)
         return "Spark Bot not ready.  "
 
     # send_message_to_email(email, "Hello!")
-    spark.messages.create(toPersonEmail=email, markdown="Hello!")
+    send_message(toPersonEmail=email, markdown="Hello!")
     return "Message sent to " + email
 
 
@@ -168,14 +311,32 @@ def message_email(email):
 @app.route("/health", methods=["GET"])
 def health_check():
     """
-    Notify if bot is up
+    Report cached dependency status; 503 if a critical dependency check failed
+    :return:
+    """
+    prober.start()
+    healthy, report = prober.report()
+    return json.dumps(report), 200 if healthy else 503
+
+
+# Readiness Check
+@app.route("/ready", methods=["GET"])
+def ready_check():
+    """
+    Notify if bot can answer messages; 503 until Spark is configured and reachable
     :return:
     """
-    return "Up and healthy"
+    status = {
+        "ready": bot_ready,
+        "leader": elector.is_leader,
+        "webhooks": [w.id for w in webhooks]
+    }
+    return json.dumps(status), 200 if bot_ready else 503
 
 
 # REST API for room creation
 @app.route("/create/<provided_case_number>/<email>", methods=["GET"])
+@traced("create")
 def create(provided_case_number, email):
     """
     Start new room for case number and user
@@ -183,8 +344,8 @@ def create(provided_case_number, email):
     :return:
     """
     # Check if the Spark connection has been made
-    if spark is None:
-        sys.stderr.write("Bot not ready.  \n")
+    if get_spark() is None:
+        log("Bot not ready.", logging.WARNING)
         return "Spark Bot not ready.  "
 
     # Check if provided case number is valid
@@ -193,167 +354,462 @@ def create(provided_case_number, email):
         # Get person ID for email provided
         person_id = get_person_id(email)
         if person_id:
-            #sys.stderr.write("Person ID for email ("+email+"): "+person_id+"\n")
+            #log("Person ID for email ("+email+"): "+person_id+"\n")
 
             # Check if room already exists for case and  user
             room_id = room_exists_for_user(case_number, email)
             if room_id:
                 message = "Room already exists with  "+case_number+" in the title and "+email+" already a member.\n"
-                sys.stderr.write(message)
-                sys.stderr.write("roomId: "+room_id+"\n")
+                log(message)
+                log("roomId: "+room_id+"\n")
             else:
                 # Create the new room
                 room_id = create_room(case_number)
                 message = "Created roomId: "+room_id+"\n"
-                sys.stderr.write(message)
+                log(message)
 
                 # Add user to the room
                 membership_id = create_membership(person_id, room_id)
                 membership_message = email+" added to the room.\n"
-                sys.stderr.write(membership_message)
-                sys.stderr.write("membershipId: "+membership_id+"\n")
+                log(membership_message)
+                log("membershipId: "+membership_id+"\n")
                 message = message+membership_message
 
             # Print Welcome message to room
-            spark.messages.create(roomId=room_id, markdown=send_help(False))
+            send_message(roomId=room_id, markdown=send_help(False))
             welcome_message = "Welcome message (with help command) sent to the room.\n"
-            sys.stderr.write(welcome_message)
+            log(welcome_message)
             message = message+welcome_message
         else:
             message = "No user found with the email address: "+email
-            sys.stderr.write(message)
+            log(message)
     else:
         message = provided_case_number+" is not a valid case number"
-        sys.stderr.write(message)
+        log(message)
 
     return message
 
 
+# REST API for bulk room creation
+@app.route("/create/bulk", methods=["POST"])
+def create_bulk():
+    """
+    Start rooms for a JSON list of {"case": <case number>, "email": <email>} pairs
+    Streams back one JSON result per pair (NDJSON) as rooms and memberships are created
+    :return:
+    """
+    # Check if the Spark connection has been made
+    if get_spark() is None:
+        log("Bot not ready.", logging.WARNING)
+        return "Spark Bot not ready.  "
+
+    items = request.get_json(force=True)
+    if not isinstance(items, list):
+        return "Error: POST requires a JSON list of {\"case\": <case number>, \"email\": <email>} objects", 400
+
+    return Response(provision_rooms(items), mimetype="application/x-ndjson")
+
+
 # Room counter - returns the number of rooms for which TAC bot is a member
 # Useful for tracking utilization of TAC bot
 @app.route("/rooms", methods=["GET"])
+@traced("rooms")
 def room_count():
     """
     Notify if bot is up
     :return:
     """
-    return "{}\n".format(sum(1 for x in spark.rooms.list()))
+    return "{}\n".format(sum(1 for x in get_spark().rooms.list()))
+
+
+# The webhooks the bot should have registered, as {name: filter}
+def desired_webhooks(name):
+    if webhook_mode == "firehose":
+        return {name: None}
+    # Only direct messages, and group messages that mention the bot
+    return {
+        name + " direct": "roomType=direct",
+        name + " mentions": "roomType=group&mentionedPeople=me"
+    }
+
+
+# Case-room inventory export, streamed as NDJSON (default) or CSV (?format=csv)
+@app.route("/export", methods=["GET"])
+@admin_required
+def export_rooms():
+    """
+    Stream case number, status, severity, owner and last update for every SR room the bot is in
+    :return:
+    """
+    # Check if the Spark connection has been made
+    if get_spark() is None:
+        log("Bot not ready.", logging.WARNING)
+        return "Spark Bot not ready.  "
+
+    if request.args.get("format") == "csv":
+        return Response(to_csv(export_rows()), mimetype="text/csv")
+    return Response(to_ndjson(export_rows()), mimetype="application/x-ndjson")
 
 
-# Function to Setup the WebHook for the bot
+# Case aging across all tracked cases
+@app.route("/aging", methods=["GET"])
+@admin_required
+def aging_report():
+    """
+    Report open duration and time since last update for every case the bot has looked up
+    :return:
+    """
+    limit = request.args.get("limit", "50")
+    if not limit.isdigit():
+        return "Error: limit must be a number", 400
+    return json.dumps(aging.store.report(limit=int(limit))), 200, {"Content-Type": "application/json"}
+
+
+# Admission control counts in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Report messages admitted and shed by priority class, the current backlog, and the journal when it is on
+    :return:
+    """
+    samples = controller.metrics() + (journal.store.metrics() if journal.store is not None else [])
+    return format_metrics(samples), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+# Memory use, live case objects and cache sizes; POST starts allocation tracing, DELETE stops it
+@app.route("/memory", methods=["GET", "POST", "DELETE"])
+@admin_required
+def memory_report():
+    """
+    Report process memory, live CaseDetail objects and cache sizes, with allocation sites while tracing
+    :return:
+    """
+    limit = request.args.get("limit", "10")
+    frames = request.args.get("frames", "1")
+    if not limit.isdigit() or not frames.isdigit():
+        return "Error: limit and frames must be numbers", 400
+    if request.method == "POST":
+        try:
+            memory.start_tracing(int(frames))
+        except RuntimeError as e:
+            return "Error: {}".format(e), 501
+    elif request.method == "DELETE":
+        memory.stop_tracing()
+    return json.dumps(memory.report(int(limit))), 200, {"Content-Type": "application/json"}
+
+
+# Daily case digest; POST posts it now
+@app.route("/digest", methods=["GET", "POST"])
+@admin_required
+def digest_status():
+    """
+    Report the digest schedule and the outcome of the last run; POST starts a run in the background
+    :return:
+    """
+    if request.method == "POST":
+        if digest_scheduler.running:
+            return "Error: a digest is already being posted", 409
+        runner = threading.Thread(target=digest_scheduler.run, name="digest-run")
+        runner.daemon = True
+        runner.start()
+        return json.dumps(digest_scheduler.status()), 202, {"Content-Type": "application/json"}
+    return json.dumps(digest_scheduler.status()), 200, {"Content-Type": "application/json"}
+
+
+# Webhook routing across instances
+@app.route("/shards", methods=["GET"])
+@admin_required
+def shard_status():
+    """
+    Report the instances sharing webhook processing, and how many webhooks were processed here or forwarded
+    :return:
+    """
+    return json.dumps(router.status()), 200, {"Content-Type": "application/json"}
+
+
+# Top consumers of upstream calls by person, room or command
+@app.route("/usage", methods=["GET"])
+@admin_required
+def usage_report():
+    """
+    List the people, rooms or commands that made the most Case API, Spark and other upstream calls
+    :return:
+    """
+    by = request.args.get("by", "person")
+    limit = request.args.get("limit", "10")
+    if by not in DIMENSIONS:
+        return "Error: by must be one of {}".format(", ".join(DIMENSIONS)), 400
+    if not limit.isdigit():
+        return "Error: limit must be a number", 400
+    top = accountant.top(by, int(limit), request.args.get("service"))
+
+    # Names from the caches only, so the report makes no upstream calls
+    for item in top:
+        if by == "person":
+            item["email"] = utilities.person_cache.get("id:" + item["key"])
+        elif by == "room":
+            item["title"] = utilities.room_cache.get(item["key"])
+    return json.dumps({"by": by, "limits": quota.limits(), "top": top}), 200, {"Content-Type": "application/json"}
+
+
+# Function to Setup the WebHooks for the bot
+# Reconciles the registered webhooks with desired_webhooks: stale ones are removed, missing ones created
 def setup_webhook(name, targeturl):
-    # Get a list of current webhooks
-    webhooks = spark.webhooks.list()
+    spark = get_spark()
+    desired = desired_webhooks(name)
+    result = []
 
-    # Look for a Webhook for this bot_name
-    # Need try block because if there are NO webhooks it throws an error
-    try:
-        for h in webhooks:  # Efficiently iterates through returned objects
-            if h.name == name:
-                sys.stderr.write("Found existing webhook.  Updating it.\n")
-                wh = spark.webhooks.update(webhookId=h.id, name=name, targetUrl=targeturl)
-                # Stop searching
-                break
-        # If there wasn't a Webhook found
-        if wh is None:
-            sys.stderr.write("Creating new webhook.\n")
-            wh = spark.webhooks.create(name=name, targetUrl=targeturl, resource="messages", event="created")
-    except:
-        sys.stderr.write("Creating new webhook.\n")
-        wh = spark.webhooks.create(name=name, targetUrl=targeturl, resource="messages", event="created")
-
-    return wh
-
-
-# Function to take action on incoming message
+    # Get a list of current webhooks
+    existing = list(spark.webhooks.list())
+
+    for h in existing:
+        # Only touch webhooks that belong to this bot_name
+        if h.name != name and not h.name.startswith(name + " "):
+            continue
+        if h.name in desired and getattr(h, "filter", None) == desired[h.name] and \
+                h.name not in [w.name for w in result]:
+            if h.targetUrl != targeturl:
+                log("Found existing webhook {}.  Updating it.".format(h.name))
+                h = spark.webhooks.update(webhookId=h.id, name=h.name, targetUrl=targeturl)
+            result.append(h)
+        else:
+            # Filters cannot be changed in place, so stale or duplicate webhooks are deleted
+            log("Deleting webhook {}.".format(h.name))
+            spark.webhooks.delete(h.id)
+
+    for hook_name, hook_filter in desired.items():
+        if hook_name not in [w.name for w in result]:
+            log("Creating new webhook {}.".format(hook_name))
+            kwargs = {"filter": hook_filter} if hook_filter else {}
+            result.append(spark.webhooks.create(name=hook_name, targetUrl=targeturl, resource="messages",
+                                                event="created", **kwargs))
+
+    return result
+
+
+# Create rooms and memberships for many case/email pairs, yielding one NDJSON result line per pair
+def provision_rooms(items):
+    with start_request("create_bulk", items=len(items)):
+        # Validate the pairs, grouping emails by case number; invalid pairs are answered immediately
+        pending = {}
+        for item in items:
+            item = item if isinstance(item, dict) else {}
+            case_number = verify_case_number(str(item.get("case", "")))
+            email = item.get("email")
+            if not case_number:
+                yield bulk_result(item.get("case"), email, "error", error="Not a valid case number")
+            elif not email or not check_email_syntax(email):
+                yield bulk_result(case_number, email, "error", error="Not a valid email address")
+            elif email not in pending.setdefault(case_number, []):
+                pending[case_number].append(email)
+
+        pool = ThreadPool(bulk_concurrency)
+        try:
+            # Shared lookups: each person once, all rooms in one listing, each matching room's members once
+            emails = sorted(set(e for case_emails in pending.values() for e in case_emails))
+            person_ids = dict(zip(emails, pool.map(bind(call_safely(get_person_id)), emails)))
+            case_rooms = get_rooms_for_cases(pending.keys())
+            room_ids = sorted(set(r for rooms in case_rooms.values() for r in rooms))
+            room_members = dict(zip(room_ids, pool.map(bind(call_safely(get_membership)), room_ids)))
+
+            # Case titles for new rooms, in batched Case API calls; rooms are titled "SR <case>" without them
+            cases = call_safely(get_cases_details)(pending.keys())
+            if isinstance(cases, Exception):
+                log("Case lookup for bulk create failed: {}".format(cases), logging.WARNING)
+                cases = {}
+
+            # Create rooms and memberships, one task per case, streaming results as each case finishes
+            tasks = [(case_number, case_emails, case_rooms[case_number], room_members, person_ids,
+                      cases.get(case_number)) for case_number, case_emails in pending.items()]
+            for results in pool.imap_unordered(bind(provision_case), tasks):
+                for line in results:
+                    yield line
+        finally:
+            pool.close()
+
+
+# Create the room and memberships needed for one case; all new members of a case share one new room
+def provision_case(task):
+    case_number, emails, room_ids, room_members, person_ids, case_json = task
+    results = []
+    new_room_id = None
+
+    for email in emails:
+        person_id = person_ids.get(email)
+        if isinstance(person_id, Exception) or not person_id:
+            results.append(bulk_result(case_number, email, "error",
+                                       error="No user found with the email address: " + email))
+            continue
+
+        # Check if room already exists for case and user
+        existing = [r for r in room_ids if not isinstance(room_members.get(r), Exception) and
+                    person_id in [m.personId for m in room_members.get(r) or []]]
+        if existing:
+            results.append(bulk_result(case_number, email, "exists", roomId=existing[0]))
+            continue
+
+        try:
+            if new_room_id is None:
+                case = CaseDetail(case_json or {"RESPONSE": {"COUNT": 0}})
+                new_room_id = create_room(case_number, case)
+                send_message(roomId=new_room_id, markdown=send_help(False))
+            membership_id = create_membership(person_id, new_room_id)
+            results.append(bulk_result(case_number, email, "created", roomId=new_room_id,
+                                       membershipId=membership_id))
+        except Exception as e:
+            results.append(bulk_result(case_number, email, "error", error="{}: {}".format(type(e).__name__, e)))
+
+    return results
+
+
+# Format one bulk room creation result as an NDJSON line
+def bulk_result(case_number, email, status, **fields):
+    result = {"case": case_number, "email": email, "status": status}
+    result.update(fields)
+    log("Bulk create {} for {}: {}".format(case_number, email, status))
+    return json.dumps(result) + "\n"
+
+
+# Wrap func to return any exception it raises instead, for use with ThreadPool.map
+def call_safely(func):
+    def wrapper(*args):
+        try:
+            return func(*args)
+        except Exception as e:
+            return e
+    return wrapper
+
+
+# Function to take action on incoming message; messages being processed count towards the backlog
 def process_incoming_message(post_data):
+    controller.enter()
+    try:
+        return handle_message(post_data)
+    finally:
+        controller.leave()
+
+
+# Find the command in an incoming message, admit it by priority class and send the reply
+def handle_message(post_data):
     # Determine the Spark Room to send reply to
     room_id = post_data["data"]["roomId"]
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message = spark.messages.get(message_id)
+    message = get_message(message_id)
     # Uncomment to debug
-    # sys.stderr.write("Message content:" + "\n")
-    # sys.stderr.write(str(message) + "\n")
+    # log("Message content:" + "\n")
+    # log(str(message) + "\n")
 
     # First make sure not processing a message from the bot
-    if message.personEmail in spark.people.me().emails:
+    if message.personEmail in get_bot_emails():
         # Uncomment to debug
-        # sys.stderr.write("Message from bot recieved." + "\n")
+        # log("Message from bot recieved." + "\n")
         return ""
 
     # Log details on message
-    sys.stderr.write("Message from {}: {}\n".format(message.personEmail, message.text))
+    log("Message from {}".format(message.personEmail), text=message.text)
 
     # Find the command that was sent, if any
     command = ""
+    text = message.text
     for c in commands.items():
-        if message.text.find(c[0]) != -1:
+        if text.find(c[0]) != -1:
             command = c[0]
-            sys.stderr.write("Found command: " + command + "\n")
+            log("Found command: " + command + "\n")
+            annotate(command=command)
             # If a command was found, stop looking for others
             break
 
+    # Shed the message if the bot is too busy for its priority class
+    priority = classify(command)
+    if not controller.admit(priority):
+        annotate(shed=priority)
+        log("Shed {} message".format(priority), logging.WARNING)
+        if controller.should_reply_busy(room_id):
+            send_message(roomId=room_id, markdown=BUSY_MESSAGE)
+        return ""
+    try:
+        reply = run_command(command, post_data, message)
+    finally:
+        controller.release(priority)
+
+    # send_message_to_room(room_id, reply)
+    send_message(roomId=room_id, markdown=reply)
+
+
+# Run a command and return the reply to send
+def run_command(command, post_data, message):
     reply = ""
     # Take action based on command
     # If no command found, send help
     if command in ["", "/help"]:
         reply = send_help(post_data)
-        sys.stderr.write("Sent help message")
+        log("Sent help message")
     # elif command in ["/echo"]:
         # reply = send_echo(message)
     # elif command in ["/test"]:
         # reply = send_test()
     elif command in ["/title"]:
         reply = send_title(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/owner"]:
         reply = send_owner(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/description"]:
         reply = send_description(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/contract"]:
         reply = send_contract(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/customer"]:
         reply = send_customer(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/status"]:
         reply = send_status(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/rma"]:
         reply = send_rma_numbers(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/feedback"]:
         # If feedback is blank, dont send it
         feedback = send_feedback(post_data, "feedback")
         feedback_room = os.environ.get("FEEDBACK_ROOM")
         if feedback is not None:
-            spark.messages.create(roomId=feedback_room, markdown=feedback)
+            send_message(roomId=feedback_room, markdown=feedback)
             reply = send_feedback(post_data, "reply")
         else:
             reply = "Sorry, cannot submit blank feedback"
     elif command in ["/created"]:
         reply = send_created(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/updated"]:
         reply = send_updated(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/device"]:
         reply = send_device(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
+    elif command in ["/search"]:
+        reply = send_search(post_data)
+        log_reply(message.personEmail, reply)
+    elif command in ["/history"]:
+        reply = send_history(post_data)
+        log_reply(message.personEmail, reply)
+    elif command in ["/aging"]:
+        reply = send_aging(post_data)
+        log_reply(message.personEmail, reply)
+    elif command in ["/mycases"]:
+        reply = send_mycases(post_data)
+        log_reply(message.personEmail, reply)
     elif command in ["/bug"]:
         reply = send_bug(post_data)
-        sys.stderr.write("Replied to {} with:\n{}\n".format(message.personEmail, reply))
+        log_reply(message.personEmail, reply)
     elif command in ["/link"]:
         reply = send_link(post_data)
     elif command in ["/invite"]:
         reply = send_invite(post_data)
 
-    # send_message_to_room(room_id, reply)
-    spark.messages.create(roomId=room_id, markdown=reply)
+    return reply
 
 
 #
@@ -367,7 +823,7 @@ def send_feedback(post_data, type):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/feedback", message_in.text)
 
     # Get personId of the person submitting feedback
@@ -394,7 +850,7 @@ def send_link(post_data):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/link", message_in.text)
 
     # Get personId of the person submitting feedback
@@ -432,7 +888,7 @@ def send_title(post_data):
 
 
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/title", message_in.text)
 
     # Find case number
@@ -469,7 +925,7 @@ def send_device(post_data):
 
 
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/device", message_in.text)
 
     # Find case number
@@ -515,7 +971,7 @@ def send_description(post_data):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/description", message_in.text)
 
     # Find case number
@@ -553,7 +1009,7 @@ def send_owner(post_data):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/owner", message_in.text)
 
     # Find case number
@@ -595,7 +1051,7 @@ def send_contract(post_data):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/contract", message_in.text)
 
     # Find case number
@@ -633,7 +1089,7 @@ def send_customer(post_data):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/customer", message_in.text)
 
     # Find case number
@@ -681,7 +1137,7 @@ def send_status(post_data):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/title", message_in.text)
 
     # Find case number
@@ -723,7 +1179,7 @@ def send_rma_numbers(post_data):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/rma", message_in.text)
 
     # Find case number
@@ -736,16 +1192,19 @@ def send_rma_numbers(post_data):
         # Create case object
         case = CaseDetail(get_case_details(case_number))
         if case.count > 0:
-            # Get RMAs from case
+            # Get RMAs from case, with the status of each from the RMA API
             rmas = case.rmas
             if rmas is not None:
                 if type(rmas) is list:
+                    details = get_rmas_details(rmas)
                     message = "The RMAs for SR {} are:\n".format(case_number)
                     for r in rmas:
-                        message = message + "* <a href=\"{}{}\">{}</a>\n".format(rma_url, r, r)
+                        status = format_rma_status(details[str(r)])
+                        message = message + "* <a href=\"{}{}\">{}</a>: {}\n".format(rma_url, r, r, status)
                 else:
-                    message = "The RMA for SR {} is: <a href=\"{}{}\">{}</a>".format(case_number, rma_url, rmas,
-                                                                                     rmas)
+                    status = format_rma_status(get_rmas_details([rmas])[str(rmas)])
+                    message = "The RMA for SR {} is: <a href=\"{}{}\">{}</a> ({})".format(case_number, rma_url, rmas,
+                                                                                          rmas, status)
             else:
                 message = "There are no RMAs for SR {}".format(case_number)
         else:
@@ -773,7 +1232,7 @@ def send_bug(post_data):
 
     # Get the details about the message that was sent.
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/bug", message_in.text)
 
     # Find case number
@@ -787,15 +1246,17 @@ def send_bug(post_data):
         # Create case object
         case = CaseDetail(get_case_details(case_number))
         if case.count > 0:
-            # Get Bugs from case
+            # Get Bugs from case, with the details of each from the Bug API
             bugs = case.bugs
             if bugs is not None:
                 if type(bugs) is list:
+                    details = get_bugs_details(bugs)
                     message = "The Bugs for SR {} are:\n".format(case_number)
                     for b in bugs:
-                        message = message + "* {} (<a href=\"{}{}\">external</a> | <a href=\"{}{}\">internal</a>)\n".format(b,bug_url, b, internal_bug_url, b)
+                        message = message + "* {}: {} (<a href=\"{}{}\">external</a> | <a href=\"{}{}\">internal</a>)\n".format(b, format_bug(details[b]), bug_url, b, internal_bug_url, b)
                 else:
-                    message = "The Bug for SR {} is: {} (<a href=\"{}{}\">external</a> | <a href=\"{}{}\">internal</a>)".format(case_number, bugs, bug_url, bugs, internal_bug_url, bugs)
+                    details = get_bugs_details([bugs])
+                    message = "The Bug for SR {} is: {}: {} (<a href=\"{}{}\">external</a> | <a href=\"{}{}\">internal</a>)".format(case_number, bugs, format_bug(details[bugs]), bug_url, bugs, internal_bug_url, bugs)
             else:
                 message = "There are no Bugs for SR {}".format(case_number)
         else:
@@ -823,7 +1284,7 @@ def send_created(post_data):
 
 
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/created", message_in.text)
 
     # Find case number
@@ -871,7 +1332,7 @@ def send_updated(post_data):
     room_id = post_data["data"]["roomId"]
 
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
+    message_in = get_message(message_id)
     content = extract_message("/updated", message_in.text)
 
     # Find case number
@@ -907,42 +1368,171 @@ def send_updated(post_data):
     return message
 
 
-# Invite user by email or keyword
+# Returns the changes seen for the case, from the local history with no Case API call
+def send_history(post_data):
+    """
+    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
+    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
+    """
+    # Check if user is cisco.com
+    person_id = post_data["data"]["personId"]
+    email = get_email(person_id)
+    if not check_cisco_user(email):
+        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
+
+    # Determine the Spark Room to send reply to
+    room_id = post_data["data"]["roomId"]
+
+    message_id = post_data["data"]["id"]
+    message_in = get_message(message_id)
+    content = extract_message("/history", message_in.text)
+
+    # Find case number
+    case_number = get_case_number(content, room_id)
+
+    if case_number:
+        message = history.format_timeline(case_number, history.store.timeline(case_number))
+    else:
+        message = "Invalid case number"
+
+    return message
+
+
+# Returns the cases in the requester's rooms matching the search terms, from the local search index
+def send_search(post_data):
+    """
+    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
+    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
+    """
+    # Check if user is cisco.com
+    person_id = post_data["data"]["personId"]
+    email = get_email(person_id)
+    if not check_cisco_user(email):
+        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
+
+    # Determine the Spark Room to send reply to
+    room_id = post_data["data"]["roomId"]
+
+    message_id = post_data["data"]["id"]
+    message_in = get_message(message_id)
+    query = extract_message("/search", message_in.text).strip()
+    if not query:
+        return "Please provide search terms, for example: /search bgp flap"
+
+    return search.format_results(query, search.search_for_person(query, person_id, room_id))
+
+
+# Returns aging of all cases the bot has looked up, by severity and owner, with stale cases listed
+def send_aging(post_data):
+    """
+    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
+    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
+    """
+    # Check if user is cisco.com
+    person_id = post_data["data"]["personId"]
+    email = get_email(person_id)
+    if not check_cisco_user(email):
+        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
+
+    return aging.format_report(aging.store.report())
+
+
+# Returns the open cases owned by the requester, from the Case API's list of cases by user
+def send_mycases(post_data):
+    """
+    Due to the potentially sensitive nature of TAC case data, it is necessary (for the time being) to limit CASE API
+    access to Cisco employees and contractors, until such time as a more appropriate authentication method can be added
+    """
+    # Check if user is cisco.com
+    person_id = post_data["data"]["personId"]
+    user_id = mycases.user_id_for(get_email(person_id))
+    if not user_id:
+        return "Sorry, CASE API access is limited to Cisco Employees for the time being"
+
+    cases, complete = mycases.get_user_cases(user_id)
+    return mycases.format_cases(user_id, cases, complete)
+
+
+# Invite users by email or keyword; several can be given, separated by spaces or commas
 def send_invite(post_data):
     # Determine the Spark Room to send reply to
     room_id = post_data["data"]["roomId"]
 
     message_id = post_data["data"]["id"]
-    message_in = spark.messages.get(message_id)
-    content = extract_message("/invite ", message_in.text)
+    message_in = get_message(message_id)
+    content = extract_message("/invite", message_in.text)
+
+    added, existing, failed = [], [], []
+    invites = []    # (label, email) pairs to add to the room
+
+    tokens = [t for t in re.split("[\\s,;]+", content) if t]
+    if not tokens:
+        return "Error, not a valid email address"
 
-    # Check for keywords
-    if content == "cse" or content == "CSE":
+    # Resolve keywords from the case details
+    keywords = [t for t in tokens if t.lower() in ["cse", "customer"]]
+    if keywords:
+        person_id = post_data["data"]["personId"]
         case_number = get_case_number(content, room_id)
-        case = CaseDetail(get_case_details(case_number))
-        if case.count > 0:
-            owner_email = case.owner_email
-            owner_first = case.owner_first
-            owner_last = case.owner_last
-            new_membership = invite_user(room_id, owner_email)
-            if new_membership:
-                message = "Case owner {} {} has been added to the room".format(owner_first, owner_last)
-            else:
-                message = "Unable to add Case owner to the room at this time"
+        if not check_cisco_user(get_email(person_id)):
+            failed.extend("{} (CASE API access is limited to Cisco Employees)".format(k) for k in keywords)
+        elif not case_number:
+            failed.extend("{} (no case number found)".format(k) for k in keywords)
         else:
-            message = "Unable to add Case owner to the room at this time"
-    else:
-        email = check_email_syntax(content)
-        if email:
-            new_membership = invite_user(room_id, content)
-            if new_membership:
-                message = "User {} has been added to the room".format(content)
-            else:
-                message = "Unable to add user {} to the room".format(content)
+            case = CaseDetail(get_case_details(case_number))
+            for keyword in keywords:
+                if case.count == 0:
+                    failed.append("{} (no case data found matching {})".format(keyword, case_number))
+                elif keyword.lower() == "cse":
+                    invites.append(("Case owner {} {}".format(case.owner_first, case.owner_last), case.owner_email))
+                else:
+                    customer_email = case.customer_email
+                    if isinstance(customer_email, list):
+                        customer_email = customer_email[0]
+                    if customer_email:
+                        invites.append(("Customer {} {}".format(case.customer_first, case.customer_last),
+                                        customer_email))
+                    else:
+                        failed.append("customer (no customer email on the case)")
+
+    for token in tokens:
+        if token.lower() in ["cse", "customer"] or verify_case_number(token) == token:
+            continue
+        if check_email_syntax(token):
+            invites.append((token, token))
         else:
-            message = "Error, not a valid email address"
+            failed.append("{} (not a valid email address)".format(token))
+
+    # Skip anyone already in the room, then add the rest concurrently
+    members = set(m.personEmail.lower() for m in get_membership(room_id))
+    to_add = []
+    for label, email in invites:
+        if email.lower() in members:
+            existing.append(label)
+        elif email.lower() not in [e.lower() for l, e in to_add]:
+            to_add.append((label, email))
+
+    if to_add:
+        pool = ThreadPool(min(len(to_add), invite_concurrency))
+        try:
+            results = pool.map(bind(call_safely(lambda email: invite_user(room_id, email))),
+                               [email for label, email in to_add])
+        finally:
+            pool.close()
+        for (label, email), result in zip(to_add, results):
+            if isinstance(result, Exception) or not result:
+                failed.append("{} (unable to add to the room at this time)".format(label))
+            else:
+                added.append(label)
 
-    return message
+    lines = []
+    if added:
+        lines.append("Added to the room: {}".format(", ".join(added)))
+    if existing:
+        lines.append("Already in the room: {}".format(", ".join(existing)))
+    if failed:
+        lines.append("Could not add: {}".format(", ".join(failed)))
+    return "<br>".join(lines)
 
 
 # Sample command function that just echos back the sent message
@@ -978,42 +1568,81 @@ def spark_setup(email, token):
     # Update the global variables for config details
     globals()["spark_token"] = token
     globals()["bot_email"] = email
-
-    sys.stderr.write("Spark Bot Email: " + bot_email + "\n")
-    sys.stderr.write("Spark Token: REDACTED\n")
-
-    # Setup the Spark Connection
-    globals()["spark"] = CiscoSparkAPI(access_token=globals()["spark_token"])
-    globals()["webhook"] = setup_webhook(globals()["bot_app_name"], globals()["bot_url"])
-    sys.stderr.write("Configuring Webhook. \n")
-    sys.stderr.write("Webhook ID: " + globals()["webhook"].id + "\n")
+    globals()["bot_ready"] = False
+    globals()["reconcile_generation"] += 1
+
+    log("Spark Bot Email: " + bot_email + "\n")
+    log("Spark Token: REDACTED\n")
+
+    # The Spark client is created lazily on first use; the webhook is reconciled in the background
+    set_spark_token(token)
+    elector.start()
+    start_reconciler()
+
+    digest_scheduler.start()
+
+    # Webhooks cut off by the last shutdown are processed again
+    if journal.store is not None:
+        journal.store.start()
+        replayer = threading.Thread(target=replay_journal, name="journal-replay")
+        replayer.daemon = True
+        replayer.start()
+
+
+# Reconcile the webhook in the background
+def start_reconciler():
+    reconciler = threading.Thread(target=reconcile_webhook, name="webhook-reconciler",
+                                  args=(bot_app_name, bot_url, reconcile_generation))
+    reconciler.daemon = True
+    reconciler.start()
+
+
+# Verify the Spark connection and, on the leader instance only, set up the WebHook, retrying with
+# backoff until it succeeds
+def reconcile_webhook(name, targeturl, generation):
+    delay = 1
+    # Stop if spark_setup has been called again with new details
+    while generation == reconcile_generation:
+        try:
+            get_bot_emails()
+            globals()["bot_ready"] = True
+            if not elector.is_leader:
+                log("Webhooks are configured by the leader instance")
+                return
+            log("Configuring Webhook. \n")
+            with _webhook_lock:
+                globals()["webhooks"] = setup_webhook(name, targeturl)
+            log("Webhook IDs: " + ", ".join(w.id for w in webhooks))
+            return
+        except Exception as e:
+            log("Webhook setup failed, retrying in {}s: {}".format(delay, e), logging.WARNING)
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+
+# An instance that takes over leadership reconciles the webhook; until the bot is ready, the running
+# reconciler does it
+elector.on_elected(lambda: bot_ready and start_reconciler())
 
 
 if __name__ == '__main__':
     # Entry point for bot
-    # Retrieve needed details from environment for the bot
-    bot_email = os.getenv("SPARK_BOT_EMAIL")
-    spark_token = os.getenv("SPARK_BOT_TOKEN")
-    bot_url = os.getenv("SPARK_BOT_URL")
-    bot_app_name = os.getenv("SPARK_BOT_APP_NAME")
-
     # bot_url and bot_app_name must come in from Environment Variables
     if bot_url is None or bot_app_name is None:
             sys.exit("Missing required argument.  Must set 'SPARK_BOT_URL' and 'SPARK_BOT_APP_NAME' in ENV.")
 
     # Write the details out to the console
-    sys.stderr.write("Spark Bot URL (for webhook): " + bot_url + "\n")
-    sys.stderr.write("Spark Bot App Name: " + bot_app_name + "\n")
-
-    # Placeholder variables for spark connection objects
-    spark = None
-    webhook = None
+    log("Spark Bot URL (for webhook): " + bot_url + "\n")
+    log("Spark Bot App Name: " + bot_app_name + "\n")
 
     # Check if the token and email were set in ENV
     if spark_token is None or bot_email is None:
-        sys.stderr.write("Spark Config is missing, please provide via API.  Bot not ready.\n")
+        log("Spark Config is missing, please provide via API.  Bot not ready.", logging.WARNING)
     else:
         spark_setup(bot_email, spark_token)
-        spark = CiscoSparkAPI(access_token=spark_token)
+    prober.start()
+    router.start()
 
-    app.run(debug=True, host='0.0.0.0', port=int("5000"))
+    # The reloader would import and set up the bot a second time; webhooks are handled on their own
+    # threads, so admission control (see admission.py) has concurrent messages to admit or shed
+    app.run(debug=True, use_reloader=False, threaded=True, host='0.0.0.0', port=int("5000"))
@@ -0,0 +1,128 @@
+#! /usr/bin/python
+
+"""
+bugs.py file contains the Bug API functions for bot.py
+
+Bug details are requested with up to BUG_API_BATCH_SIZE bug IDs per call (the Bug API allows
+5), with the batches for one case sent concurrently and sharing one SSO access token.  Bug
+metadata rarely changes, so each bug is cached for BUG_CACHE_TTL seconds.
+
+    # Bug API location, and seconds to keep bug details
+    export BUG_API_URL=https://api.cisco.com/bug/v2.0/bugs/bug_ids
+    export BUG_CACHE_TTL=86400
+"""
+
+import os
+import requests
+from multiprocessing.pool import ThreadPool
+from tracing import span, bind
+from logger import log
+from cache import get_cache
+import utilities
+
+bug_api_url = os.environ.get("BUG_API_URL", "https://api.cisco.com/bug/v2.0/bugs/bug_ids")
+batch_size = int(os.environ.get("BUG_API_BATCH_SIZE", "5"))
+concurrency = int(os.environ.get("BUG_CONCURRENCY", "4"))
+
+# Bug API bug records by bug ID
+cache = get_cache("bug", float(os.environ.get("BUG_CACHE_TTL", "86400")))
+
+STATUSES = {"O": "Open", "F": "Fixed", "T": "Terminated"}
+
+
+# Bug API wrapper class
+class BugDetail(object):
+    def __init__(self, json):
+        self._json = json
+        super(BugDetail, self).__init__()
+
+    @property
+    def bug_id(self):
+        return self._json['bug_id']
+
+    @property
+    def headline(self):
+        return self._json['headline']
+
+    @property
+    def status(self):
+        status = self._json.get('status')
+        return STATUSES.get(status, status)
+
+    @property
+    def severity(self):
+        return self._json.get('severity')
+
+    @property
+    def fixed_releases(self):
+        releases = self._json.get('known_fixed_releases') or ""
+        return [r.strip() for r in releases.replace(",", " ").split() if r.strip()]
+
+
+# Get bug details for up to batch_size bug IDs from the Bug API, as a dict of bug ID to bug
+def get_bug_batch(bug_ids, access_token=None):
+    access_token = access_token or utilities.get_access_token()
+
+    url = bug_api_url + "/" + ",".join(bug_ids)
+    headers = {
+        'authorization': "Bearer " + access_token,
+        'cache-control': "no-cache"
+    }
+    with span("bug_api.get_bugs", bugs=len(bug_ids)):
+        response = requests.request("GET", url, headers=headers, timeout=10)
+    response.raise_for_status()
+    return dict((b['bug_id'], b) for b in response.json().get('bugs', []))
+
+
+# Get bug details for many bugs; returns a dict of bug ID to BugDetail, or to None if the bug was not found
+# or its lookup failed.  Uncached bugs are requested in batches of batch_size, concurrently.
+def get_bugs_details(bug_ids):
+    details = {}
+    missing = []
+    for bug_id in bug_ids:
+        cached = cache.get(bug_id)
+        details[bug_id] = BugDetail(cached) if cached is not None else None
+        if cached is None and bug_id not in missing:
+            missing.append(bug_id)
+    if not missing:
+        return details
+
+    try:
+        access_token = utilities.get_access_token()
+    except Exception as e:
+        log("Bug lookups skipped, no access token: {}".format(e))
+        return details
+
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    pool = ThreadPool(min(len(batches), concurrency))
+    try:
+        results = pool.map(bind(lambda batch: _lookup_batch(batch, access_token)), batches)
+    finally:
+        pool.close()
+    for found in results:
+        details.update(found)
+    return details
+
+
+# Look up one batch of bugs and cache them; a failed batch is logged and left out
+def _lookup_batch(bug_ids, access_token):
+    try:
+        found = get_bug_batch(bug_ids, access_token)
+    except Exception as e:
+        log("Bug lookup for {} failed: {}".format(",".join(bug_ids), e))
+        return {}
+    details = {}
+    for bug_id, json in found.items():
+        details[bug_id] = BugDetail(json)
+        cache.set(bug_id, json)
+    return details
+
+
+# Describe a bug's headline, status, severity and fixed releases for a chat reply
+def format_bug(detail):
+    if detail is None:
+        return "details unavailable"
+    message = "{} ({}, Sev {})".format(detail.headline, detail.status, detail.severity)
+    if detail.fixed_releases:
+        message = message + ", fixed in {}".format(", ".join(detail.fixed_releases))
+    return message
@@ -0,0 +1,271 @@
+#! /usr/bin/python
+
+"""
+cache.py file contains the cache backends used for upstream lookups
+
+By default every bot instance caches in process.  When several instances run, set CACHE_URL
+to a Redis (or Redis protocol compatible) server, so that SSO tokens, case details, person
+lookups, RMA and bug details fetched by one instance are reused by the others.  Cached values
+must be JSON serializable, and expire after the cache's TTL with either backend.  If the shared
+cache cannot be reached, lookups go upstream as if nothing was cached.
+
+    # Shared cache; leave unset to cache in process
+    export CACHE_URL=redis://:password@cache.example.com:6379/0
+
+    # Prefix for the bot's keys in the shared cache
+    export CACHE_PREFIX=tacbot
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from collections import OrderedDict
+from logger import log
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+cache_url = os.environ.get("CACHE_URL")
+key_prefix = os.environ.get("CACHE_PREFIX", "tacbot")
+
+_client = None
+_client_lock = threading.Lock()
+
+
+# Return a cache for one kind of value: shared if CACHE_URL is set, in process otherwise
+def get_cache(name, ttl, max_size=10000):
+    if cache_url:
+        return RedisCache(get_client(), "{}:{}:".format(key_prefix, name), ttl)
+    return TTLCache(ttl, max_size)
+
+
+# Return the shared Redis client, creating it on first use
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = RedisClient(cache_url)
+    return _client
+
+
+# Dictionary cache whose entries expire ttl seconds after they are set
+# When max_size entries are held, expired entries are dropped first, then the oldest ones
+class TTLCache(object):
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()     # key -> (expires, value), oldest first
+        self._lock = threading.Lock()
+        super(TTLCache, self).__init__()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Return the cached value, or None if it is missing or expired
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_size:
+                for k in [k for k, (expires, v) in self._entries.items() if expires <= now]:
+                    del self._entries[k]
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+            self._entries[key] = (now + (self.ttl if ttl is None else ttl), value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Unexpired entries as [key, expires, value] lists, for saving to a file
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return [[k, expires, v] for k, (expires, v) in self._entries.items() if expires > now]
+
+    # Add entries from snapshot(), keeping their expiry times
+    def restore(self, entries):
+        now = time.time()
+        for key, expires, value in entries:
+            if expires > now:
+                self.set(key, value, ttl=expires - now)
+
+
+# Cache kept in a Redis server under a key prefix; values are stored as JSON
+class RedisCache(object):
+    def __init__(self, client, prefix, ttl):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        super(RedisCache, self).__init__()
+
+    # Return the cached value, or None if it is missing, expired or the server cannot be reached
+    def get(self, key):
+        try:
+            value = self.client.command("GET", self.prefix + key)
+        except (RedisError, socket.error) as e:
+            log("Cache get failed: {}".format(e), logging.WARNING)
+            return None
+        return json.loads(value.decode("utf-8")) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        try:
+            self.client.command("SET", self.prefix + key, json.dumps(value), "PX", int(ttl * 1000))
+        except (RedisError, socket.error) as e:
+            log("Cache set failed: {}".format(e), logging.WARNING)
+
+    def delete(self, key):
+        try:
+            self.client.command("DEL", self.prefix + key)
+        except (RedisError, socket.error) as e:
+            log("Cache delete failed: {}".format(e), logging.WARNING)
+
+    # Delete every key under this cache's prefix
+    def clear(self):
+        cursor = b"0"
+        try:
+            while True:
+                cursor, keys = self.client.command("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 500)
+                if keys:
+                    self.client.command("DEL", *keys)
+                if cursor == b"0":
+                    break
+        except (RedisError, socket.error) as e:
+            log("Cache clear failed: {}".format(e), logging.WARNING)
+
+
+# Error reply from the Redis server
+class RedisError(Exception):
+    pass
+
+
+# Minimal Redis protocol (RESP) client with a small pool of connections
+# After failing to connect, commands fail at once for retry_after seconds instead of waiting on the server
+class RedisClient(object):
+    def __init__(self, url, timeout=1.0, pool_size=8, retry_after=5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip("/") or 0)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._down_until = 0
+        self._pool = queue.LifoQueue(pool_size)
+        super(RedisClient, self).__init__()
+
+    # Send one command and return its reply; the connection is dropped if anything goes wrong
+    def command(self, *args):
+        connection = self._connection()
+        try:
+            connection[0].sendall(encode_command(args))
+            reply = read_reply(connection[1])
+        except RedisError:
+            self._release(connection)
+            raise
+        except Exception:
+            self._close(connection)
+            raise
+        self._release(connection)
+        return reply
+
+    def _connection(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        if time.time() < self._down_until:
+            raise socket.error("Cache server unavailable")
+        try:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+        except socket.error:
+            self._down_until = time.time() + self.retry_after
+            raise
+        connection = (sock, sock.makefile("rb"))
+        try:
+            if self.password:
+                sock.sendall(encode_command(["AUTH", self.password]))
+                read_reply(connection[1])
+            if self.db:
+                sock.sendall(encode_command(["SELECT", self.db]))
+                read_reply(connection[1])
+        except Exception:
+            self._close(connection)
+            raise
+        return connection
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection[1].close()
+            connection[0].close()
+        except socket.error:
+            pass
+
+
+# Encode a command as a RESP array of bulk strings
+def encode_command(args):
+    parts = [("*{}\r\n".format(len(args))).encode("utf-8")]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(("${}\r\n".format(len(arg))).encode("utf-8") + arg + b"\r\n")
+    return b"".join(parts)
+
+
+# Read one RESP reply from a file object; bulk strings are returned as bytes
+def read_reply(f):
+    line = f.readline()
+    if not line.endswith(b"\r\n"):
+        raise socket.error("Connection closed by cache server")
+    kind, data = line[:1], line[1:-2]
+    if kind == b"+":
+        return data.decode("utf-8")
+    if kind == b"-":
+        raise RedisError(data.decode("utf-8"))
+    if kind == b":":
+        return int(data)
+    if kind == b"$":
+        length = int(data)
+        if length < 0:
+            return None
+        value = f.read(length + 2)
+        return value[:-2]
+    if kind == b"*":
+        length = int(data)
+        if length < 0:
+            return None
+        return [read_reply(f) for _ in range(length)]
+    raise RedisError("Unexpected reply from cache server: {!r}".format(line))
@@ -0,0 +1,240 @@
+#! /usr/bin/python
+
+"""
+capture.py file contains the optional recorder of webhook traffic, for replay with benchmarks/replay.py
+
+While CAPTURE_FILE is set, each webhook received on / is written to it as one JSON line, with the
+upstream calls it caused: the service (spark, sso, case_api, rma_api or bug_api), method, path,
+status, response body, and start and duration relative to the webhook.  CAPTURE_SAMPLE is the
+fraction of webhooks recorded.
+
+Records are sanitized before they are written.  Request headers and bodies, which carry the SSO
+client secret and API tokens, are never recorded.  The local part of every email address is
+replaced by a hash, the same one wherever the address appears, so the bot still sees the same
+people in a replay.  Values of keys containing any of CAPTURE_REDACT_KEYS (tokens, secrets and
+people's names by default) are replaced by "REDACTED".  In Case, RMA and Bug API responses, the
+values of keys containing any of CAPTURE_REDACT_CASE_KEYS (case titles, problem descriptions, notes
+and bug headlines by default) are redacted too, so no free-text case content is written; responses
+of those services that are not JSON are left out.  The replay only needs the case fields the bot
+acts on, such as status, owner, RMAs and bugs.  Spark messages and room titles (the text, markdown,
+html and title keys) are cut down to the commands, case numbers, masked addresses and /invite
+keywords in them, which is what the bot reads from them in a replay; the bot's replies, what
+people type and /feedback text are not written.
+
+    export CAPTURE_FILE=/var/tmp/tacbot-capture.ndjson
+    export CAPTURE_SAMPLE=1.0
+    export CAPTURE_REDACT_KEYS=token,secret,password,name,phone,avatar
+    export CAPTURE_REDACT_CASE_KEYS=title,desc,note,headline,summary,comment
+"""
+
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+import requests
+import tracing
+from logger import log
+
+try:
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from urlparse import urlparse, parse_qsl
+
+capture_file = os.environ.get("CAPTURE_FILE")
+sample_rate = float(os.environ.get("CAPTURE_SAMPLE", "1.0"))
+redact_keys = [k.strip().lower() for k in
+               os.environ.get("CAPTURE_REDACT_KEYS", "token,secret,password,name,phone,avatar").split(",") if k.strip()]
+case_redact_keys = [k.strip().lower() for k in os.environ.get(
+    "CAPTURE_REDACT_CASE_KEYS", "title,desc,note,headline,summary,comment").split(",") if k.strip()]
+
+# Services whose responses carry case content
+CASE_SERVICES = ["case_api", "rma_api", "bug_api"]
+
+EMAIL = re.compile(r"([A-Za-z0-9._%+-]+)@([A-Za-z0-9.-]+\.[A-Za-z]{2,})")
+
+# Spark keys holding message text or room titles, and the parts of them kept
+SPARK_TEXT_KEYS = ["text", "markdown", "html", "title"]
+KEPT_WORDS = re.compile(r"(?<![\w/<])/[a-z]+|\b6[0-9]{8}\b|[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}|"
+                        r"\b(?:cse|customer)\b", re.IGNORECASE)
+
+
+# Replace the local part of email addresses in text with a hash of the address
+def mask_emails(text):
+    return EMAIL.sub(lambda m: "u{}@{}".format(hashlib.sha1(m.group(0).lower().encode("utf-8")).hexdigest()[:12],
+                                               m.group(2)), text)
+
+
+# Copy of a JSON value with email addresses masked and the values of sensitive keys redacted
+def sanitize(value, keys=None):
+    keys = redact_keys if keys is None else keys
+    if isinstance(value, dict):
+        return dict((k, "REDACTED" if value[k] is not None and any(r in k.lower() for r in keys)
+                     else sanitize(value[k], keys)) for k in value)
+    if isinstance(value, list):
+        return [sanitize(v, keys) for v in value]
+    if isinstance(value, (str, type(u""))):
+        return mask_emails(value)
+    return value
+
+
+# Upstream services by base URL, read when called so the URLs can be changed before the first webhook
+def services():
+    import utilities
+    import rma
+    import bugs
+    return [
+        ("spark", utilities.spark_api_url),
+        ("sso", utilities.sso_url),
+        ("case_api", utilities.case_api_url),
+        ("rma_api", rma.rma_api_url),
+        ("bug_api", bugs.bug_api_url)
+    ]
+
+
+# Commands, case numbers, addresses and /invite keywords of a sanitized message or room title, without the rest
+def strip_text(text):
+    kept = [m.group(0) for m in KEPT_WORDS.finditer(text)]
+    return " ".join(kept) if kept else "REDACTED"
+
+
+# Copy of a Spark response with message text and room titles stripped to what the bot reads from them
+def strip_spark_text(value):
+    if isinstance(value, dict):
+        return dict((k, strip_text(v) if k in SPARK_TEXT_KEYS and isinstance(v, (str, type(u"")))
+                     else strip_spark_text(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [strip_spark_text(v) for v in value]
+    return value
+
+
+# Service and sanitized path of an upstream URL, or (None, None) for URLs of other hosts
+def split_url(url):
+    parsed = urlparse(url)
+    bare = "{}://{}{}".format(parsed.scheme, parsed.netloc, parsed.path)
+    for service, base in sorted(services(), key=lambda s: -len(s[1])):
+        base = base.rstrip("/")
+        if bare == base or bare.startswith(base + "/"):
+            return service, canonical_path(bare[len(base):], parse_qsl(parsed.query))
+    return None, None
+
+
+# Path relative to a service's base URL, with its query decoded and sorted; replays are matched on it
+def canonical_path(path, query):
+    path = mask_emails(path.strip("/"))
+    if query:
+        path += "?" + "&".join("{}={}".format(k, mask_emails(v)) for k, v in sorted(query))
+    return path
+
+
+# Records webhooks and the upstream calls made for them, written as JSON lines when the webhook finishes
+class Recorder(object):
+    def __init__(self, path, sample=sample_rate):
+        self.path = path
+        self.sample = sample
+        self.recorded = 0
+        self._pending = {}      # trace id -> record being built
+        self._lock = threading.Lock()
+        self._file = None
+        self._send = None
+        super(Recorder, self).__init__()
+
+    # Wrap outgoing requests, which the Case API, SSO and Spark clients all use, and collect finished traces
+    def install(self):
+        if self._send is not None:
+            return
+        self._send = send = requests.Session.send
+        recorder = self
+
+        def recorded_send(session, prepared, **kwargs):
+            span = tracing.current_span()
+            if span is None or span.trace_id not in recorder._pending:
+                return send(session, prepared, **kwargs)
+            start = time.time()
+            try:
+                response = send(session, prepared, **kwargs)
+            except Exception as e:
+                recorder.add_call(span.root, prepared, start, error=type(e).__name__)
+                raise
+            recorder.add_call(span.root, prepared, start, response)
+            return response
+
+        requests.Session.send = recorded_send
+        tracing.add_exporter(self)
+
+    def uninstall(self):
+        if self._send is not None:
+            requests.Session.send = self._send
+            self._send = None
+        tracing.remove_exporter(self)
+        with self._lock:
+            self._pending.clear()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # Start recording the webhook handled in the current trace, if it is sampled
+    def begin(self, post_data):
+        root = tracing.current_span()
+        if root is None or self._send is None or (self.sample < 1 and random.random() >= self.sample):
+            return
+        record = {"time": root.start, "payload": sanitize(post_data), "calls": []}
+        with self._lock:
+            self._pending[root.trace_id] = record
+
+    def add_call(self, root, prepared, start, response=None, error=None):
+        service, path = split_url(prepared.url)
+        if service is None:
+            return
+        call = {"service": service, "method": prepared.method, "path": path,
+                "start": round(start - root.start, 6), "duration": round(time.time() - start, 6)}
+        if response is not None:
+            call["status"] = response.status_code
+            case_content = service in CASE_SERVICES
+            try:
+                call["body"] = sanitize(response.json(), redact_keys + case_redact_keys if case_content else None)
+                if service == "spark":
+                    call["body"] = strip_spark_text(call["body"])
+            except ValueError:
+                call["text"] = "REDACTED" if case_content else mask_emails(response.text)
+        else:
+            call["error"] = error
+        with self._lock:
+            record = self._pending.get(root.trace_id)
+            if record is not None:
+                record["calls"].append(call)
+
+    # Write the record of a finished webhook
+    def export(self, root):
+        with self._lock:
+            record = self._pending.pop(root.trace_id, None)
+        if record is None:
+            return
+        record["duration"] = round(root.duration, 6)
+        record["error"] = root.error
+        record["calls"].sort(key=lambda c: c["start"])
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "a")
+                self._file.write(line)
+                self._file.flush()
+                self.recorded += 1
+            except (IOError, OSError) as e:
+                log("Webhook capture write failed: {}".format(e), logging.WARNING)
+
+
+# Record the webhook handled in the current trace, when capture is on
+def record_webhook(post_data):
+    if recorder is not None:
+        recorder.begin(post_data)
+
+
+# Recorder for this instance, when CAPTURE_FILE is set
+recorder = Recorder(capture_file) if capture_file else None
+if recorder is not None:
+    recorder.install()
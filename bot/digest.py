@@ -0,0 +1,294 @@
+#! /usr/bin/python
+
+"""
+digest.py file contains the scheduled case digest posted to every case room
+
+Once a day at DIGEST_TIME (UTC), the leader instance lists the rooms the bot is in, groups the
+rooms by the case number in their title, fetches every case in batched Case API calls and the new
+RMAs and bugs in batched RMA and Bug API calls, and posts a digest to each room: status and severity,
+owner, time since the last update, and the RMAs and bugs added since the previous digest.  Closed
+cases get no digest.
+
+Digests are posted at no more than DIGEST_RATE messages per second, so thousands of rooms finish
+within DIGEST_WINDOW seconds without reaching Spark's rate limits.  An instance that becomes leader,
+or restarts, inside the window posts the day's digest if no instance has yet.
+
+The date of the last digest and the RMAs and bugs already announced must outlive a restart, or a
+restart inside the window would post the day's digest again and announce every RMA and bug as new.
+They are kept in the shared cache when CACHE_URL is set (see cache.py), and otherwise in the file
+DIGEST_STATE_FILE.  The digest is off unless DIGEST_TIME and one of the two are set.
+
+    export DIGEST_TIME=08:00
+    export DIGEST_RATE=2
+    export DIGEST_WINDOW=1800
+    export DIGEST_STATE_FILE=/var/lib/tacbot/digest.json
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from case import CaseDetail
+from cache import get_cache, cache_url
+from ratelimit import TokenBucket
+from tracing import start_request
+from logger import log
+from rma import get_rmas_details, format_status as format_rma_status
+from bugs import get_bugs_details, format_bug
+from leader import elector
+import utilities
+
+digest_time = os.environ.get("DIGEST_TIME")
+digest_rate = float(os.environ.get("DIGEST_RATE", "2"))
+digest_window = float(os.environ.get("DIGEST_WINDOW", "1800"))
+state_file = os.environ.get("DIGEST_STATE_FILE")
+
+# Rooms requested per Spark page
+page_size = int(os.environ.get("EXPORT_PAGE_SIZE", "100"))
+
+# Seconds the new RMA and bug lookups of a digest run may take
+LOOKUP_BUDGET = 60
+
+# RMAs and bugs included in each case's last digest, and the date of the last run; shared between
+# instances with CACHE_URL, so a new leader neither repeats the day's digest nor old RMAs and bugs
+seen = get_cache("digest", 30 * 86400, max_size=100000)
+runs = get_cache("digest_runs", 2 * 86400)
+
+
+# Whether the digest state outlives a restart
+def persistent():
+    return bool(cache_url or state_file)
+
+
+# Without the shared cache, keep the digest state in state_file
+def save_state():
+    if cache_url or not state_file:
+        return
+    temp = state_file + ".tmp"
+    with open(temp, "w") as f:
+        json.dump({"seen": seen.snapshot(), "runs": runs.snapshot()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp, state_file)
+
+
+def load_state():
+    if cache_url or not state_file or not os.path.exists(state_file):
+        return
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+        seen.restore(state.get("seen", []))
+        runs.restore(state.get("runs", []))
+    except (IOError, OSError, ValueError) as e:
+        log("Digest state not loaded from {}: {}".format(state_file, e), logging.WARNING)
+
+
+# Case numbers of the rooms the bot is in, with the rooms of each
+def case_rooms():
+    rooms = {}
+    for room in utilities.get_spark().rooms.list(max=page_size):
+        case_number = utilities.verify_case_number(room.title or "")
+        if case_number:
+            rooms.setdefault(str(case_number), []).append(room.id)
+    return rooms
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return [str(v) for v in value] if isinstance(value, list) else [str(value)]
+
+
+# Digest message for a case, with the RMAs and bugs added since seen; None for closed cases
+def format_digest(case_number, case, new_rmas, new_bugs, rma_details, bug_details, now=None):
+    if "Closed" in (case.status or ""):
+        return None
+    message = "**Daily digest for SR {}**\n".format(case_number)
+    message += "* Status: {}, Severity {}\n".format(case.status, case.severity)
+    message += "* Owner: {} {} ({})\n".format(case.owner_first, case.owner_last, case.owner_email)
+    try:
+        now = now or datetime.utcnow().replace(microsecond=0)
+        since_update = now - datetime.strptime(case.updated, '%Y-%m-%dT%H:%M:%SZ')
+        if since_update > timedelta(3):
+            message += "* **{} since last update**\n".format(since_update)
+        else:
+            message += "* {} since last update\n".format(since_update)
+    except (TypeError, ValueError):
+        pass
+    for r in new_rmas:
+        message += "* New RMA {}: {}\n".format(r, format_rma_status(rma_details.get(r)))
+    for b in new_bugs:
+        message += "* New bug {}: {}\n".format(b, format_bug(bug_details.get(b)))
+    return message
+
+
+# Build the digest for every open case room; returns a list of (room ID, case number, message), and
+# the RMAs and bugs of each case to record in seen once its digests are sent
+def build_digests(rooms):
+    cases = utilities.get_cases_details(rooms.keys())
+
+    # Find the RMAs and bugs each case gained since its last digest, and look them all up together
+    changes = {}
+    for case_number, json in cases.items():
+        case = CaseDetail(json)
+        if not case.count:
+            continue
+        last = seen.get(case_number) or {"rmas": [], "bugs": []}
+        rmas, bugs = _as_list(case.rmas), _as_list(case.bugs)
+        changes[case_number] = (case, rmas, bugs, [r for r in rmas if r not in last["rmas"]],
+                                [b for b in bugs if b not in last["bugs"]])
+    rma_details = get_rmas_details(sorted(set(r for c in changes.values() for r in c[3])), budget=LOOKUP_BUDGET)
+    bug_details = get_bugs_details(sorted(set(b for c in changes.values() for b in c[4])))
+
+    digests = []
+    announced = {}
+    for case_number, (case, rmas, bugs, new_rmas, new_bugs) in sorted(changes.items()):
+        message = format_digest(case_number, case, new_rmas, new_bugs, rma_details, bug_details)
+        announced[case_number] = {"rmas": rmas, "bugs": bugs}
+        if message:
+            digests.extend((room_id, case_number, message) for room_id in rooms[case_number])
+    return digests, announced
+
+
+# Posts messages at a steady rate
+class PacedSender(object):
+    def __init__(self, rate=digest_rate, window=digest_window):
+        self.rate = rate
+        self.window = window
+        self.bucket = TokenBucket(rate, 1)
+        super(PacedSender, self).__init__()
+
+    # Post each (room ID, case number, message); returns the number sent, the number that failed, and
+    # the case numbers with a digest that failed
+    def deliver(self, digests):
+        if len(digests) / self.rate > self.window:
+            log("Digest for {} rooms will take {:.0f}s at {} messages/s, more than the {:.0f}s window".format(
+                len(digests), len(digests) / self.rate, self.rate, self.window), logging.WARNING)
+        sent = failed = 0
+        failed_cases = set()
+        for room_id, case_number, message in digests:
+            self.bucket.acquire()
+            with start_request("digest", room_id=room_id, case_number=case_number):
+                try:
+                    utilities.send_message(roomId=room_id, markdown=message)
+                    sent += 1
+                except Exception as e:
+                    log("Digest for SR {} not sent: {}".format(case_number, e), logging.WARNING)
+                    failed += 1
+                    failed_cases.add(case_number)
+        return sent, failed, failed_cases
+
+
+# Runs the digest once a day on the leader
+class DigestScheduler(object):
+    def __init__(self, at=digest_time, window=digest_window, sender=None, is_leader=lambda: True):
+        self.at = at
+        self.window = window
+        self.sender = sender or PacedSender(window=window)
+        self.is_leader = is_leader
+        self.last = {}              # outcome of the last run on this instance
+        self.running = False
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+        super(DigestScheduler, self).__init__()
+
+    # Scheduled only when the state survives restarts, so a restart does not post the digest twice
+    @property
+    def enabled(self):
+        return bool(self.at) and persistent()
+
+    # Start of the latest digest window begun by now, in epoch seconds
+    def window_start(self, now=None):
+        now = now or time.time()
+        hours, minutes = [int(part) for part in self.at.split(":")]
+        start = datetime.utcfromtimestamp(now).replace(hour=hours, minute=minutes, second=0, microsecond=0)
+        start = (start - datetime(1970, 1, 1)).total_seconds()
+        return start if start <= now else start - 86400
+
+    # The day whose digest is due, if this instance is the leader, inside the window and no instance has
+    # posted it yet; otherwise None
+    def due(self, now=None):
+        now = now or time.time()
+        start = self.window_start(now)
+        day = datetime.utcfromtimestamp(start).strftime("%Y-%m-%d")
+        if now < start + self.window and self.is_leader() and runs.get("last") != day:
+            return day
+        return None
+
+    # Post the digest to every case room now, as the digest of day (today by default)
+    def run(self, day=None):
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+        started = time.time()
+        try:
+            previous = runs.get("last")
+            # Marked as posted first, so a leader change part way through does not post the digest twice
+            runs.set("last", day or datetime.utcfromtimestamp(started).strftime("%Y-%m-%d"))
+            try:
+                save_state()
+                with start_request("digest.build"):
+                    rooms = case_rooms()
+                    digests, announced = build_digests(rooms)
+            except Exception:
+                # Nothing was posted, so the scheduler tries again while the window lasts
+                if previous is None:
+                    runs.delete("last")
+                else:
+                    runs.set("last", previous)
+                save_state()
+                raise
+            sent, failed, failed_cases = self.sender.deliver(digests)
+            # RMAs and bugs of a case whose digest failed in any room are announced again next time
+            for case_number, items in announced.items():
+                if case_number not in failed_cases:
+                    seen.set(case_number, items)
+            save_state()
+            self.last = {"started": started, "seconds": round(time.time() - started, 3), "cases": len(rooms),
+                         "rooms": len(digests), "sent": sent, "failed": failed}
+            log("Digest posted to {} rooms, {} failed, in {:.0f}s".format(sent, failed, time.time() - started))
+        except Exception as e:
+            self.last = {"started": started, "error": str(e)}
+            log("Digest failed: {}".format(e), logging.WARNING)
+        finally:
+            with self._lock:
+                self.running = False
+        return True
+
+    # Check once a minute whether the digest is due
+    def start(self):
+        if self.at and not persistent():
+            log("Digest not scheduled: set CACHE_URL or DIGEST_STATE_FILE, so a restart does not post it again",
+                logging.WARNING)
+        with self._lock:
+            if self._thread is not None or not self.enabled:
+                return
+            self._thread = threading.Thread(target=self._loop, name="digest-scheduler")
+            self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _loop(self):
+        while not self._stopped.wait(60):
+            try:
+                day = self.due()
+                if day:
+                    self.run(day)
+            except Exception as e:
+                log("Digest check failed: {}".format(e), logging.WARNING)
+
+    def status(self):
+        return {"enabled": self.enabled, "at": self.at, "window": self.window, "rate": self.sender.rate,
+                "running": self.running, "last": self.last}
+
+
+# Digest schedule for this instance; only the leader posts
+load_state()
+scheduler = DigestScheduler(is_leader=lambda: elector.is_leader)
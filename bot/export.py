@@ -0,0 +1,104 @@
+#! /usr/bin/python
+
+"""
+export.py file contains the streaming case-room inventory export for bot.py
+
+Rooms are read page by page from Spark, and the case details for rooms with a case number
+in their title are fetched in batched Case API calls, so only one batch is held in memory
+and the first rows are sent before the crawl finishes.
+"""
+
+import csv
+import json
+import os
+from tracing import start_request
+from case import CaseDetail
+from logger import log
+import utilities
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# Rooms requested per Spark page
+page_size = int(os.environ.get("EXPORT_PAGE_SIZE", "100"))
+
+COLUMNS = ["case_number", "status", "severity", "owner", "owner_email", "updated", "room_id", "room_title"]
+
+
+# Yield one row per case room the bot is in
+def export_rows():
+    with start_request("export"):
+        batch = []
+        for room in utilities.get_spark().rooms.list(max=page_size):
+            case_number = utilities.verify_case_number(room.title or "")
+            if not case_number:
+                continue
+            batch.append((case_number, room))
+            if len(batch) >= utilities.case_batch_size:
+                for row in _enrich(batch):
+                    yield row
+                batch = []
+        for row in _enrich(batch):
+            yield row
+
+
+# Add case details to a batch of (case number, room) pairs
+def _enrich(batch):
+    if not batch:
+        return []
+    try:
+        cases = utilities.get_cases_details(case_number for case_number, room in batch)
+    except Exception as e:
+        log("Case lookup for export failed: {}".format(e))
+        cases = {}
+
+    rows = []
+    for case_number, room in batch:
+        row = dict.fromkeys(COLUMNS)
+        row.update({"case_number": case_number, "room_id": room.id, "room_title": room.title})
+        if case_number in cases:
+            case = CaseDetail(cases[case_number])
+            row.update({
+                "status": case.status,
+                "severity": case.severity,
+                "owner": "{} {}".format(case.owner_first, case.owner_last),
+                "owner_email": case.owner_email,
+                "updated": case.updated
+            })
+        rows.append(row)
+    return rows
+
+
+#
+# Output formats
+#
+
+# Stream rows as newline-delimited JSON
+def to_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+# The csv module on Python 2 only writes byte strings, so unicode cells (room titles, owner names) are
+# encoded as UTF-8 first; on Python 3 rows are written as they are
+if str is bytes:
+    def _csv_row(row):
+        return dict((k, v.encode("utf-8") if isinstance(v, unicode) else v) for k, v in row.items())
+else:
+    def _csv_row(row):
+        return row
+
+
+# Stream rows as CSV, starting with a header line
+def to_csv(rows):
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+    writer.writerow(dict(zip(COLUMNS, COLUMNS)))
+    for row in rows:
+        writer.writerow(_csv_row(row))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue()
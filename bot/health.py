@@ -0,0 +1,129 @@
+#! /usr/bin/python
+
+"""
+health.py file contains the dependency health prober for bot.py
+
+A background thread checks SSO token validity, Case API reachability, Spark reachability
+and webhook registration every HEALTH_INTERVAL seconds.  The /health endpoint answers
+from the cached results, so a health probe never causes upstream traffic.
+
+    # Seconds between dependency checks
+    export HEALTH_INTERVAL=60
+
+    # Checks whose failure makes /health return 503
+    export HEALTH_CRITICAL=sso,case_api,spark,webhook
+"""
+
+import os
+import time
+import threading
+import requests
+from tracing import span
+from logger import log
+import utilities
+
+interval = float(os.environ.get("HEALTH_INTERVAL", "60"))
+critical = [c.strip() for c in os.environ.get("HEALTH_CRITICAL", "sso,case_api,spark,webhook").split(",") if c.strip()]
+
+
+# Raised by a check when the dependency is not configured, which is not counted as a failure
+class NotConfigured(Exception):
+    pass
+
+
+# Runs dependency checks in the background and caches their results
+class HealthProber(object):
+    def __init__(self, checks, interval=interval, critical=critical):
+        self.checks = checks
+        self.interval = interval
+        self.critical = critical
+        self.status = dict((name, {"status": "pending"}) for name, check in checks)
+        self._lock = threading.Lock()
+        self._thread = None
+        super(HealthProber, self).__init__()
+
+    # Run every check once and store the results
+    def probe(self):
+        with span("health_probe"):
+            for name, check in self.checks:
+                start = time.time()
+                try:
+                    detail = check()
+                    result = {"status": "ok"}
+                    if detail:
+                        result["detail"] = detail
+                except NotConfigured as e:
+                    result = {"status": "unconfigured", "detail": str(e)}
+                except Exception as e:
+                    result = {"status": "failed", "detail": "{}: {}".format(type(e).__name__, e)}
+                    log("Health check {} failed: {}".format(name, result["detail"]))
+                result["checked"] = int(time.time())
+                result["latency_ms"] = round((time.time() - start) * 1000, 1)
+                with self._lock:
+                    self.status[name] = result
+
+    # Start the background prober; safe to call more than once
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="health-prober")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self.probe()
+            time.sleep(self.interval)
+
+    # Return (healthy, report) from the cached results
+    def report(self):
+        with self._lock:
+            checks = dict((name, dict(result)) for name, result in self.status.items())
+        healthy = not any(r["status"] == "failed" for name, r in checks.items() if name in self.critical)
+        return healthy, {"healthy": healthy, "checks": checks}
+
+
+#
+# Dependency checks
+#
+
+# SSO credentials can still be exchanged for a Case API access token
+# A new token is requested, as the cached one would hide revoked credentials or an SSO outage
+def check_sso():
+    client_id = os.environ.get("CASE_API_CLIENT_ID")
+    client_secret = os.environ.get("CASE_API_CLIENT_SECRET")
+    if not client_id or not client_secret:
+        raise NotConfigured("CASE_API_CLIENT_ID and CASE_API_CLIENT_SECRET are not set")
+    utilities.fetch_access_token(client_id, client_secret)
+
+
+# Case API answers over HTTP; any response below 500 means it is reachable
+def check_case_api():
+    response = requests.head(utilities.case_api_url, timeout=5)
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return "HTTP {}".format(response.status_code)
+
+
+# Spark accepts the bot token
+def check_spark():
+    spark = utilities.get_spark()
+    if spark is None:
+        raise NotConfigured("Spark token has not been provided")
+    with span("spark.people.me"):
+        return spark.people.me().emails[0]
+
+
+# Build a check that each of the bot's webhooks ({name: filter}) is registered with the expected target URL
+def webhook_check(get_desired, get_target_url):
+    def check_webhook():
+        spark = utilities.get_spark()
+        if spark is None:
+            raise NotConfigured("Spark token has not been provided")
+        with span("spark.webhooks.list"):
+            registered = dict((h.name, h) for h in spark.webhooks.list() if h.targetUrl == get_target_url())
+        missing = [name for name, hook_filter in get_desired().items()
+                   if name not in registered or getattr(registered[name], "filter", None) != hook_filter]
+        if missing:
+            raise Exception("Webhooks not registered: {}".format(", ".join(sorted(missing))))
+        return ", ".join(sorted(registered[name].id for name in get_desired()))
+    return check_webhook
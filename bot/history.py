@@ -0,0 +1,163 @@
+#! /usr/bin/python
+
+"""
+history.py file contains the per-case change history for bot.py
+
+Every case the bot fetches from the Case API is compared with the last version seen, and only
+the fields that changed are kept.  Each case holds one base snapshot and a list of deltas, so the
+timeline of a case can be rebuilt locally without calling the Case API.  When a case has more than
+HISTORY_MAX_ENTRIES deltas, the oldest delta is folded into the base snapshot.
+
+    # Changes kept per case
+    export HISTORY_MAX_ENTRIES=50
+"""
+
+import os
+import time
+import threading
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+max_entries = int(os.environ.get("HISTORY_MAX_ENTRIES", "50"))
+
+# Case fields tracked for changes, with the label used in replies
+FIELDS = [
+    ("STATUS", "Status"),
+    ("SEVERITY", "Severity"),
+    ("TITLE", "Title"),
+    ("OWNER_FIRST_NAME", "Owner first name"),
+    ("OWNER_LAST_NAME", "Owner last name"),
+    ("OWNER_EMAIL_ADDRESS", "Owner email"),
+    ("CONTRACT_ID", "Contract"),
+    ("SERIAL_NUMBER", "Serial number"),
+    ("DEVICE_NAME", "Hostname"),
+    ("RMAS", "RMAs"),
+    ("BUGS", "Bugs")
+]
+
+
+# Tracked field values of a single-case Case API response, in FIELDS order
+def extract_fields(json):
+    detail = json['RESPONSE']['CASES']['CASE_DETAIL']
+    return tuple(_freeze(detail.get(key)) for key, label in FIELDS)
+
+
+# Lists (RMAs, bugs) are stored as tuples so they compare and share like any other value
+def _freeze(value):
+    if isinstance(value, dict) and "ID" in value:
+        value = value["ID"]
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+# History of one case: a base snapshot and the deltas applied to it since
+class CaseTimeline(object):
+    __slots__ = ["base_time", "base", "deltas", "current"]
+
+    def __init__(self, seen, fields):
+        self.base_time = seen
+        self.base = fields
+        self.deltas = []        # (seen, ((field index, value), ...)) with only the changed fields
+        self.current = fields
+        super(CaseTimeline, self).__init__()
+
+    # Add a new version of the case, keeping only the fields that changed
+    def update(self, seen, fields, max_entries):
+        changed = tuple((i, value) for i, value in enumerate(fields) if value != self.current[i])
+        if changed:
+            self.deltas.append((seen, changed))
+            self.current = fields
+            while len(self.deltas) > max_entries:
+                self.base_time, delta = self.deltas.pop(0)
+                self.base = _apply(self.base, delta)
+
+    # Rebuild the timeline as (seen, [(label, old, new), ...]) entries, oldest first
+    def changes(self):
+        fields = self.base
+        result = []
+        for seen, delta in self.deltas:
+            result.append((seen, [(FIELDS[i][1], fields[i], value) for i, value in delta]))
+            fields = _apply(fields, delta)
+        return result
+
+
+# Apply a delta to a snapshot
+def _apply(fields, delta):
+    fields = list(fields)
+    for i, value in delta:
+        fields[i] = value
+    return tuple(fields)
+
+
+# Change history for every case the bot has looked up
+class CaseHistory(object):
+    def __init__(self, max_entries=max_entries):
+        self.max_entries = max_entries
+        self.cases = {}
+        self._lock = threading.Lock()
+        super(CaseHistory, self).__init__()
+
+    def __len__(self):
+        return len(self.cases)
+
+    # Record a single-case Case API response; the first version of a case becomes its base snapshot
+    def record(self, case_number, json, seen=None):
+        if not json['RESPONSE'].get('COUNT'):
+            return
+        seen = int(time.time() if seen is None else seen)
+        fields = extract_fields(json)
+        with self._lock:
+            timeline = self.cases.get(str(case_number))
+            if timeline is None:
+                self.cases[str(case_number)] = CaseTimeline(seen, fields)
+            else:
+                timeline.update(seen, fields, self.max_entries)
+
+    # Return (first seen, base fields by label, changes) for a case, or None if it has not been seen
+    def timeline(self, case_number):
+        with self._lock:
+            timeline = self.cases.get(str(case_number))
+            if timeline is None:
+                return None
+            base = dict((label, timeline.base[i]) for i, (key, label) in enumerate(FIELDS))
+            return timeline.base_time, base, timeline.changes()
+
+
+# Format a case timeline as a markdown chat reply
+def format_timeline(case_number, timeline):
+    if timeline is None:
+        return "No history recorded for SR {} yet".format(case_number)
+
+    first_seen, base, changes = timeline
+    message = u"History for SR {}:\n".format(case_number)
+    message = message + u"* {}: Status {}, Severity {}, Owner {} {}\n".format(
+        _format_time(first_seen), _format_value(base["Status"]), _format_value(base["Severity"]),
+        _format_value(base["Owner first name"]), _format_value(base["Owner last name"]))
+    for seen, fields in changes:
+        described = [u"{} changed from {} to {}".format(label, _format_value(old), _format_value(new))
+                     for label, old, new in fields]
+        message = message + u"* {}: {}\n".format(_format_time(seen), u"; ".join(described))
+    if not changes:
+        message = message + "No changes seen since then"
+    return message
+
+
+def _format_time(seen):
+    return time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(seen))
+
+
+# Values are kept as text, since str() of a non-ASCII owner name raises UnicodeEncodeError on Python 2
+def _format_value(value):
+    if value is None or value == ():
+        return u"none"
+    if isinstance(value, tuple):
+        return u", ".join(unicode(v) for v in value)
+    return unicode(value)
+
+
+# Cases seen by this bot instance
+store = CaseHistory()
@@ -0,0 +1,335 @@
+#! /usr/bin/python
+
+"""
+journal.py file contains the on-disk journal of incoming webhooks, so that messages being processed
+when the bot is killed are processed again after it restarts
+
+While JOURNAL_DIR is set, each webhook is appended to the journal, and written to disk, before it is
+processed and so before Spark gets a response.  Concurrent webhooks share one fsync, made at most
+every JOURNAL_FSYNC_INTERVAL seconds.  A done record is appended once a webhook has been processed,
+and every JOURNAL_CHECKPOINT_INTERVAL seconds the sequence number up to which every webhook is done
+is saved as the checkpoint.  On start, webhooks after the checkpoint without a done record are
+processed again, unless they are older than JOURNAL_REPLAY_AGE seconds.  A message can be answered
+twice if the bot is killed after replying but before the done record reached the disk.
+
+The journal is split into segment files of about JOURNAL_SEGMENT_BYTES.  At each checkpoint, the
+oldest segments are deleted up to the first with a webhook still to be processed, and past
+JOURNAL_MAX_SEGMENTS the webhooks still pending in the oldest segments are copied to the newest,
+so disk use stays bounded.
+
+    export JOURNAL_DIR=/var/lib/tacbot/journal
+    export JOURNAL_FSYNC_INTERVAL=0.005
+    export JOURNAL_CHECKPOINT_INTERVAL=1
+    export JOURNAL_SEGMENT_BYTES=4194304
+    export JOURNAL_MAX_SEGMENTS=8
+    export JOURNAL_REPLAY_AGE=900
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import atexit
+import struct
+import logging
+import threading
+from logger import log
+
+journal_dir = os.environ.get("JOURNAL_DIR")
+fsync_interval = float(os.environ.get("JOURNAL_FSYNC_INTERVAL", "0.005"))
+checkpoint_interval = float(os.environ.get("JOURNAL_CHECKPOINT_INTERVAL", "1"))
+segment_bytes = int(os.environ.get("JOURNAL_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+max_segments = int(os.environ.get("JOURNAL_MAX_SEGMENTS", "8"))
+replay_age = float(os.environ.get("JOURNAL_REPLAY_AGE", "900"))
+
+# Record header: body length, CRC32 of the rest of the record, sequence number, kind
+HEADER = struct.Struct(">IIQB")
+EVENT = 1
+DONE = 2
+
+SEGMENT_NAME = re.compile(r"^segment-(\d+)\.log$")
+
+
+def _encode(seq, kind, body):
+    crc = zlib.crc32(struct.pack(">QB", seq, kind) + body) & 0xffffffff
+    return HEADER.pack(len(body), crc, seq, kind) + body
+
+
+# Records of a segment file as (seq, kind, body, record), and the length of its intact part
+def read_segment(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    records = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc, seq, kind = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        body = data[offset + HEADER.size:end]
+        if end > len(data) or zlib.crc32(struct.pack(">QB", seq, kind) + body) & 0xffffffff != crc:
+            break
+        records.append((seq, kind, body, data[offset:end]))
+        offset = end
+    return records, offset
+
+
+# Append-only webhook journal in segment files, with batched fsync, checkpoints and compaction
+class Journal(object):
+    def __init__(self, path, segment_bytes=segment_bytes, max_segments=max_segments,
+                 fsync_interval=fsync_interval, replay_age=replay_age):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.fsync_interval = fsync_interval
+        self.replay_age = replay_age
+        self.segments = []          # [number, file name, size], oldest first; the last one is written to
+        self.pending = {}           # seq -> [segment number, record] of webhooks not yet done
+        self.next_seq = 1
+        self.checkpoint = 0
+        self.appended = 0
+        self.fsyncs = 0
+        self._writes = 0            # records written, and records known to be on disk
+        self._synced = 0
+        self._syncing = False
+        self._last_sync = 0
+        self._file = None
+        self._lock = threading.Lock()
+        self._sync_done = threading.Condition(threading.Lock())
+        self._thread = None
+        self._stopped = threading.Event()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._unprocessed = self._load()
+        self._open_segment()
+        super(Journal, self).__init__()
+
+    # Read the segments left by the last run; returns the webhooks it did not finish, oldest first
+    def _load(self):
+        self.checkpoint = self._read_checkpoint()
+        events = {}
+        done = set()
+        for name in sorted(os.listdir(self.path)):
+            match = SEGMENT_NAME.match(name)
+            if not match:
+                continue
+            records, length = read_segment(os.path.join(self.path, name))
+            if length < os.path.getsize(os.path.join(self.path, name)):
+                log("Journal segment {} truncated after a partial write".format(name), logging.WARNING)
+                with open(os.path.join(self.path, name), "r+b") as f:
+                    f.truncate(length)
+            number = int(match.group(1))
+            self.segments.append([number, name, length])
+            for seq, kind, body, record in records:
+                self.next_seq = max(self.next_seq, seq + 1)
+                if kind == DONE:
+                    done.add(seq)
+                elif seq > self.checkpoint:
+                    events[seq] = (number, body, record)
+
+        # Once compaction has deleted every segment with records, only the checkpoint has the last seq
+        self.next_seq = max(self.next_seq, self.checkpoint + 1)
+
+        unprocessed = []
+        for seq in sorted(events):
+            if seq not in done:
+                number, body, record = events[seq]
+                self.pending[seq] = [number, record]
+                unprocessed.append((seq, json.loads(body.decode("utf-8"))))
+        return unprocessed
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.path, "checkpoint")) as f:
+                return int(json.load(f)["seq"])
+        except (IOError, OSError, ValueError, KeyError):
+            return 0
+
+    # Start a new segment; the caller holds the lock, or the journal is not shared yet
+    def _open_segment(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self.fsyncs += 1
+        number = self.segments[-1][0] + 1 if self.segments else 1
+        name = "segment-{:010d}.log".format(number)
+        self._file = open(os.path.join(self.path, name), "ab")
+        self.segments.append([number, name, 0])
+        self._synced = self._writes
+
+    # Write a record; the caller holds the lock
+    def _write(self, record):
+        if self.segments[-1][2] and self.segments[-1][2] + len(record) > self.segment_bytes:
+            self._open_segment()
+        self._file.write(record)
+        self.segments[-1][2] += len(record)
+        self._writes += 1
+
+    # Wait until the first `writes` records are on disk; one caller at a time makes the fsync for all
+    def _sync(self, writes):
+        with self._sync_done:
+            while self._synced < writes:
+                if self._syncing:
+                    self._sync_done.wait()
+                    continue
+                self._syncing = True
+                delay = self._last_sync + self.fsync_interval - time.time()
+                self._sync_done.release()
+                try:
+                    if delay > 0:
+                        time.sleep(delay)
+                    synced = self._flush()
+                finally:
+                    self._sync_done.acquire()
+                    self._syncing = False
+                    self._last_sync = time.time()
+                    self._sync_done.notify_all()
+                self._synced = max(self._synced, synced)
+
+    def _flush(self):
+        with self._lock:
+            writes = self._writes
+            f = self._file
+            f.flush()
+        try:
+            os.fsync(f.fileno())
+        except ValueError:
+            # Closed by a new segment, which synced it first
+            pass
+        with self._lock:
+            self.fsyncs += 1
+        return writes
+
+    # Append a webhook and return its sequence number once it is on disk
+    def append(self, post_data):
+        body = json.dumps({"time": time.time(), "webhook": post_data}).encode("utf-8")
+        with self._lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            record = _encode(seq, EVENT, body)
+            self._write(record)
+            self.pending[seq] = [self.segments[-1][0], record]
+            self.appended += 1
+            writes = self._writes
+        try:
+            self._sync(writes)
+        except Exception:
+            # Not on disk, so the caller processes it without the journal
+            with self._lock:
+                self.pending.pop(seq, None)
+            raise
+        return seq
+
+    # Mark a webhook processed; done records reach the disk with the next fsync
+    def done(self, seq):
+        with self._lock:
+            if self.pending.pop(seq, None) is not None:
+                self._write(_encode(seq, DONE, b""))
+
+    # Webhooks left unprocessed by the last run; those older than replay_age are marked done instead
+    def unprocessed(self):
+        items, self._unprocessed = self._unprocessed, []
+        result = []
+        for seq, event in items:
+            if time.time() - event["time"] > self.replay_age:
+                log("Skipping journaled webhook {} from {:.0f}s ago".format(seq, time.time() - event["time"]),
+                    logging.WARNING)
+                self.done(seq)
+            else:
+                result.append((seq, event["webhook"]))
+        return result
+
+    # Save the checkpoint, move pending webhooks out of the oldest segments, and delete finished segments
+    def compact(self):
+        with self._lock:
+            for segment in self.segments[:max(0, len(self.segments) - self.max_segments)]:
+                for entry in self.pending.values():
+                    if entry[0] == segment[0]:
+                        self._write(entry[1])
+                        entry[0] = self.segments[-1][0]
+            writes = self._writes
+        self._sync(writes)
+
+        with self._lock:
+            self.checkpoint = min(self.pending) - 1 if self.pending else self.next_seq - 1
+            # Only the oldest segments up to the first with a pending webhook, as later segments hold
+            # the done records of webhooks in that one
+            live = set(entry[0] for entry in self.pending.values())
+            finished = []
+            for segment in self.segments[:-1]:
+                if segment[0] in live:
+                    break
+                finished.append(segment)
+            self.segments = self.segments[len(finished):]
+            checkpoint = self.checkpoint
+
+        temp = os.path.join(self.path, "checkpoint.tmp")
+        with open(temp, "w") as f:
+            json.dump({"seq": checkpoint}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, os.path.join(self.path, "checkpoint"))
+        # Oldest first, so a done record is never kept without the webhook it marks
+        for number, name, size in finished:
+            os.remove(os.path.join(self.path, name))
+
+    # Checkpoint and compact in the background
+    def start(self, interval=checkpoint_interval):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="journal-checkpoint")
+            self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        try:
+            self.compact()
+        except (IOError, OSError) as e:
+            log("Journal checkpoint failed: {}".format(e), logging.WARNING)
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.compact()
+            except (IOError, OSError) as e:
+                log("Journal checkpoint failed: {}".format(e), logging.WARNING)
+
+    # Metrics as (name, help, type, [(labels, value)]) tuples, as in admission.py
+    def metrics(self):
+        with self._lock:
+            return [
+                ("tacbot_journal_pending", "Journaled webhooks not yet processed", "gauge", [({}, len(self.pending))]),
+                ("tacbot_journal_segments", "Journal segment files", "gauge", [({}, len(self.segments))]),
+                ("tacbot_journal_bytes", "Size of the journal segment files", "gauge",
+                 [({}, sum(s[2] for s in self.segments))]),
+                ("tacbot_journal_appended_total", "Webhooks appended to the journal", "counter",
+                 [({}, self.appended)]),
+                ("tacbot_journal_fsyncs_total", "Journal fsyncs", "counter", [({}, self.fsyncs)])
+            ]
+
+
+# Append a webhook to the journal before it is processed; returns its sequence number, or None
+# when the journal is off or cannot be written, in which case the webhook is processed without it
+def append(post_data):
+    if store is None:
+        return None
+    try:
+        return store.append(post_data)
+    except (IOError, OSError) as e:
+        log("Journal append failed: {}".format(e), logging.WARNING)
+        return None
+
+
+def done(seq):
+    if store is not None and seq is not None:
+        try:
+            store.done(seq)
+        except (IOError, OSError) as e:
+            log("Journal done record failed: {}".format(e), logging.WARNING)
+
+
+# Journal for this instance, when JOURNAL_DIR is set
+store = Journal(journal_dir) if journal_dir else None
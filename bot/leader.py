@@ -0,0 +1,191 @@
+#! /usr/bin/python
+
+"""
+leader.py file contains the lease-based leader election used when several bot instances run
+
+Only the leader reconciles the Spark webhooks and runs singleton background jobs.  The leader holds
+a lease for LEADER_LEASE_TTL seconds and renews it every third of that; if it stops renewing, the
+lease expires and another instance takes over within LEADER_LEASE_TTL plus one renewal interval.
+A leader that cannot renew steps down when its own lease runs out, before another instance can
+acquire it.
+
+The lease is kept in the shared cache when CACHE_URL is set (see cache.py), otherwise in
+LEADER_LEASE_FILE, which instances on one host can share.  With neither set the instance is
+always the leader, as a single instance should be.
+
+    # Lease length in seconds, and the file holding it when there is no shared cache
+    export LEADER_LEASE_TTL=15
+    export LEADER_LEASE_FILE=/var/run/tacbot/leader.json
+
+    # Name of this instance in the lease; defaults to host name and process ID
+    export LEADER_ID=tacbot-1
+"""
+
+import os
+import json
+import time
+import socket
+import atexit
+import logging
+import threading
+from logger import log
+import cache
+
+lease_ttl = float(os.environ.get("LEADER_LEASE_TTL", "15"))
+lease_file = os.environ.get("LEADER_LEASE_FILE")
+instance_id = os.environ.get("LEADER_ID") or "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+# Lease that is always granted, for a single instance
+class LocalLease(object):
+    def acquire(self, holder, ttl):
+        return True
+
+    def release(self, holder):
+        pass
+
+
+# Lease kept as JSON in a file, locked while it is read and written
+class FileLease(object):
+    def __init__(self, path):
+        self.path = path
+        super(FileLease, self).__init__()
+
+    # Take the lease if it is free, expired or already ours, and extend it by ttl seconds
+    def acquire(self, holder, ttl):
+        return self._update(holder, lambda lease, now: {"holder": holder, "expires": now + ttl})
+
+    def release(self, holder):
+        self._update(holder, lambda lease, now: {"holder": None, "expires": 0})
+
+    # Replace the lease with change(lease, now) if it is free, expired or held by holder
+    def _update(self, holder, change):
+        import fcntl
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = os.read(fd, 4096)
+            try:
+                lease = json.loads(raw.decode("utf-8")) if raw else {}
+            except ValueError:
+                lease = {}
+            now = time.time()
+            if lease.get("holder") not in [None, holder] and lease.get("expires", 0) > now:
+                return False
+            data = json.dumps(change(lease, now)).encode("utf-8")
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, data)
+            return True
+        finally:
+            os.close(fd)
+
+
+# Extend or delete the lease only while holder has it, in one step, so an instance whose lease
+# expired cannot take it back from the instance that took it over
+RENEW_SCRIPT = 'if redis.call("GET", KEYS[1]) == ARGV[1] then return redis.call("PEXPIRE", KEYS[1], ARGV[2]) ' \
+               'else return 0 end'
+RELEASE_SCRIPT = 'if redis.call("GET", KEYS[1]) == ARGV[1] then return redis.call("DEL", KEYS[1]) else return 0 end'
+
+
+# Lease kept in a Redis key: SET NX takes a free lease, and the holder extends it with a script
+class RedisLease(object):
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+        super(RedisLease, self).__init__()
+
+    def acquire(self, holder, ttl):
+        ms = int(ttl * 1000)
+        if self.client.command("SET", self.key, holder, "NX", "PX", ms) == "OK":
+            return True
+        return self.client.command("EVAL", RENEW_SCRIPT, 1, self.key, holder, ms) == 1
+
+    def release(self, holder):
+        self.client.command("EVAL", RELEASE_SCRIPT, 1, self.key, holder)
+
+
+# Return the lease store for this deployment
+def get_lease():
+    if cache.cache_url:
+        return RedisLease(cache.get_client(), "{}:leader".format(cache.key_prefix))
+    if lease_file:
+        return FileLease(lease_file)
+    return LocalLease()
+
+
+# Keeps trying to hold the lease in the background, and calls the registered functions on becoming leader
+class LeaderElector(object):
+    def __init__(self, lease, holder, ttl=lease_ttl):
+        self.lease = lease
+        self.holder = holder
+        self.ttl = ttl
+        self.valid_until = 0
+        self._callbacks = []
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        super(LeaderElector, self).__init__()
+
+    # True while this instance holds an unexpired lease
+    @property
+    def is_leader(self):
+        return time.time() < self.valid_until
+
+    # Register a function to call, in the election thread, each time this instance becomes leader
+    def on_elected(self, func):
+        self._callbacks.append(func)
+
+    # Try to take or renew the lease once; returns whether this instance is the leader
+    def try_acquire(self):
+        if self._stopped.is_set():
+            return False
+        was_leader = self.is_leader
+        started = time.time()
+        try:
+            acquired = self.lease.acquire(self.holder, self.ttl)
+        except Exception as e:
+            log("Leader lease renewal failed: {}".format(e), logging.WARNING)
+            acquired = False
+        if acquired:
+            # Timed from before the request, so this instance steps down before the lease can expire elsewhere
+            self.valid_until = started + self.ttl
+        if self.is_leader and not was_leader:
+            log("Elected leader as {}".format(self.holder))
+            for func in list(self._callbacks):
+                try:
+                    func()
+                except Exception as e:
+                    log("Leader callback failed: {}".format(e), logging.WARNING)
+        elif was_leader and not self.is_leader:
+            log("Lost leadership", logging.WARNING)
+        return self.is_leader
+
+    # Take part in the election; the first attempt is made before returning
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="leader-election")
+            self._thread.daemon = True
+        self.try_acquire()
+        self._thread.start()
+        atexit.register(self.stop)
+
+    # Stop renewing, and release the lease so another instance can take over at once
+    def stop(self):
+        self._stopped.set()
+        if self.is_leader:
+            self.valid_until = 0
+            try:
+                self.lease.release(self.holder)
+            except Exception as e:
+                log("Leader lease release failed: {}".format(e), logging.WARNING)
+
+    def _run(self):
+        while not self._stopped.wait(self.ttl / 3.0):
+            self.try_acquire()
+
+
+# Election for this instance
+elector = LeaderElector(get_lease(), instance_id)
@@ -0,0 +1,205 @@
+#! /usr/bin/python
+
+"""
+logger.py file contains the non-blocking structured logging pipeline for the bot
+
+Log records are put on a bounded queue by the calling thread and written out as JSON
+lines by a background thread, so worker threads never block on stderr.  Each record
+carries the request id, command, case number and room of the active trace.
+
+    # Minimum level written (DEBUG, INFO, WARNING, ERROR)
+    export LOG_LEVEL=INFO
+
+    # Fraction of requests whose DEBUG/INFO records are kept; warnings and errors are always kept
+    export LOG_SAMPLE_RATE=1.0
+
+    # Include reply bodies in the log (off by default, as replies contain case data)
+    export LOG_REPLY_BODIES=false
+"""
+
+import os
+import sys
+import json
+import random
+import zlib
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import tracing
+
+level = getattr(logging, os.environ.get("LOG_LEVEL", "INFO").upper(), logging.INFO)
+sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", "1.0"))
+log_reply_bodies = os.environ.get("LOG_REPLY_BODIES", "false").lower() == "true"
+queue_size = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+# Root span attributes copied onto every record
+CONTEXT_FIELDS = ["command", "case_number", "room_id", "person_id"]
+
+
+# Formats records as single-line JSON
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.utcfromtimestamp(record.created).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "level": record.levelname,
+            "message": record.getMessage()
+        }
+        entry.update(getattr(record, "context", {}))
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+# Puts records on a bounded queue without blocking; records are dropped when the queue is full
+class QueueHandler(logging.Handler):
+    def __init__(self, record_queue):
+        logging.Handler.__init__(self)
+        self.queue = record_queue
+        self.dropped = 0
+
+    def emit(self, record):
+        # Capture the request context in the calling thread, before the record changes threads
+        root = tracing.current_span()
+        if root is not None:
+            root = root.root
+            context = dict((k, root.attributes[k]) for k in CONTEXT_FIELDS if k in root.attributes)
+            context["request_id"] = root.trace_id
+            record.context = context
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Drains the queue on a background thread and writes records to a stream
+class QueueListener(object):
+    def __init__(self, record_queue, formatter, stream=None):
+        self.queue = record_queue
+        self.stream = stream
+        self.formatter = formatter
+        self._thread = None
+        super(QueueListener, self).__init__()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(5)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                # Default to whatever sys.stderr is at write time
+                stream = self.stream or sys.stderr
+                stream.write(self.formatter.format(record) + "\n")
+                if self.queue.empty():
+                    stream.flush()
+            except Exception:
+                pass
+
+
+# Keeps DEBUG/INFO records for a sampled fraction of requests
+class SamplingFilter(logging.Filter):
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or sample_rate >= 1.0:
+            return True
+        rid = getattr(record, "context", {}).get("request_id") or tracing.request_id()
+        if rid is None:
+            return random.random() < sample_rate
+        return (zlib.crc32(rid.encode("utf-8")) & 0xffffffff) % 10000 < sample_rate * 10000
+
+
+# Emits one summary record per finished request with timings by upstream call
+class RequestLogExporter(object):
+    def export(self, root):
+        timings = {}
+        for depth, s in root.walk():
+            if depth > 0:
+                timings[s.name] = timings.get(s.name, 0.0) + s.duration * 1000
+        context = dict((k, root.attributes[k]) for k in CONTEXT_FIELDS if k in root.attributes)
+        context["request_id"] = root.trace_id
+        fields = {
+            "event": root.name,
+            "duration_ms": round(root.duration * 1000, 1),
+            "upstream_ms": dict((k, round(v, 1)) for k, v in timings.items())
+        }
+        if root.error:
+            fields["error"] = root.error
+        _emit(logging.WARNING if root.error else logging.INFO, "Request complete", context, fields)
+
+
+# Log the full span tree of a slow request
+def _log_slow_trace(root):
+    context = dict((k, root.attributes[k]) for k in CONTEXT_FIELDS if k in root.attributes)
+    context["request_id"] = root.trace_id
+    fields = {"duration_ms": round(root.duration * 1000, 1), "spans": root.to_dict()}
+    _emit(logging.WARNING, "Slow request", context, fields)
+
+
+# Emit a record with explicit context (used after the trace has closed)
+def _emit(levelno, message, context, fields):
+    if not logger.isEnabledFor(levelno):
+        return
+    record = logger.makeRecord(logger.name, levelno, __file__, 0, message, None, None)
+    record.context = context
+    record.fields = fields
+    logger.handle(record)
+
+
+#
+# Logging functions
+#
+
+# Write a log record, tagged with the context of the active trace
+def log(message, level=logging.INFO, **fields):
+    logger.log(level, message.rstrip("\n"), extra={"fields": fields})
+
+
+# Log that a reply was sent; the reply body is only included when LOG_REPLY_BODIES is set
+def log_reply(email, reply):
+    fields = {"reply_length": len(reply or "")}
+    if log_reply_bodies:
+        fields["reply"] = reply
+    log("Replied to {}".format(email), **fields)
+
+
+# Number of records dropped because the queue was full
+def dropped():
+    return _handler.dropped
+
+
+_queue = queue.Queue(queue_size)
+_handler = QueueHandler(_queue)
+_handler.addFilter(SamplingFilter())
+_listener = QueueListener(_queue, JsonFormatter())
+_listener.start()
+atexit.register(_listener.stop)
+
+logger = logging.getLogger("tacbot")
+logger.setLevel(level)
+logger.propagate = False
+logger.addHandler(_handler)
+
+tracing.add_exporter(RequestLogExporter())
+tracing.set_slow_handler(_log_slow_trace)
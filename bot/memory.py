@@ -0,0 +1,220 @@
+#! /usr/bin/python
+
+"""
+memory.py file contains the memory report served by the admin-only /memory endpoint
+
+The report gives the process's resident memory, the number and approximate size of live
+CaseDetail, RMADetail and BugDetail objects, and the entries and approximate size of each
+in-process cache and store.  Objects shared between containers are counted once; containers
+with more than SAMPLE_SIZE entries are estimated from a sample of their entries, so the report
+stays quick on a loaded bot.
+
+While allocation tracing is on (started with POST /memory, stopped with DELETE /memory), each
+report also takes a tracemalloc snapshot and lists the top allocation sites, and the growth
+in allocations since the previous report.  Tracing slows the bot and uses memory itself, so
+it is meant to be turned on while looking for a leak, and off again after.
+"""
+
+import gc
+import sys
+import types
+import threading
+from collections import OrderedDict
+from case import CaseDetail
+from rma import RMADetail
+from bugs import BugDetail
+from cache import RedisCache
+import utilities
+import rma
+import bugs
+import search
+import aging
+import history
+import digest
+import mycases
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SAMPLE_SIZE = 10000
+
+_SCALARS = set([str, bytes, int, float, bool, type(None), type(u"")])
+_SKIPPED = set([type, types.ModuleType, types.FunctionType, types.MethodType, types.BuiltinFunctionType])
+
+# Classes whose live instances are counted
+TRACKED_CLASSES = [CaseDetail, RMADetail, BugDetail]
+
+_previous = None
+_lock = threading.Lock()
+
+
+# The in-process caches and stores reported, by name
+def caches():
+    return OrderedDict([
+        ("sso_tokens", utilities.token_cache),
+        ("case_details", utilities.case_cache),
+        ("people", utilities.person_cache),
+        ("room_titles", utilities.room_cache),
+        ("rma_details", rma.cache),
+        ("bug_details", bugs.cache),
+        ("user_cases", mycases.cache),
+        ("search_index", search.index),
+        ("search_memberships", search.memberships),
+        ("aging", aging.store),
+        ("history", history.store),
+        ("digest_seen", digest.seen)
+    ])
+
+
+# Approximate size in bytes of obj and everything it references; containers larger than
+# sample entries are estimated from sample entries spread evenly through them
+def approximate_size(obj, sample=SAMPLE_SIZE, seen=None):
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    kind = type(obj)
+    if kind in _SCALARS:
+        return sys.getsizeof(obj)
+    if kind in _SKIPPED:
+        return 0
+    if hasattr(obj, "nbytes") and hasattr(obj, "dtype"):
+        return sys.getsizeof(obj) if obj.base is None else 0
+    size = sys.getsizeof(obj, 0)
+
+    if isinstance(obj, dict):
+        items = [item for pair in _spread(obj.items(), len(obj), sample) for item in pair]
+        return size + _scaled(items, len(obj) * 2, sample, seen)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + _scaled(_spread(obj, len(obj), sample), len(obj), sample, seen)
+    if hasattr(obj, "__dict__"):
+        size += approximate_size(vars(obj), sample, seen)
+    for name in getattr(kind, "__slots__", ()):
+        if hasattr(obj, name):
+            size += approximate_size(getattr(obj, name), sample, seen)
+    return size
+
+
+def _spread(items, total, count):
+    if total <= count:
+        return list(items)
+    step = -(-total // count)
+    return [item for i, item in enumerate(items) if i % step == 0]
+
+
+# Size of the measured items, scaled up to the total number of items
+def _scaled(items, total, sample, seen):
+    measured = sum(approximate_size(item, sample, seen) for item in items)
+    return int(measured * float(total) / len(items)) if items else 0
+
+
+# Resident and peak resident memory of the process in bytes, where the platform reports them
+def process_memory():
+    result = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:") or line.startswith("VmHWM:"):
+                    key = "rss_bytes" if line.startswith("VmRSS:") else "peak_rss_bytes"
+                    result[key] = int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return result
+
+
+# Count and approximate size of live instances of the tracked classes
+def live_objects():
+    found = dict((cls.__name__, []) for cls in TRACKED_CLASSES)
+    for obj in gc.get_objects():
+        if isinstance(obj, tuple(TRACKED_CLASSES)):
+            found[type(obj).__name__].append(obj)
+    return dict((name, {"count": len(objs),
+                         "approx_bytes": _scaled(objs[:SAMPLE_SIZE], len(objs), SAMPLE_SIZE, set())})
+                for name, objs in found.items())
+
+
+# Entries and approximate size of each cache; caches kept in the shared cache are not measured
+def cache_sizes():
+    result = OrderedDict()
+    for name, cache in caches().items():
+        if isinstance(cache, RedisCache):
+            result[name] = {"shared": True}
+            continue
+        try:
+            size = approximate_size(cache)
+        except RuntimeError:
+            # Changed while it was measured
+            size = None
+        result[name] = {"entries": _entries(cache), "approx_bytes": size}
+    return result
+
+
+def _entries(cache):
+    if hasattr(cache, "__len__"):
+        return len(cache)
+    for name in ["entries", "cases"]:
+        if hasattr(cache, name):
+            return len(getattr(cache, name))
+    return None
+
+
+# Start allocation tracing, keeping frames stack frames per allocation site
+def start_tracing(frames=1):
+    global _previous
+    if tracemalloc is None:
+        raise RuntimeError("tracemalloc is not available on this Python version")
+    with _lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        _previous = _snapshot()
+
+
+def stop_tracing():
+    global _previous
+    with _lock:
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        _previous = None
+
+
+# Snapshot of traced allocations, leaving out tracemalloc's own
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+    ])
+
+
+def _site(stat):
+    frame = stat.traceback[0]
+    return "{}:{}".format(frame.filename, frame.lineno)
+
+
+# Top allocation sites now, and the sites that grew most since the previous snapshot
+def allocations(limit=10):
+    global _previous
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return {"tracing": False}
+    with _lock:
+        snapshot = _snapshot()
+        top = [{"site": _site(s), "bytes": s.size, "count": s.count}
+               for s in snapshot.statistics("lineno")[:limit]]
+        growth = []
+        if _previous is not None:
+            growth = [{"site": _site(s), "bytes": s.size_diff, "count": s.count_diff}
+                      for s in snapshot.compare_to(_previous, "lineno") if s.size_diff > 0][:limit]
+        _previous = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+    return {"tracing": True, "traced_bytes": current, "traced_peak_bytes": peak, "top": top, "growth": growth}
+
+
+# Full memory report
+def report(limit=10):
+    return {
+        "process": process_memory(),
+        "objects": live_objects(),
+        "caches": cache_sizes(),
+        "allocations": allocations(limit)
+    }
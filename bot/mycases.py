@@ -0,0 +1,115 @@
+#! /usr/bin/python
+
+"""
+mycases.py file contains the /mycases command's Case API functions for bot.py
+
+/mycases lists the open cases owned by the requester, found with the Case API's list-by-user call
+for the requester's Cisco user ID (the part of their cisco.com address before the @).  The first
+page gives the number of pages; the rest are requested concurrently, up to MYCASES_MAX_PAGES.
+Each user's list is cached for MYCASES_CACHE_TTL seconds, so repeated calls answer without the
+Case API, and the reply shows the MYCASES_LIMIT cases longest without an update.
+
+    export MYCASES_CACHE_TTL=120
+    export MYCASES_MAX_PAGES=10
+    export MYCASES_LIMIT=20
+"""
+
+import os
+import time
+import requests
+from multiprocessing.pool import ThreadPool
+from tracing import span, bind
+from cache import get_cache
+from aging import parse_timestamp, DAY
+import utilities
+
+max_pages = int(os.environ.get("MYCASES_MAX_PAGES", "10"))
+reply_limit = int(os.environ.get("MYCASES_LIMIT", "20"))
+concurrency = 4
+
+# Open case summaries by Cisco user ID
+cache = get_cache("mycases", float(os.environ.get("MYCASES_CACHE_TTL", "120")))
+
+# Summary fields kept for each case
+FIELDS = ["CASE_ID", "TITLE", "STATUS", "SEVERITY", "UPDATED_DATE"]
+
+TITLE_WIDTH = 40
+
+
+# Cisco user ID for a cisco.com address, or None for any other address
+def user_id_for(email):
+    if not email or not utilities.check_cisco_user(email):
+        return None
+    return email.split("@")[0].lower()
+
+
+# Get one page of a user's open cases from the Case API; returns (case summaries, last page index)
+def get_cases_page(user_id, page_index, access_token=None):
+    access_token = access_token or utilities.get_access_token()
+
+    url = utilities.case_api_url + "/cases/users/user_ids/" + user_id
+    params = {"status_flag": "O", "sort_by": "UPDATED_DATE", "page_index": page_index}
+    headers = {
+        'authorization': "Bearer " + access_token,
+        'cache-control': "no-cache"
+    }
+    with span("case_api.get_cases_by_user", page=page_index):
+        response = requests.request("GET", url, params=params, headers=headers, timeout=10)
+    response.raise_for_status()
+
+    json = response.json()['RESPONSE']
+    details = json.get('CASES', {}).get('CASE_DETAIL', [])
+    if isinstance(details, dict):
+        details = [details]
+    last_index = int(json.get('PAGINATION_RESPONSE_RECORD', {}).get('LAST_INDEX') or page_index)
+    return [dict((f, d.get(f)) for f in FIELDS) for d in details], last_index
+
+
+# Get all open cases owned by a user, from the cache or the Case API; returns (cases, complete), where
+# complete is False when the user has more than max_pages pages of cases
+def get_user_cases(user_id):
+    cached = cache.get(user_id)
+    if cached is not None:
+        return cached["cases"], cached["complete"]
+
+    access_token = utilities.get_access_token()
+    cases, last_index = get_cases_page(user_id, 1, access_token)
+    pages = range(2, min(last_index, max_pages) + 1)
+    if pages:
+        pool = ThreadPool(min(len(pages), concurrency))
+        try:
+            results = pool.map(bind(lambda page: get_cases_page(user_id, page, access_token)[0]), pages)
+        finally:
+            pool.close()
+        for page in results:
+            cases.extend(page)
+
+    complete = last_index <= max_pages
+    cache.set(user_id, {"cases": cases, "complete": complete})
+    return cases, complete
+
+
+# Format a user's open cases as a table, longest without an update first
+def format_cases(user_id, cases, complete=True, now=None, limit=reply_limit):
+    if not cases:
+        return "No open cases owned by {}".format(user_id)
+
+    now = now or time.time()
+    rows = [((now - parse_timestamp(case.get("UPDATED_DATE"))) / DAY, case) for case in cases]
+    # Cases without a valid update time (NaN) are listed last
+    rows.sort(key=lambda row: row[0] if row[0] == row[0] else float("-inf"), reverse=True)
+
+    message = "Open cases owned by {} ({}{}), longest without an update first:\n".format(
+        user_id, len(cases), "" if complete else "+")
+    message += "```\n{:<10} {:<3} {:<17} {:>6}  {}\n".format("SR", "Sev", "Status", "Idle", "Title")
+    for days, case in rows[:limit]:
+        idle = "{:.1f}d".format(days) if days == days else "-"
+        title = case.get("TITLE") or ""
+        if len(title) > TITLE_WIDTH:
+            title = title[:TITLE_WIDTH - 3] + "..."
+        message += "{:<10} {:<3} {:<17} {:>6}  {}\n".format(case.get("CASE_ID"), case.get("SEVERITY") or "-",
+                                                           (case.get("STATUS") or "")[:17], idle, title)
+    message += "```\n"
+    if len(rows) > limit:
+        message += "and {} more\n".format(len(rows) - limit)
+    return message
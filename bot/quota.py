@@ -0,0 +1,161 @@
+#! /usr/bin/python
+
+"""
+quota.py file contains the per-person and per-room limits on incoming messages, and the accounting
+of upstream calls made for each person, room and command
+
+Messages are checked against the person and room token buckets in ratelimit.py before any upstream
+call is made for them.  A limited message is dropped; its sender is told at most once per
+QUOTA_NOTICE_INTERVAL seconds per room.
+
+Every finished webhook trace is read for its upstream calls (Case, RMA and Bug API, SSO and Spark),
+which are added up by person, room and command for the admin /usage endpoint.  Totals are kept for
+the QUOTA_MAX_KEYS most recently seen people, rooms and commands.
+
+    export QUOTA_NOTICE_INTERVAL=60
+    export QUOTA_MAX_KEYS=10000
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from tracing import add_exporter
+from ratelimit import person_limiter, room_limiter
+
+notice_interval = float(os.environ.get("QUOTA_NOTICE_INTERVAL", "60"))
+max_keys = int(os.environ.get("QUOTA_MAX_KEYS", "10000"))
+
+DIMENSIONS = ["person", "room", "command"]
+
+# Span name prefixes of upstream calls, and the service they are counted under
+SERVICES = [
+    ("case_api.", "case_api"),
+    ("rma_api.", "rma_api"),
+    ("bug_api.", "bug_api"),
+    ("sso.", "sso"),
+    ("spark.", "spark")
+]
+
+LIMITED_MESSAGE = "You're sending requests faster than I can answer them. Please wait a minute and retry."
+
+
+# Upstream calls and messages counted by person, room and command; an exporter for tracing.py
+class UsageAccountant(object):
+    def __init__(self, max_keys=max_keys):
+        self.max_keys = max_keys
+        self.usage = dict((d, OrderedDict()) for d in DIMENSIONS)
+        self._lock = threading.Lock()
+        super(UsageAccountant, self).__init__()
+
+    # Count the upstream calls of a finished webhook trace; forwarded webhooks are counted by their owner
+    def export(self, root):
+        if root.name != "webhook" or root.attributes.get("forwarded"):
+            return
+        calls = {}
+        for depth, s in root.walk():
+            for prefix, service in SERVICES:
+                if s.name.startswith(prefix):
+                    calls[service] = calls.get(service, 0) + 1
+                    break
+        limited = bool(root.attributes.get("limited"))
+        command = root.attributes.get("command") or ("(limited)" if limited else "(none)")
+        self.add(root.attributes.get("person_id"), root.attributes.get("room_id"), command, calls, limited)
+
+    # Add one message, and the upstream calls made for it by service, to the totals of its person, room and command
+    def add(self, person_id, room_id, command, calls, limited=False):
+        with self._lock:
+            for dimension, key in zip(DIMENSIONS, [person_id, room_id, command]):
+                if key is None:
+                    continue
+                totals = self.usage[dimension].pop(key, None)
+                if totals is None:
+                    totals = {"messages": 0, "limited": 0, "calls": 0, "by_service": {}}
+                    if len(self.usage[dimension]) >= self.max_keys:
+                        self.usage[dimension].popitem(last=False)
+                self.usage[dimension][key] = totals
+                totals["messages"] += 1
+                totals["limited"] += 1 if limited else 0
+                for service, count in calls.items():
+                    totals["calls"] += count
+                    totals["by_service"][service] = totals["by_service"].get(service, 0) + count
+
+    # The keys of a dimension with the most upstream calls, to one service or to all of them
+    def top(self, dimension, limit=10, service=None):
+        with self._lock:
+            items = [(key, dict(totals, by_service=dict(totals["by_service"])))
+                     for key, totals in self.usage[dimension].items()]
+        if service:
+            weight = lambda totals: totals["by_service"].get(service, 0)
+        else:
+            weight = lambda totals: totals["calls"]
+        items.sort(key=lambda item: (-weight(item[1]), -item[1]["messages"]))
+        return [dict(totals, key=key) for key, totals in items[:limit]]
+
+
+# Tracks when people were last told they are limited, per room
+class Notices(object):
+    def __init__(self, interval=notice_interval, max_keys=max_keys):
+        self.interval = interval
+        self.max_keys = max_keys
+        self.sent = OrderedDict()
+        self._lock = threading.Lock()
+        super(Notices, self).__init__()
+
+    # Whether to send a notice for key now; at most one per interval
+    def due(self, key):
+        now = time.time()
+        with self._lock:
+            last = self.sent.pop(key, 0)
+            if now - last < self.interval:
+                self.sent[key] = last
+                return False
+            self.sent[key] = now
+            if len(self.sent) > self.max_keys:
+                self.sent.popitem(last=False)
+            return True
+
+
+# Check the person and room limits for a message; returns the name of the limit hit, or None
+# A token is only taken from the room bucket when the person is within their limit
+def check_limits(person_id, room_id):
+    if person_id and not person_limiter.try_acquire(person_id):
+        return "person"
+    if room_id and not room_limiter.try_acquire(room_id):
+        return "room"
+    return None
+
+
+# Current limits, as set from the environment or /config
+def limits():
+    return {
+        "PERSON_RATE_LIMIT": person_limiter.rate,
+        "PERSON_RATE_BURST": person_limiter.burst,
+        "ROOM_RATE_LIMIT": room_limiter.rate,
+        "ROOM_RATE_BURST": room_limiter.burst
+    }
+
+
+# Change the limits from a /config request; returns an error message, or None
+def configure(settings):
+    values = {}
+    for name, current in limits().items():
+        value = settings.get(name, current)
+        try:
+            values[name] = float(value)
+        except (TypeError, ValueError):
+            return "{} must be a number".format(name)
+        if values[name] < 0:
+            return "{} must not be negative".format(name)
+    for kind in ["PERSON", "ROOM"]:
+        if values[kind + "_RATE_LIMIT"] > 0 and values[kind + "_RATE_BURST"] < 1:
+            return "{}_RATE_BURST must be at least 1 while {}_RATE_LIMIT is above 0".format(kind, kind)
+    person_limiter.configure(values["PERSON_RATE_LIMIT"], values["PERSON_RATE_BURST"])
+    room_limiter.configure(values["ROOM_RATE_LIMIT"], values["ROOM_RATE_BURST"])
+    return None
+
+
+# Accounting and limit notices for this instance
+accountant = UsageAccountant()
+notices = Notices()
+add_exporter(accountant)
@@ -0,0 +1,107 @@
+#! /usr/bin/python
+
+"""
+ratelimit.py file contains the token bucket rate limiters used by the bot
+
+    # Outbound Spark room and membership creation calls per second, and burst size
+    export SPARK_RATE_LIMIT=5
+    export SPARK_RATE_BURST=10
+
+    # Messages per second, and burst size, handled for each person and for each room; 0 for no limit
+    # These can also be changed with a POST to /config
+    export PERSON_RATE_LIMIT=0.2
+    export PERSON_RATE_BURST=5
+    export ROOM_RATE_LIMIT=0.5
+    export ROOM_RATE_BURST=10
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+# Token bucket: tokens refill at `rate` per second, up to `burst` tokens
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+        super(TokenBucket, self).__init__()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take a token if one is available; never blocks
+    def try_acquire(self):
+        with self._lock:
+            self._refill(time.time())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    # Take a token, waiting up to timeout seconds (forever if None) for one to become available
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+# Token buckets kept per key (a person or a room), for the max_keys most recently seen keys
+# A rate of 0 turns the limit off
+class KeyedLimiter(object):
+    def __init__(self, rate, burst=None, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+        super(KeyedLimiter, self).__init__()
+
+    # Change the rate and burst; buckets start again full
+    # A limit with a burst below 1 would never give out a token, so it is refused
+    def configure(self, rate, burst=None):
+        rate = float(rate)
+        burst = float(burst if burst is not None else max(1, rate))
+        if rate > 0 and burst < 1:
+            raise ValueError("burst must be at least 1 when the rate is above 0")
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self._buckets.clear()
+
+    # Take a token for key if one is available; never blocks
+    def try_acquire(self, key):
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+            self._buckets[key] = bucket
+        return bucket.try_acquire()
+
+
+# Shared limit for outbound Spark room and membership creation calls
+spark_limiter = TokenBucket(float(os.environ.get("SPARK_RATE_LIMIT", "5")),
+                            float(os.environ.get("SPARK_RATE_BURST", "10")))
+
+# Limits on incoming messages, per person and per room
+person_limiter = KeyedLimiter(float(os.environ.get("PERSON_RATE_LIMIT", "0.2")),
+                              float(os.environ.get("PERSON_RATE_BURST", "5")))
+room_limiter = KeyedLimiter(float(os.environ.get("ROOM_RATE_LIMIT", "0.5")),
+                            float(os.environ.get("ROOM_RATE_BURST", "10")))
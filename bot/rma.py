@@ -0,0 +1,175 @@
+#! /usr/bin/python
+
+"""
+rma.py file contains the RMA (Service Order Return) API functions for bot.py
+
+The RMAs on a case are looked up concurrently, sharing one SSO access token, and each
+RMA's details are cached for RMA_CACHE_TTL seconds.  A failed lookup (an unknown RMA number
+or an API error) is remembered for RMA_MISS_TTL seconds, so cases listing a bad RMA number
+do not call the API for it on every reply.  Lookups still running when the RMA_LOOKUP_BUDGET
+runs out are left out of the reply, and fill the cache when they finish.
+
+    # RMA API location, and seconds to keep RMA details and failed lookups
+    export RMA_API_URL=https://api.cisco.com/return/v1.0/returns/rma_numbers
+    export RMA_CACHE_TTL=300
+    export RMA_MISS_TTL=30
+
+    # Seconds a reply waits for RMA lookups, and lookups run at once
+    export RMA_LOOKUP_BUDGET=2.0
+    export RMA_CONCURRENCY=8
+"""
+
+import os
+import time
+import threading
+import requests
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from tracing import traced, bind
+from logger import log
+from cache import get_cache
+import utilities
+
+rma_api_url = os.environ.get("RMA_API_URL", "https://api.cisco.com/return/v1.0/returns/rma_numbers")
+lookup_budget = float(os.environ.get("RMA_LOOKUP_BUDGET", "2.0"))
+concurrency = int(os.environ.get("RMA_CONCURRENCY", "8"))
+
+# RMA API responses by RMA number
+cache = get_cache("rma", float(os.environ.get("RMA_CACHE_TTL", "300")))
+
+# RMA numbers whose last lookup failed
+misses = get_cache("rma_miss", float(os.environ.get("RMA_MISS_TTL", "30")))
+
+# Lookups run on a shared pool, so lookups left behind by a reply do not pile up
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# RMA API wrapper class
+class RMADetail(object):
+    def __init__(self, json):
+        self._json = json
+        super(RMADetail, self).__init__()
+
+    @property
+    def _record(self):
+        records = self._json['returns']['RmaRecord']
+        return records[0] if isinstance(records, list) else records
+
+    @property
+    def _line(self):
+        try:
+            lines = self._record['lines']['lineDetail']
+            return lines[0] if isinstance(lines, list) else lines
+        except:
+            return {}
+
+    # Shipping details are given per RMA, or on the first line of the RMA
+    def _shipping(self, field):
+        return self._record.get(field) or self._line.get(field)
+
+    @property
+    def number(self):
+        return self._record['rmaNo']
+
+    @property
+    def status(self):
+        return self._record['status']
+
+    @property
+    def ship_date(self):
+        return self._shipping('shipDate')
+
+    @property
+    def carrier(self):
+        return self._shipping('carrier')
+
+    @property
+    def tracking(self):
+        return self._shipping('trackingNumber')
+
+
+# Get RMA details from the RMA API
+@traced("rma_api.get_rma_details")
+def get_rma_details(rma_number, access_token=None):
+    access_token = access_token or utilities.get_access_token()
+
+    url = rma_api_url + "/" + str(rma_number)
+    headers = {
+        'authorization': "Bearer " + access_token,
+        'cache-control': "no-cache"
+    }
+    response = requests.request("GET", url, headers=headers, timeout=10)
+
+    if (response.status_code == 200):
+        return response.json()
+    else:
+        response.raise_for_status()
+
+
+# Get RMA details for many RMAs concurrently; returns a dict of RMA number to RMADetail,
+# or to None when the lookup failed recently or did not finish within the budget
+def get_rmas_details(rma_numbers, budget=None):
+    deadline = time.time() + (lookup_budget if budget is None else budget)
+    details = {}
+    pending = []
+    for rma_number in rma_numbers:
+        cached = cache.get(str(rma_number))
+        details[str(rma_number)] = RMADetail(cached) if cached is not None else None
+        if cached is None and misses.get(str(rma_number)) is None:
+            pending.append(str(rma_number))
+    if not pending:
+        return details
+
+    try:
+        access_token = utilities.get_access_token()
+    except Exception as e:
+        log("RMA lookups skipped, no access token: {}".format(e))
+        return details
+
+    lookup = bind(lambda rma_number: _lookup(rma_number, access_token))
+    results = [(rma_number, _get_pool().apply_async(lookup, (rma_number,))) for rma_number in pending]
+    for rma_number, result in results:
+        try:
+            details[rma_number] = result.get(max(0, deadline - time.time()))
+        except TimeoutError:
+            log("RMA lookup for {} did not finish within the budget".format(rma_number))
+        except Exception as e:
+            log("RMA lookup for {} failed: {}".format(rma_number, e))
+    return details
+
+
+# Look up one RMA and cache it, or remember that the lookup failed
+def _lookup(rma_number, access_token):
+    try:
+        json = get_rma_details(rma_number, access_token)
+    except Exception:
+        misses.set(rma_number, True)
+        raise
+    cache.set(rma_number, json)
+    return RMADetail(json)
+
+
+# Describe an RMA's status and shipping for a chat reply
+def format_status(detail):
+    if detail is None:
+        return "status unavailable"
+    try:
+        message = "status {}".format(detail.status)
+        if detail.ship_date:
+            message = message + ", shipped {}".format(detail.ship_date)
+            if detail.carrier:
+                message = message + " via {}".format(detail.carrier)
+        if detail.tracking:
+            message = message + ", tracking {}".format(detail.tracking)
+        return message
+    except (KeyError, IndexError, TypeError):
+        return "status unavailable"
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(concurrency)
+    return _pool
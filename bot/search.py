@@ -0,0 +1,285 @@
+#! /usr/bin/python
+
+"""
+search.py file contains the local full-text case search for bot.py
+
+Every case the bot fetches from the Case API is added to an in-memory inverted index over the
+title, problem description, bug IDs, serial number and hostname.  /search answers from the index,
+and only returns cases with a room the requester is a member of.  The case number of each room is
+taken from the room title; the room list is refreshed every SEARCH_ROOM_REFRESH seconds.
+
+    # Results returned per search
+    export SEARCH_LIMIT=10
+
+    # Seconds between refreshes of the case rooms list, and of cached room membership checks
+    export SEARCH_ROOM_REFRESH=300
+"""
+
+import os
+import re
+import math
+import time
+import threading
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from tracing import span, bind
+from logger import log
+import utilities
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+search_limit = int(os.environ.get("SEARCH_LIMIT", "10"))
+room_refresh = float(os.environ.get("SEARCH_ROOM_REFRESH", "300"))
+
+# Case fields indexed, with the weight of a term found in that field
+FIELDS = [
+    ("TITLE", 3),
+    ("PROBLEM_DESC", 1),
+    ("BUGS", 5),
+    ("SERIAL_NUMBER", 5),
+    ("DEVICE_NAME", 5)
+]
+
+STOP_WORDS = set(["a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "of",
+                  "on", "or", "the", "to", "with"])
+
+_token_pattern = re.compile("[a-z0-9]+")
+
+
+# Split text into lower-case index terms
+def tokenize(text):
+    return [t for t in _token_pattern.findall(text.lower()) if t not in STOP_WORDS]
+
+
+# Text of an indexed field; lists (bug IDs) are joined.  Values are kept as text, since str() of
+# a non-ASCII title raises UnicodeEncodeError on Python 2
+def _field_text(detail, key):
+    value = detail.get(key)
+    if isinstance(value, dict):
+        value = value.get("ID")
+    if isinstance(value, list):
+        value = u" ".join(unicode(v) for v in value)
+    return unicode(value) if value else u""
+
+
+# Inverted index of case text, with the case rooms known to the bot
+# Cases are numbered as they are first indexed; a query scores all cases at once with NumPy arrays
+class SearchIndex(object):
+    def __init__(self, capacity=1024):
+        self.postings = {}      # term -> {case id: weight}
+        self.documents = {}     # case number -> (case id, terms, title, status)
+        self.case_numbers = []  # case number by case id
+        self.rooms = {}         # case number -> {room id: room title}
+        self.rooms_updated = 0
+        self.closed = np.zeros(capacity, dtype=bool)
+        self.has_room = np.zeros(capacity, dtype=bool)
+        self._arrays = {}       # term -> (case ids, weights), built from the postings on first query
+        self._lock = threading.Lock()
+        super(SearchIndex, self).__init__()
+
+    def __len__(self):
+        return len(self.documents)
+
+    # Index a single-case Case API response, replacing any earlier version of the case
+    def add(self, case_number, json):
+        if not json['RESPONSE'].get('COUNT'):
+            return
+        detail = json['RESPONSE']['CASES']['CASE_DETAIL']
+        case_number = str(case_number)
+        weights = {}
+        for key, weight in FIELDS:
+            for term in tokenize(_field_text(detail, key)):
+                weights[term] = weights.get(term, 0) + weight
+
+        with self._lock:
+            previous = self.documents.get(case_number)
+            if previous is None:
+                case_id = len(self.case_numbers)
+                self.case_numbers.append(case_number)
+                if case_id == len(self.closed):
+                    self.closed = np.concatenate([self.closed, np.zeros(case_id, dtype=bool)])
+                    self.has_room = np.concatenate([self.has_room, np.zeros(case_id, dtype=bool)])
+                self.has_room[case_id] = case_number in self.rooms
+            else:
+                case_id = previous[0]
+                for term in previous[1]:
+                    if term not in weights:
+                        postings = self.postings[term]
+                        del postings[case_id]
+                        if not postings:
+                            del self.postings[term]
+                        self._arrays.pop(term, None)
+            for term, weight in weights.items():
+                self.postings.setdefault(term, {})[case_id] = weight
+                self._arrays.pop(term, None)
+            self.documents[case_number] = (case_id, tuple(weights), detail.get("TITLE"), detail.get("STATUS"))
+            self.closed[case_id] = "Closed" in (detail.get("STATUS") or "")
+
+    # Replace the case rooms with (room id, room title) pairs; rooms without a case number are skipped
+    def set_rooms(self, rooms):
+        by_case = {}
+        for room_id, title in rooms:
+            case_number = utilities.verify_case_number(title or "")
+            if case_number:
+                by_case.setdefault(case_number, {})[room_id] = title
+        with self._lock:
+            self.rooms = by_case
+            self.rooms_updated = time.time()
+            self.has_room[:] = False
+            for case_number in by_case:
+                if case_number in self.documents:
+                    self.has_room[self.documents[case_number][0]] = True
+
+    # Case ids and weights of a term's postings
+    def _term_arrays(self, term):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            postings = self.postings[term]
+            arrays = (np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                      np.fromiter(postings.values(), dtype=np.float64, count=len(postings)))
+            self._arrays[term] = arrays
+        return arrays
+
+    # Return matching cases, best first: cases must contain every term, and open cases rank above closed ones
+    # With in_rooms, only cases that have a room are returned
+    def search(self, query, limit=None, in_rooms=False):
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            if not all(t in self.postings for t in terms):
+                return []
+
+            # Score every case by term weight and inverse document frequency, counting the terms it contains
+            count = len(self.case_numbers)
+            scores = np.zeros(count)
+            hits = np.zeros(count, dtype=np.int32)
+            for term in terms:
+                case_ids, weights = self._term_arrays(term)
+                scores[case_ids] += weights * math.log(1 + float(count) / len(case_ids))
+                hits[case_ids] += 1
+
+            matches = hits == len(terms)
+            if in_rooms:
+                matches &= self.has_room[:count]
+            found = np.flatnonzero(matches)
+
+            # Open cases first, then closed ones, best score first within each
+            if len(found):
+                rank = scores[found] + np.where(self.closed[found], 0, scores[found].max() + 1)
+                found = found[np.argsort(-rank, kind="mergesort")[:limit]]
+
+            results = []
+            for case_id in found.tolist():
+                case_number = self.case_numbers[case_id]
+                document = self.documents[case_number]
+                results.append({
+                    "case_number": case_number,
+                    "score": round(float(scores[case_id]), 3),
+                    "title": document[2],
+                    "status": document[3],
+                    "rooms": dict(self.rooms.get(case_number, {}))
+                })
+            return results
+
+
+# Caches whether a person is a member of a room, for room_refresh seconds
+class MembershipCache(object):
+    def __init__(self, ttl=room_refresh):
+        self.ttl = ttl
+        self.entries = {}
+        self._lock = threading.Lock()
+        super(MembershipCache, self).__init__()
+
+    def get(self, room_id, person_id):
+        with self._lock:
+            entry = self.entries.get((room_id, person_id))
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def set(self, room_id, person_id, member):
+        with self._lock:
+            self.entries[(room_id, person_id)] = (time.time(), member)
+
+
+# List the bot's rooms and map them to case numbers
+def refresh_rooms():
+    with span("spark.rooms.list"):
+        rooms = [(room.id, room.title) for room in utilities.get_spark().rooms.list()]
+    index.set_rooms(rooms)
+
+
+# Check whether a person is a member of a room
+def is_member(room_id, person_id):
+    member = memberships.get(room_id, person_id)
+    if member is None:
+        with span("spark.memberships.list"):
+            member = any(True for m in utilities.get_spark().memberships.list(roomId=room_id, personId=person_id))
+        memberships.set(room_id, person_id, member)
+    return member
+
+
+# Search cases, keeping only cases with a room the person is a member of; each result lists those rooms
+def search_for_person(query, person_id, current_room_id=None, limit=search_limit):
+    if time.time() - index.rooms_updated > room_refresh:
+        try:
+            refresh_rooms()
+        except Exception as e:
+            log("Room list refresh for search failed: {}".format(e))
+
+    results = []
+    # Memberships are checked for at most five pages of the best matching cases
+    candidates = index.search(query, limit=limit * 5, in_rooms=True)
+    if not candidates:
+        return results
+
+    pool = ThreadPool(4)
+    try:
+        # Check memberships in ranked order, a page at a time, until enough results are found
+        for start in range(0, len(candidates), limit):
+            page = candidates[start:start + limit]
+            checks = [(room_id, person_id) for result in page for room_id in result["rooms"]
+                      if room_id != current_room_id]
+            member = dict(zip(checks, pool.map(bind(lambda check: _is_member_safely(*check)), checks)))
+            for result in page:
+                result["rooms"] = dict((room_id, title) for room_id, title in result["rooms"].items()
+                                       if room_id == current_room_id or member[(room_id, person_id)])
+                if result["rooms"]:
+                    results.append(result)
+            if len(results) >= limit:
+                break
+    finally:
+        pool.close()
+    return results[:limit]
+
+
+# Membership check for the thread pool; a failed check counts as not a member
+def _is_member_safely(room_id, person_id):
+    try:
+        return is_member(room_id, person_id)
+    except Exception as e:
+        log("Membership check for search failed: {}".format(e))
+        return False
+
+
+# Format search results as a markdown chat reply
+def format_results(query, results):
+    if not results:
+        return u"No cases in your rooms match \"{}\"".format(query)
+
+    message = u"Cases in your rooms matching \"{}\":\n".format(query)
+    for result in results:
+        rooms = u", ".join(sorted(title for title in result["rooms"].values()))
+        message = message + u"* SR {} ({}): {} - in {}\n".format(result["case_number"], result["status"],
+                                                                result["title"], rooms)
+    return message
+
+
+# Cases seen by this bot instance
+index = SearchIndex()
+memberships = MembershipCache()
@@ -0,0 +1,237 @@
+#! /usr/bin/python
+
+"""
+sharding.py file contains the room-affinity webhook router used when several bot instances run
+
+Webhooks are routed by room: a consistent hash of data.roomId picks the instance that owns the
+room, so a room's traffic always reaches the same instance and that instance's per-room caches
+(room titles, case numbers, memberships) stay warm.  The instance receiving a webhook processes
+it when it owns the room, and otherwise forwards it to the owner.  When an instance joins or
+leaves, only the rooms it owns move.
+
+Instances are listed in SHARD_PEERS.  With a shared cache (CACHE_URL, see cache.py) each
+instance also registers itself there, and the ring is rebuilt from the registered instances by a
+background thread every SHARD_REFRESH seconds, so instances that start or stop are added to or
+dropped from every instance's ring without a configuration change.  A peer that cannot be
+reached is left out of the ring until the next refresh, and its webhooks are processed locally.
+
+A forwarded webhook carries an HMAC-SHA256 signature of its body made with SHARD_SECRET, which
+all instances share; a webhook claiming to be forwarded without a valid signature is routed like
+any other, so callers cannot make an instance process rooms it does not own.  The forwarding
+instance waits at most SHARD_FORWARD_TIMEOUT seconds for the owner to answer; after that the
+owner is left to finish the webhook.  Sharding is off unless SHARD_SELF_URL and SHARD_SECRET are
+set.
+
+    # Address other instances use to reach this one, the other instances, and the shared secret
+    export SHARD_SELF_URL=http://10.0.0.5:5000
+    export SHARD_PEERS=http://10.0.0.5:5000,http://10.0.0.6:5000
+    export SHARD_SECRET=change-me
+
+    # Seconds between peer list refreshes, and to wait for a forwarded webhook
+    export SHARD_REFRESH=10
+    export SHARD_FORWARD_TIMEOUT=2
+"""
+
+import os
+import time
+import bisect
+import hashlib
+import hmac
+import logging
+import threading
+import requests
+from tracing import span
+from logger import log
+import cache
+
+self_url = os.environ.get("SHARD_SELF_URL")
+static_peers = [p.strip() for p in os.environ.get("SHARD_PEERS", "").split(",") if p.strip()]
+refresh_interval = float(os.environ.get("SHARD_REFRESH", "10"))
+forward_timeout = float(os.environ.get("SHARD_FORWARD_TIMEOUT", "2"))
+shard_secret = os.environ.get("SHARD_SECRET")
+
+# Header marking a webhook forwarded by another instance, and the header with its signature; a
+# forwarded webhook with a valid signature is always processed where it arrives
+FORWARDED_HEADER = "X-Shard-Forwarded"
+SIGNATURE_HEADER = "X-Shard-Signature"
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+# Consistent hash ring; each node is placed at replicas points so rooms spread evenly
+class HashRing(object):
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash("{}#{}".format(node, i)), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [h for h, node in points]
+        self._nodes = [node for h, node in points]
+        super(HashRing, self).__init__()
+
+    # The node owning key: the first node point at or after the key's hash
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+
+# Routes webhooks to the instance owning their room
+class ShardRouter(object):
+    def __init__(self, self_url, peers=(), registry=None, refresh=refresh_interval, secret=shard_secret):
+        self.self_url = self_url
+        self.peers = list(peers)
+        self.registry = registry
+        self.refresh = refresh
+        self.secret = secret
+        self.down = {}           # peer -> time it was found unreachable
+        self.registered = set()  # peers found in the registry at the last refresh
+        self.counts = {"local": 0, "forwarded": 0, "received": 0, "failed": 0}
+        self.ring = HashRing([self_url] + self.peers if self_url else [])
+        self._lock = threading.Lock()
+        self._thread = None
+        super(ShardRouter, self).__init__()
+
+    @property
+    def enabled(self):
+        return bool(self.self_url and self.secret)
+
+    # Refresh the ring in the background, so webhooks never wait for the registry
+    def start(self):
+        if not self.enabled:
+            if self.self_url:
+                log("Sharding is off: SHARD_SELF_URL is set without SHARD_SECRET", logging.WARNING)
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="shard-refresh")
+            self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self.refresh_peers()
+            time.sleep(self.refresh)
+
+    # Register this instance, then rebuild the ring with the peers found in the registry
+    def refresh_peers(self):
+        if self.registry is not None:
+            try:
+                self.registry.register(self.self_url, self.refresh * 3)
+                registered = set(self.registry.peers())
+                with self._lock:
+                    self.registered = registered
+            except Exception as e:
+                log("Shard peer registry refresh failed: {}".format(e), logging.WARNING)
+        self.rebuild()
+
+    # Rebuild the ring from the configured and last registered peers, leaving out peers recently found down
+    def rebuild(self):
+        now = time.time()
+        with self._lock:
+            self.down = dict((p, t) for p, t in self.down.items() if now - t < self.refresh)
+            peers = [p for p in set(self.peers) | self.registered if p not in self.down] + [self.self_url]
+            if sorted(set(peers)) != self.ring.nodes:
+                log("Shard ring members: {}".format(", ".join(sorted(set(peers)))))
+                self.ring = HashRing(peers, self.ring.replicas)
+
+    # The instance owning a room
+    def owner(self, room_id):
+        return self.ring.owner(room_id)
+
+    # Signature of a forwarded webhook body
+    def sign(self, body):
+        return hmac.new(self.secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+    # Whether a webhook was forwarded by another instance: it has the header and a valid signature
+    def is_forwarded(self, body, headers):
+        if not headers.get(FORWARDED_HEADER):
+            return False
+        signature = headers.get(SIGNATURE_HEADER)
+        if signature and hmac.compare_digest(str(signature), str(self.sign(body))):
+            return True
+        log("Ignored {} header without a valid signature".format(FORWARDED_HEADER), logging.WARNING)
+        return False
+
+    # Forward a webhook to the instance owning its room; returns False if it should be processed here
+    def route(self, room_id, body, headers):
+        if not self.enabled:
+            self._count("local")
+            return False
+        if self._thread is None:
+            self.start()
+        if self.is_forwarded(body, headers):
+            self._count("received")
+            return False
+        owner = self.owner(room_id)
+        if owner == self.self_url:
+            self._count("local")
+            return False
+
+        forward_headers = {"Content-Type": "application/json", FORWARDED_HEADER: self.self_url,
+                           SIGNATURE_HEADER: self.sign(body)}
+        if headers.get("X-Request-Id"):
+            forward_headers["X-Request-Id"] = headers.get("X-Request-Id")
+        try:
+            with span("shard.forward", owner=owner):
+                response = requests.post(owner.rstrip("/") + "/", data=body, headers=forward_headers,
+                                         timeout=(1, forward_timeout))
+            response.raise_for_status()
+        except requests.exceptions.ReadTimeout:
+            # The owner has the webhook, and may still answer it; processing it here could answer twice
+            log("Forwarded webhook for room {} still running on {}".format(room_id, owner), logging.WARNING)
+            self._count("forwarded")
+            return True
+        except Exception as e:
+            log("Forwarding webhook to {} failed, processing locally: {}".format(owner, e), logging.WARNING)
+            with self._lock:
+                self.down[owner] = time.time()
+            self.rebuild()
+            self._count("failed")
+            return False
+        self._count("forwarded")
+        return True
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    # Ring members and routing counts, for the admin endpoint
+    def status(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "self": self.self_url,
+                "members": list(self.ring.nodes),
+                "down": sorted(self.down),
+                "counts": dict(self.counts)
+            }
+
+
+# Instances registered in the shared cache, each under a key that expires unless renewed
+class PeerRegistry(object):
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+        super(PeerRegistry, self).__init__()
+
+    def register(self, url, ttl):
+        self.client.command("SET", self.prefix + url, "1", "PX", int(ttl * 1000))
+
+    def peers(self):
+        found = []
+        cursor = b"0"
+        while True:
+            cursor, keys = self.client.command("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 500)
+            found.extend(k.decode("utf-8")[len(self.prefix):] for k in keys)
+            if cursor == b"0":
+                return found
+
+
+# Router for this instance
+router = ShardRouter(self_url, static_peers,
+                     PeerRegistry(cache.get_client(), "{}:peers:".format(cache.key_prefix))
+                     if cache.cache_url and self_url else None)
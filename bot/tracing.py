@@ -0,0 +1,256 @@
+#! /usr/bin/python
+
+"""
+tracing.py file contains lightweight request tracing for bot.py and utilities.py
+
+A trace is opened for every incoming webhook, and a child span is opened around
+every upstream call (Spark, Case API and SSO).  Any request slower than
+TRACE_SLOW_THRESHOLD seconds is written out as a full span tree, and finished
+traces are handed to any registered exporters.
+
+    # Requests slower than this (in seconds) are logged as a span tree
+    export TRACE_SLOW_THRESHOLD=2.0
+
+    # Write every finished trace as an OTLP-style JSON line to a local file
+    export TRACE_EXPORT_FILE=/tmp/tac-bot-traces.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import functools
+from contextlib import contextmanager
+
+# Requests slower than this many seconds are written out as a full span tree
+slow_threshold = float(os.environ.get("TRACE_SLOW_THRESHOLD", "2.0"))
+
+# Name reported to collectors for this service
+service_name = os.environ.get("SPARK_BOT_APP_NAME") or "tac-bot"
+
+# Active span for the running thread
+_local = threading.local()
+
+# Exporters receiving every finished trace
+_exporters = []
+
+
+# Default handler for slow requests: write the span tree to stderr
+def _write_slow_trace(root):
+    sys.stderr.write("[{}] Slow request ({:.3f}s):\n{}\n".format(root.trace_id, root.duration, format_tree(root)))
+
+
+_slow_handler = _write_slow_trace
+
+
+# A single timed operation within a trace
+class Span(object):
+    def __init__(self, name, trace_id, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.children = []
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        super(Span, self).__init__()
+
+    @property
+    def root(self):
+        span = self
+        while span.parent is not None:
+            span = span.parent
+        return span
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.time()
+        return end - self.start
+
+    def walk(self, depth=0):
+        yield depth, self
+        for child in list(self.children):
+            for item in child.walk(depth + 1):
+                yield item
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "start": self.start,
+            "duration": round(self.duration, 6),
+            "attributes": self.attributes,
+            "error": self.error,
+            "children": [c.to_dict() for c in list(self.children)]
+        }
+
+
+# Writes finished traces as OTLP-style JSON lines to a local file
+class FileExporter(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        super(FileExporter, self).__init__()
+
+    def export(self, root):
+        line = json.dumps(to_otlp(root))
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+#
+# Span functions
+#
+
+# Return the active span for this thread, if any
+def current_span():
+    return getattr(_local, "span", None)
+
+
+# Return the request id of the active trace, if any
+def request_id():
+    span = current_span()
+    if span is None:
+        return None
+    return span.trace_id
+
+
+# Set attributes on the root span of the active trace
+def annotate(**attributes):
+    span = current_span()
+    if span is not None:
+        span.root.attributes.update(attributes)
+
+
+# Open a span; if no trace is active, a new trace is started with this span as its root
+@contextmanager
+def span(name, **attributes):
+    parent = current_span()
+    if parent is None:
+        trace_id = attributes.pop("request_id", None) or uuid.uuid4().hex[:12]
+    else:
+        trace_id = parent.trace_id
+    s = Span(name, trace_id, parent=parent, attributes=attributes)
+    if parent is not None:
+        parent.children.append(s)
+
+    _local.span = s
+    try:
+        yield s
+    except Exception as e:
+        s.error = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        s.end = time.time()
+        _local.span = parent
+        if parent is None:
+            _finish_trace(s)
+
+
+# Open a root span for an incoming request
+def start_request(name, request_id=None, **attributes):
+    return span(name, request_id=request_id, **attributes)
+
+
+# Decorator wrapping a function call in a span
+def traced(name=None):
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Run func in another thread as a child of the caller's span
+def bind(func):
+    parent = current_span()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = current_span()
+        _local.span = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.span = previous
+    return wrapper
+
+
+#
+# Export functions
+#
+
+# Register an exporter; any object with an export(root_span) method can be used
+def add_exporter(exporter):
+    _exporters.append(exporter)
+
+
+# Remove a previously registered exporter
+def remove_exporter(exporter):
+    if exporter in _exporters:
+        _exporters.remove(exporter)
+
+
+# Replace the handler called with the root span of every slow request
+def set_slow_handler(handler):
+    globals()["_slow_handler"] = handler
+
+
+# Format a span tree as indented text
+def format_tree(root):
+    lines = []
+    for depth, s in root.walk():
+        line = "{}{} {:.3f}s".format("  " * depth, s.name, s.duration)
+        if s.error:
+            line = line + " [{}]".format(s.error)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+# Convert a finished trace into an OTLP/JSON ExportTraceServiceRequest
+def to_otlp(root):
+    spans = []
+    for depth, s in root.walk():
+        item = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "startTimeUnixNano": int(s.start * 1e9),
+            "endTimeUnixNano": int((s.end or time.time()) * 1e9),
+            "attributes": [{"key": k, "value": {"stringValue": str(v)}} for k, v in s.attributes.items()],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1}
+        }
+        if s.parent is not None:
+            item["parentSpanId"] = s.parent.span_id
+        spans.append(item)
+
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": "tac-bot.tracing"}, "spans": spans}]
+        }]
+    }
+
+
+# Log slow traces and hand every finished trace to the exporters
+def _finish_trace(root):
+    if root.duration >= slow_threshold:
+        _slow_handler(root)
+    for exporter in list(_exporters):
+        try:
+            exporter.export(root)
+        except Exception as e:
+            sys.stderr.write("Trace export failed: {}\n".format(e))
+
+
+if os.environ.get("TRACE_EXPORT_FILE"):
+    add_exporter(FileExporter(os.environ.get("TRACE_EXPORT_FILE")))
@@ -7,11 +7,40 @@ utilities.py file contains supporting functions for bot.py
 import re
 import requests
 import os
+import logging
+import threading
 from ciscosparkapi import CiscoSparkAPI
 from case import CaseDetail
+from tracing import traced, span, annotate
+from logger import log
+from ratelimit import spark_limiter
+from cache import get_cache, TTLCache
 
+# Upstream endpoints; can be overridden to point the bot at local stand-ins
+spark_api_url = os.environ.get("SPARK_API_URL", "https://api.ciscospark.com/v1/")
+sso_url = os.environ.get("SSO_URL", "https://cloudsso.cisco.com/as/token.oauth2")
+case_api_url = os.environ.get("CASE_API_URL", "https://api.cisco.com/case/v1.0")
+
+# Maximum number of case IDs requested in one Case API call
+case_batch_size = int(os.environ.get("CASE_API_BATCH_SIZE", "30"))
+
+# Upstream responses are cached, and shared between instances when CACHE_URL is set (see cache.py)
+# SSO tokens are kept until shortly before they expire
+token_cache = get_cache("sso", 0)
+case_cache = get_cache("case", float(os.environ.get("CASE_CACHE_TTL", "60")))
+person_cache = get_cache("person", float(os.environ.get("PERSON_CACHE_TTL", "3600")))
+
+# Room titles are cached in process; with sharding (see sharding.py) a room's webhooks all reach one instance
+room_cache = TTLCache(float(os.environ.get("ROOM_CACHE_TTL", "300")))
+
+# The Spark client is created on first use, and only once
 spark_token = os.environ.get("SPARK_BOT_TOKEN")
-spark = CiscoSparkAPI(access_token=spark_token)
+_spark = None
+_bot_emails = None
+_spark_lock = threading.Lock()
+
+# Functions called with (case_number, json) for every case fetched from the Case API
+_case_observers = []
 
 
 #
@@ -62,11 +91,13 @@ def verify_case_number(content):
 def get_case_number(content, room_id):
     case_number = verify_case_number(content)
     if case_number:
+        annotate(case_number=case_number)
         return case_number
     else:
         room_name = get_room_name(room_id)
         case_number = verify_case_number(room_name)
         if case_number:
+            annotate(case_number=case_number)
             return case_number
         else:
             return False
@@ -75,12 +106,22 @@ def get_case_number(content, room_id):
 # Case API functions
 #
 
-# Get access-token for Case API
+# Get access-token for Case API, reusing a cached token until a minute before it expires
 def get_access_token():
     client_id = os.environ.get("CASE_API_CLIENT_ID")
-    client_secret = os.environ.get("CASE_API_CLIENT_SECRET")
+    access_token = token_cache.get(client_id)
+    if access_token is None:
+        json = fetch_access_token(client_id, os.environ.get("CASE_API_CLIENT_SECRET"))
+        access_token = json['access_token']
+        token_cache.set(client_id, access_token, ttl=float(json.get('expires_in', 0)) - 60)
+    return access_token
+
+
+# Request a new access-token from SSO
+@traced("sso.get_access_token")
+def fetch_access_token(client_id, client_secret):
     grant_type = "client_credentials"
-    url = "https://cloudsso.cisco.com/as/token.oauth2"
+    url = sso_url
     payload = "client_id="+client_id+"&grant_type=client_credentials&client_secret="+client_secret
     headers = {
         'accept': "application/json",
@@ -89,16 +130,25 @@ def get_access_token():
     }
     response = requests.request("POST", url, data=payload, headers=headers)
     if (response.status_code == 200):
-        return response.json()['access_token']
+        return response.json()
     else:
         response.raise_for_status()
 
 
-# Get case details from CASE API
+# Get case details, from the cache or the CASE API
 def get_case_details(case_number):
+    json = case_cache.get(str(case_number))
+    if json is None:
+        json = fetch_case_details(case_number)
+    return json
+
+
+# Get case details from CASE API
+@traced("case_api.get_case_details")
+def fetch_case_details(case_number):
     access_token = get_access_token()
 
-    url = "https://api.cisco.com/case/v1.0/cases/details/case_ids/" + str(case_number)
+    url = case_api_url + "/cases/details/case_ids/" + str(case_number)
     headers = {
         'authorization': "Bearer " + access_token,
         'cache-control': "no-cache"
@@ -109,55 +159,197 @@ def get_case_details(case_number):
         # Uncomment to debug
         # sys.stderr.write(response.text)
 
-        return response.json()
+        json = response.json()
+        case_cache.set(str(case_number), json)
+        notify_case_observers(case_number, json)
+        return json
     else:
         response.raise_for_status()
 
 
+# Get case details for many cases, with the cases not cached requested from the CASE API with up to
+# case_batch_size case IDs per call
+# Returns a dict of case number to the same response get_case_details would return for that case
+def get_cases_details(case_numbers):
+    cases = {}
+    missing = []
+    for case_number in sorted(set(str(c) for c in case_numbers)):
+        json = case_cache.get(case_number)
+        if json is None:
+            missing.append(case_number)
+        else:
+            cases[case_number] = json
+    if missing:
+        cases.update(fetch_cases_details(missing))
+    return cases
+
+
+# Get case details for many cases from CASE API, and cache them
+def fetch_cases_details(case_numbers):
+    cases = {}
+    access_token = get_access_token()
+    headers = {
+        'authorization': "Bearer " + access_token,
+        'cache-control': "no-cache"
+    }
+    for i in range(0, len(case_numbers), case_batch_size):
+        url = case_api_url + "/cases/details/case_ids/" + ",".join(case_numbers[i:i + case_batch_size])
+        with span("case_api.get_case_details"):
+            response = requests.request("GET", url, headers=headers)
+        response.raise_for_status()
+        cases.update(split_case_details(response.json()))
+
+    for case_number, json in cases.items():
+        case_cache.set(case_number, json)
+        notify_case_observers(case_number, json)
+    return cases
+
+
+# Split a multi-case CASE API response into single-case responses keyed by case number
+def split_case_details(json):
+    details = json['RESPONSE'].get('CASES', {}).get('CASE_DETAIL', [])
+    if isinstance(details, dict):
+        details = [details]
+    return dict((str(d['CASE_ID']), {'RESPONSE': {'COUNT': 1, 'CASES': {'CASE_DETAIL': d}}}) for d in details)
+
+
+# Register a function to be called with (case_number, json) for every case fetched from the Case API
+def add_case_observer(func):
+    _case_observers.append(func)
+
+
+# Pass a fetched case to the observers; an observer failing does not fail the lookup
+def notify_case_observers(case_number, json):
+    for observer in list(_case_observers):
+        try:
+            observer(str(case_number), json)
+        except Exception as e:
+            log("Case observer failed for {}: {}".format(case_number, e), logging.WARNING)
+
+
 #
 # Spark functions
 #
 
+# Return the shared Spark client, creating it on first use; None until a token is configured
+def get_spark():
+    global _spark
+    if _spark is None and spark_token is not None:
+        with _spark_lock:
+            if _spark is None:
+                _spark = CiscoSparkAPI(access_token=spark_token, base_url=spark_api_url)
+    return _spark
+
+
+# Set the Spark token; the client is recreated on next use
+def set_spark_token(token):
+    global spark_token, _spark, _bot_emails
+    with _spark_lock:
+        spark_token = token
+        _spark = None
+        _bot_emails = None
+
+
+# Get the details about a message that was sent
+@traced("spark.messages.get")
+def get_message(message_id):
+    return get_spark().messages.get(message_id)
+
+
+# Send a message to a room or person
+@traced("spark.messages.create")
+def send_message(**kwargs):
+    return get_spark().messages.create(**kwargs)
+
+
+# Get the email addresses of the bot account; the bot identity is looked up once per token
+def get_bot_emails():
+    global _bot_emails
+    if _bot_emails is None:
+        with span("spark.people.me"):
+            _bot_emails = get_spark().people.me().emails
+    return _bot_emails
+
+
 # Get all rooms name matching case number
+@traced("spark.rooms.list")
 def get_matching_rooms(case_number):
-    rooms = spark.rooms.list()
+    rooms = get_spark().rooms.list()
     matches = [x for x in rooms if str(case_number) in x.title]
     return matches
 
 
-# Get Spark room name using CiscoSparkAPI
+# Get the rooms whose name contains each of the given case numbers, with a single room listing
+@traced("spark.rooms.list")
+def get_rooms_for_cases(case_numbers):
+    matches = dict((str(c), []) for c in case_numbers)
+    pattern = re.compile("(6[0-9]{8})")
+    for room in get_spark().rooms.list():
+        for case_number in set(pattern.findall(room.title or "")):
+            if case_number in matches:
+                matches[case_number].append(room.id)
+    return matches
+
+
+# Get Spark room name, from the cache or using CiscoSparkAPI
 def get_room_name(room_id):
-    room_name = spark.rooms.get(room_id).title
+    room_name = room_cache.get(room_id)
+    if room_name is None:
+        room_name = fetch_room_name(room_id)
+        room_cache.set(room_id, room_name)
     return room_name
 
 
-# Create Spark Room
-def create_room(case_number):
-    case = CaseDetail(get_case_details(case_number))
-    title = case.title
+# Get Spark room name using CiscoSparkAPI
+@traced("spark.rooms.get")
+def fetch_room_name(room_id):
+    room_name = get_spark().rooms.get(room_id).title
+    return room_name
+
+
+# Create Spark Room; case details are fetched unless already provided
+def create_room(case_number, case=None):
+    if case is None:
+        case = CaseDetail(get_case_details(case_number))
+    title = case.title if case.count > 0 else None
     if title:
         data = "SR {}: {}".format(case_number, title)
     else:
         data = "SR {}".format(case_number)
 
-    new_room = spark.rooms.create(data)
+    spark_limiter.acquire()
+    with span("spark.rooms.create"):
+        new_room = get_spark().rooms.create(data)
     return new_room.id
 
 
 # Get room membership
+@traced("spark.memberships.list")
 def get_membership(room_id):
-    memberships= spark.memberships.list(roomId=room_id)
+    memberships = list(get_spark().memberships.list(roomId=room_id))
     return memberships
 
 
-# Get person_id for email address
+# Get person_id for email address; found IDs are cached
 def get_person_id(email):
+    person_id = person_cache.get("email:" + email)
+    if person_id is None:
+        person_id = fetch_person_id(email)
+        if person_id:
+            person_cache.set("email:" + email, person_id)
+    return person_id
+
+
+# Look up person_id for email address in Spark
+@traced("spark.people.list")
+def fetch_person_id(email):
     if check_email_syntax(email):
-        person = spark.people.list(email=email)
+        person = get_spark().people.list(email=email)
 
         # Future capabilities of Spark allow for multiple emails.
         # Today, iterating through GeneratorContainer created by CiscoSparkAPI will yield only one personId.
         # This may break in the future if GeneratorContainer returns multiple items
+        person_id = False
         for p in person:
             person_id = p.id
         return person_id
@@ -165,18 +357,30 @@ def get_person_id(email):
         return False
 
 
-# Get email address for provided personId
+# Get email address for provided personId; found addresses are cached
 def get_email(person_id):
+    email = person_cache.get("id:" + person_id)
+    if email is None:
+        email = fetch_email(person_id)
+        person_cache.set("id:" + person_id, email)
+    return email
+
+
+# Look up email address for provided personId in Spark
+@traced("spark.people.get")
+def fetch_email(person_id):
     # Future capabilities of Spark allow for multiple emails.
     # Today, iterating through GeneratorContainer created by CiscoSparkAPI will yield only one personId.
     # This may break in the future if GeneratorContainer returns multiple items
-    email = spark.people.get(person_id).emails[0]
+    email = get_spark().people.get(person_id).emails[0]
     return email
 
 
 # Create membership
+@traced("spark.memberships.create")
 def create_membership(person_id, new_room_id):
-    new_membership = spark.memberships.create(new_room_id, personId=person_id)
+    spark_limiter.acquire()
+    new_membership = get_spark().memberships.create(new_room_id, personId=person_id)
     return new_membership.id
 
 
@@ -194,6 +398,8 @@ def room_exists_for_user(case_number, email):
 
 
 # Invite user to room
+@traced("spark.memberships.create")
 def invite_user(room_id, email):
-    new_membership = spark.memberships.create(room_id, personEmail=email)
+    spark_limiter.acquire()
+    new_membership = get_spark().memberships.create(room_id, personEmail=email)
     return new_membership
\ No newline at end of file
@@ -1,6 +1,36 @@
 import unittest
+import os
+import json
+import io
+import time
+import tempfile
+import sys
 import bot.bot
 import bot.utilities
+import bot.tracing
+import bot.logger
+import bot.health
+import bot.case
+import bot.ratelimit
+import bot.export
+import bot.aging
+import bot.history
+import bot.search
+import bot.cache
+import bot.rma
+import bot.bugs
+import bot.leader
+import bot.sharding
+import bot.admission
+import bot.memory
+import bot.quota
+import bot.capture
+import bot.journal
+import bot.digest
+import bot.mycases
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+import fakes
 
 class testcases(unittest.TestCase):
     def setUp(self):
@@ -30,4 +60,785 @@ class testcases(unittest.TestCase):
         test = bot.utilities.check_cisco_user("somename@yahoo.com")
         self.assertFalse(test)
 
+    def test_007_span_tree(self):
+        with bot.tracing.start_request("webhook", request_id="abc123") as root:
+            with bot.tracing.span("case_api.get_case_details"):
+                with bot.tracing.span("sso.get_access_token"):
+                    self.assertEqual(bot.tracing.request_id(), "abc123")
+        names = [s.name for d, s in root.walk()]
+        self.assertEqual(names, ["webhook", "case_api.get_case_details", "sso.get_access_token"])
+        self.assertIsNone(bot.tracing.current_span())
+
+    def test_008_trace_file_export(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        exporter = bot.tracing.FileExporter(path)
+        bot.tracing.add_exporter(exporter)
+        try:
+            with bot.tracing.start_request("webhook"):
+                with bot.tracing.span("spark.messages.get"):
+                    pass
+        finally:
+            bot.tracing.remove_exporter(exporter)
+        with open(path) as f:
+            spans = json.loads(f.readline())["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        os.remove(path)
+        self.assertEqual(len(spans), 2)
+        self.assertEqual(spans[1]["parentSpanId"], spans[0]["spanId"])
+
+    def test_009_json_log_record_has_request_context(self):
+        records = bot.logger.queue.Queue()
+        handler = bot.logger.QueueHandler(records)
+        log = bot.logger.logging.getLogger("tacbot.test")
+        log.addHandler(handler)
+        try:
+            with bot.tracing.start_request("webhook", request_id="req42"):
+                bot.tracing.annotate(command="/status", case_number="612345678")
+                log.warning("Replied to %s", "someone@cisco.com")
+        finally:
+            log.removeHandler(handler)
+        entry = json.loads(bot.logger.JsonFormatter().format(records.get_nowait()))
+        self.assertEqual(entry["request_id"], "req42")
+        self.assertEqual(entry["command"], "/status")
+        self.assertEqual(entry["case_number"], "612345678")
+        self.assertEqual(entry["message"], "Replied to someone@cisco.com")
+
+    def test_010_health_report_from_cache(self):
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise Exception("token revoked")
+
+        prober = bot.health.HealthProber([("spark", failing), ("sso", lambda: None)], critical=["spark"])
+        healthy, report = prober.report()
+        self.assertTrue(healthy)
+        self.assertEqual(report["checks"]["spark"]["status"], "pending")
+        prober.probe()
+        healthy, report = prober.report()
+        self.assertFalse(healthy)
+        self.assertEqual(report["checks"]["spark"]["status"], "failed")
+        self.assertEqual(report["checks"]["sso"]["status"], "ok")
+        self.assertEqual(len(calls), 1)
+
+    def test_011_webhooks_reconciled_to_filtered_set(self):
+        class Hook(object):
+            def __init__(self, id, name, targetUrl, filter=None):
+                self.id, self.name, self.targetUrl, self.filter = id, name, targetUrl, filter
+
+        class Webhooks(object):
+            def __init__(self):
+                self.hooks = [Hook("1", "tac", "http://bot"), Hook("2", "other bot", "http://other")]
+
+            def list(self):
+                return list(self.hooks)
+
+            def delete(self, id):
+                self.hooks = [h for h in self.hooks if h.id != id]
+
+            def create(self, name, targetUrl, resource, event, filter=None):
+                hook = Hook(name, name, targetUrl, filter)
+                self.hooks.append(hook)
+                return hook
+
+        class Spark(object):
+            webhooks = Webhooks()
+
+        get_spark = bot.bot.get_spark
+        bot.bot.get_spark = lambda: Spark
+        try:
+            result = bot.bot.setup_webhook("tac", "http://bot")
+            again = bot.bot.setup_webhook("tac", "http://bot")
+        finally:
+            bot.bot.get_spark = get_spark
+        names = sorted(h.name for h in Spark.webhooks.hooks)
+        self.assertEqual(names, ["other bot", "tac direct", "tac mentions"])
+        self.assertEqual(sorted(h.id for h in result), sorted(h.id for h in again))
+
+    def test_012_split_batched_case_details(self):
+        response = {"RESPONSE": {"COUNT": 2, "CASES": {"CASE_DETAIL": [
+            {"CASE_ID": "612345678", "TITLE": "BGP flap"},
+            {"CASE_ID": "612345679", "TITLE": "Fan failure"}]}}}
+        cases = bot.utilities.split_case_details(response)
+        self.assertEqual(sorted(cases.keys()), ["612345678", "612345679"])
+        self.assertEqual(bot.case.CaseDetail(cases["612345679"]).title, "Fan failure")
+        self.assertEqual(bot.utilities.split_case_details({"RESPONSE": {"COUNT": 0}}), {})
+
+    def test_013_token_bucket_limits_burst(self):
+        bucket = bot.ratelimit.TokenBucket(rate=1, burst=2)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertFalse(bucket.acquire(timeout=0.1))
+
+    def test_014_export_csv_streams_header_and_rows(self):
+        rows = [dict.fromkeys(bot.export.COLUMNS, ""), dict.fromkeys(bot.export.COLUMNS, "")]
+        rows[0]["case_number"] = "612345678"
+        rows[1]["case_number"] = "612345679"
+        chunks = list(bot.export.to_csv(iter(rows)))
+        lines = "".join(chunks).splitlines()
+        self.assertEqual(lines[0], ",".join(bot.export.COLUMNS))
+        self.assertTrue(lines[2].startswith("612345679"))
+        self.assertTrue(len(chunks) >= 2)
+
+    def test_015_aging_report_by_severity(self):
+        store = bot.aging.CaseStore(capacity=2)
+        now = 1500000000
+        for case_id, severity, status, days_open, days_since_update in [
+                ("612345671", "1", "Customer Pending", 10, 1), ("612345672", "1", "Cisco Pending", 20, 5),
+                ("612345673", "3", "Cisco Pending", 30, 4), ("612345674", "2", "Closed", 40, 2)]:
+            store.record(case_id, {"RESPONSE": {"COUNT": 1, "CASES": {"CASE_DETAIL": {
+                "SEVERITY": severity, "STATUS": status, "OWNER_EMAIL_ADDRESS": "cse@cisco.com",
+                "CREATION_DATE": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now - days_open * 86400)),
+                "UPDATED_DATE": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now - days_since_update * 86400))}}}})
+        report = store.report(now=now)
+        self.assertEqual((report["open"], report["closed"], report["stale"]), (3, 1, 2))
+        self.assertEqual(report["open_days"]["p50"], 20)
+        sev1 = [g for g in report["by_severity"] if g["group"] == "1"][0]
+        self.assertEqual((sev1["open"], sev1["stale"], sev1["median_open_days"]), (2, 1, 15))
+        self.assertEqual([c["case_number"] for c in report["stale_cases"]], ["612345672", "612345673"])
+
+    def test_016_case_history_keeps_deltas(self):
+        store = bot.history.CaseHistory(max_entries=2)
+        for seen, status, severity in [(100, "Cisco Pending", "3"), (200, "Cisco Pending", "2"),
+                                       (300, "Customer Pending", "2"), (400, "Closed", "2")]:
+            store.record("612345678", {"RESPONSE": {"COUNT": 1, "CASES": {"CASE_DETAIL": {
+                "STATUS": status, "SEVERITY": severity}}}}, seen=seen)
+        first_seen, base, changes = store.timeline("612345678")
+        self.assertEqual((first_seen, base["Status"], base["Severity"]), (200, "Cisco Pending", "2"))
+        self.assertEqual(changes, [(300, [("Status", "Cisco Pending", "Customer Pending")]),
+                                   (400, [("Status", "Customer Pending", "Closed")])])
+        self.assertIsNone(store.timeline("612345679"))
+
+    def test_017_search_ranks_open_cases_in_rooms(self):
+        index = bot.search.SearchIndex(capacity=1)
+        for case_id, title, status in [("612345671", "BGP flap after upgrade", "Closed"),
+                                       ("612345672", "BGP flap on core router", "Cisco Pending"),
+                                       ("612345673", "Fan failure", "Cisco Pending")]:
+            index.add(case_id, {"RESPONSE": {"COUNT": 1, "CASES": {"CASE_DETAIL": {
+                "TITLE": title, "STATUS": status, "BUGS": {"ID": ["CSCuv12345"]}}}}})
+        self.assertEqual([r["case_number"] for r in index.search("bgp FLAP")], ["612345672", "612345671"])
+        self.assertEqual(len(index.search("cscuv12345")), 3)
+        self.assertEqual(index.search("bgp fan"), [])
+        index.set_rooms([("room1", "SR 612345671: BGP flap"), ("room2", "Team chat")])
+        results = index.search("bgp flap", in_rooms=True)
+        self.assertEqual([r["case_number"] for r in results], ["612345671"])
+        self.assertEqual(results[0]["rooms"], {"room1": "SR 612345671: BGP flap"})
+
+    def test_018_rma_status_from_cache(self):
+        json = {"returns": {"RmaRecord": [{"rmaNo": "84512345", "status": "Shipped",
+            "lines": {"lineDetail": [{"shipDate": "2017-01-05", "carrier": "UPS", "trackingNumber": "1Z999"}]}}]}}
+        bot.rma.cache.set("84512345", json)
+        try:
+            details = bot.rma.get_rmas_details(["84512345"], budget=0)
+        finally:
+            bot.rma.cache.delete("84512345")
+        self.assertEqual(bot.rma.format_status(details["84512345"]),
+                         "status Shipped, shipped 2017-01-05 via UPS, tracking 1Z999")
+        cache = bot.cache.TTLCache(ttl=0)
+        cache.set("key", "value")
+        self.assertIsNone(cache.get("key"))
+
+    def test_019_bug_lookups_batched_and_cached(self):
+        batches = []
+
+        def get_bug_batch(bug_ids, access_token=None):
+            batches.append(len(bug_ids))
+            return dict((b, {"bug_id": b, "headline": "Crash", "status": "F", "severity": "2",
+                             "known_fixed_releases": "15.2(4)M7 15.3(3)M5"}) for b in bug_ids)
+
+        get_access_token = bot.bugs.utilities.get_access_token
+        bot.bugs.utilities.get_access_token = lambda: "token"
+        bot.bugs.get_bug_batch, original = get_bug_batch, bot.bugs.get_bug_batch
+        bug_ids = ["CSCuv{}".format(10000 + i) for i in range(12)]
+        try:
+            details = bot.bugs.get_bugs_details(bug_ids)
+            again = bot.bugs.get_bugs_details(bug_ids[:3])
+        finally:
+            bot.bugs.get_bug_batch = original
+            bot.bugs.utilities.get_access_token = get_access_token
+            bot.bugs.cache.clear()
+        self.assertEqual(sorted(batches), [2, 5, 5])
+        self.assertEqual(bot.bugs.format_bug(details["CSCuv10011"]), "Crash (Fixed, Sev 2), fixed in 15.2(4)M7, 15.3(3)M5")
+        self.assertEqual(again["CSCuv10000"].headline, "Crash")
+
+    def test_020_shared_cache_protocol(self):
+        self.assertEqual(bot.cache.encode_command(["SET", "k", 5]), b"*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\n5\r\n")
+        reply = io.BytesIO(b"*3\r\n$3\r\nfoo\r\n$-1\r\n:7\r\n+OK\r\n-ERR wrong type\r\n")
+        self.assertEqual(bot.cache.read_reply(reply), [b"foo", None, 7])
+        self.assertEqual(bot.cache.read_reply(reply), "OK")
+        self.assertRaises(bot.cache.RedisError, bot.cache.read_reply, reply)
+        unreachable = bot.cache.RedisCache(bot.cache.RedisClient("redis://127.0.0.1:1/0"), "test:", 60)
+        unreachable.set("key", "value")
+        self.assertIsNone(unreachable.get("key"))
+        self.assertIsInstance(bot.cache.get_cache("test", 60), bot.cache.TTLCache)
+
+    def test_021_leader_lease_fails_over(self):
+        lease = bot.leader.FileLease(os.path.join(tempfile.mkdtemp(), "leader.json"))
+        first = bot.leader.LeaderElector(lease, "first", ttl=0.2)
+        second = bot.leader.LeaderElector(lease, "second", ttl=0.2)
+        elected = []
+        second.on_elected(lambda: elected.append("second"))
+        self.assertTrue(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+        time.sleep(0.25)
+        self.assertFalse(first.is_leader)
+        self.assertTrue(second.try_acquire())
+        self.assertFalse(first.try_acquire())
+        second.stop()
+        self.assertTrue(first.try_acquire())
+        self.assertEqual(elected, ["second"])
+
+    def test_022_rooms_sharded_by_consistent_hash(self):
+        rooms = ["room{}".format(i) for i in range(3000)]
+        ring = bot.sharding.HashRing(["http://a", "http://b", "http://c"])
+        before = dict((r, ring.owner(r)) for r in rooms)
+        for node in ["http://a", "http://b", "http://c"]:
+            self.assertGreater(list(before.values()).count(node), 700)
+        ring = bot.sharding.HashRing(["http://a", "http://b", "http://c", "http://d"])
+        moved = [r for r in rooms if ring.owner(r) != before[r]]
+        self.assertTrue(500 < len(moved) < 1000)
+        self.assertEqual(set(ring.owner(r) for r in moved), set(["http://d"]))
+
+        router = bot.sharding.ShardRouter("http://self", ["http://127.0.0.1:1"], secret="s3cret")
+        remote = [r for r in rooms if router.owner(r) == "http://127.0.0.1:1"][0]
+        self.assertFalse(router.route(remote, b"{}", {bot.sharding.FORWARDED_HEADER: "http://other",
+                                                      bot.sharding.SIGNATURE_HEADER: router.sign(b"{}")}))
+        self.assertFalse(router.route(remote, b"{}", {}))
+        self.assertEqual(router.owner(remote), "http://self")
+        self.assertEqual(router.status()["counts"], {"local": 0, "forwarded": 0, "received": 1, "failed": 1})
+
+    def test_023_admission_sheds_by_priority(self):
+        self.assertEqual([bot.admission.classify(c) for c in ["", "/help", "/link", "/status"]],
+                         ["chatter", "local", "local", "case"])
+        controller = bot.admission.AdmissionController(case_concurrency=1, case_queue=0, case_wait=0.05,
+                                                       shed_backlog=1, busy_interval=60)
+        self.assertTrue(controller.admit("case"))
+        self.assertFalse(controller.admit("case"))
+        controller.release("case")
+        self.assertTrue(controller.admit("case"))
+        controller.release("case")
+        controller.enter()
+        controller.enter()
+        self.assertFalse(controller.admit("chatter"))
+        self.assertTrue(controller.admit("local"))
+        controller.leave()
+        self.assertTrue(controller.admit("chatter"))
+        self.assertTrue(controller.should_reply_busy("room1"))
+        self.assertFalse(controller.should_reply_busy("room1"))
+        text = bot.admission.format_metrics(controller.metrics())
+        self.assertIn('tacbot_messages_shed_total{class="case"} 1\n', text)
+        self.assertIn('tacbot_messages_shed_total{class="chatter"} 1\n', text)
+        self.assertIn("tacbot_message_backlog 1\n", text)
+
+    def test_024_memory_report(self):
+        shared = "x" * 1000
+        self.assertLess(bot.memory.approximate_size([shared, shared]), 1200)
+        self.assertGreater(bot.memory.approximate_size([shared, "y" * 1000]), 2000)
+        sampled = bot.memory.approximate_size(["z" * i for i in range(100)], sample=10)
+        self.assertTrue(9000 < sampled < 12000)
+        cases = [bot.case.CaseDetail({"RESPONSE": {"COUNT": 0}}) for _ in range(3)]
+        report = bot.memory.report(limit=5)
+        self.assertGreaterEqual(report["objects"]["CaseDetail"]["count"], len(cases))
+        self.assertIn("entries", report["caches"]["case_details"])
+        self.assertFalse(bot.memory.allocations()["tracing"])
+
+        # Allocation tracing needs tracemalloc, only available from Python 3.4
+        if bot.memory.tracemalloc is None:
+            self.assertRaises(RuntimeError, bot.memory.start_tracing)
+            return
+        bot.memory.start_tracing()
+        try:
+            report = bot.memory.report(limit=5)
+            report = bot.memory.report(limit=5)
+        finally:
+            bot.memory.stop_tracing()
+        self.assertTrue(report["allocations"]["tracing"])
+        self.assertLessEqual(len(report["allocations"]["top"]), 5)
+        self.assertFalse(bot.memory.allocations()["tracing"])
+
+    def test_025_rate_limits_and_usage(self):
+        limiter = bot.ratelimit.KeyedLimiter(0.001, 2, max_keys=2)
+        self.assertTrue(limiter.try_acquire("alice"))
+        self.assertTrue(limiter.try_acquire("alice"))
+        self.assertFalse(limiter.try_acquire("alice"))
+        self.assertTrue(limiter.try_acquire("bob"))
+        limiter.try_acquire("carol")
+        self.assertTrue(limiter.try_acquire("alice"))
+        limiter.configure(0)
+        self.assertTrue(all(limiter.try_acquire("alice") for _ in range(10)))
+        self.assertRaises(ValueError, bot.ratelimit.KeyedLimiter, 1, 0)
+        before = bot.quota.limits()
+        self.assertIn("PERSON_RATE_BURST must be at least 1",
+                      bot.quota.configure({"PERSON_RATE_LIMIT": 1, "PERSON_RATE_BURST": 0}))
+        self.assertEqual(bot.quota.limits(), before)
+
+        accountant = bot.quota.UsageAccountant()
+        bot.tracing.add_exporter(accountant)
+        try:
+            for person_id, calls in [("alice", 3), ("bob", 1)]:
+                with bot.tracing.start_request("webhook", room_id="room1", person_id=person_id):
+                    bot.tracing.annotate(command="/title")
+                    for _ in range(calls):
+                        with bot.tracing.span("case_api.get_case_details"):
+                            pass
+                    with bot.tracing.span("spark.messages.create"):
+                        pass
+        finally:
+            bot.tracing.remove_exporter(accountant)
+        top = accountant.top("person")
+        self.assertEqual([t["key"] for t in top], ["alice", "bob"])
+        self.assertEqual(top[0]["by_service"], {"case_api": 3, "spark": 1})
+        self.assertEqual(accountant.top("room")[0]["calls"], 6)
+        self.assertEqual(accountant.top("command", service="case_api")[0]["messages"], 2)
+
+    def test_026_capture_sanitized(self):
+        self.assertEqual(bot.capture.sanitize({"personEmail": "Jo@cisco.com", "displayName": "Jo", "n": 1}),
+                         {"personEmail": bot.capture.mask_emails("jo@cisco.com"), "displayName": "REDACTED", "n": 1})
+        self.assertTrue(bot.capture.mask_emails("jo@cisco.com").endswith("@cisco.com"))
+        url = bot.utilities.spark_api_url + "people?email=jo%40cisco.com"
+        self.assertEqual(bot.capture.split_url(url),
+                         ("spark", "people?email=" + bot.capture.mask_emails("jo@cisco.com")))
+        self.assertEqual(bot.capture.split_url("http://10.0.0.6:5000/"), (None, None))
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        recorder = bot.capture.Recorder(path)
+        recorder.install()
+        try:
+            with bot.tracing.start_request("webhook"):
+                recorder.begin({"data": {"roomId": "room1", "personEmail": "jo@cisco.com"}})
+                prepared = bot.capture.requests.Request("POST", bot.utilities.sso_url).prepare()
+                response = bot.capture.requests.models.Response()
+                response.status_code = 200
+                response._content = b'{"access_token": "secret", "expires_in": 3599}'
+                recorder.add_call(bot.tracing.current_span().root, prepared, time.time(), response)
+        finally:
+            recorder.uninstall()
+        with open(path) as f:
+            record = json.loads(f.readline())
+        os.remove(path)
+        self.assertEqual(record["payload"]["data"]["roomId"], "room1")
+        self.assertNotIn("jo@", json.dumps(record))
+        call = record["calls"][0]
+        self.assertEqual((call["service"], call["method"], call["path"], call["status"]), ("sso", "POST", "", 200))
+        self.assertEqual(call["body"], {"access_token": "REDACTED", "expires_in": 3599})
+
+    def test_027_journal_replays_unfinished_webhooks(self):
+        path = tempfile.mkdtemp()
+        journal = bot.journal.Journal(path, segment_bytes=1000, max_segments=2)
+        stuck = journal.append({"data": {"roomId": "room1", "id": "m0"}})
+        for i in range(50):
+            journal.done(journal.append({"data": {"roomId": "room1", "id": "m{}".format(i + 1)}}))
+        self.assertGreater(len(journal.segments), 2)
+        journal.compact()
+        self.assertLessEqual(len(journal.segments), 2)
+        self.assertEqual(journal.checkpoint, stuck - 1)
+
+        # A webhook cut off mid-write is dropped; the unfinished one is replayed after a restart
+        crashed = journal.append({"data": {"roomId": "room2", "id": "m51"}})
+        with open(os.path.join(path, journal.segments[-1][1]), "ab") as f:
+            f.write(b"\x00\x00\x01")
+        restarted = bot.journal.Journal(path)
+        self.assertEqual([(seq, p["data"]["id"]) for seq, p in restarted.unprocessed()],
+                         [(stuck, "m0"), (crashed, "m51")])
+        self.assertEqual(restarted.append({"data": {"roomId": "room3"}}), crashed + 1)
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+
+    def test_028_digest_formatting_and_schedule(self):
+        def case(status, updated, rmas=None):
+            return bot.case.CaseDetail({"RESPONSE": {"COUNT": 1, "CASES": {"CASE_DETAIL": {
+                "STATUS": status, "SEVERITY": "3", "UPDATED_DATE": updated, "RMAS": {"ID": rmas},
+                "OWNER_FIRST_NAME": "Jo", "OWNER_LAST_NAME": "Smith", "OWNER_EMAIL_ADDRESS": "jo@cisco.com"}}}})
+        now = bot.digest.datetime(2017, 1, 10, 8, 0, 0)
+        self.assertIsNone(bot.digest.format_digest("612345678", case("Closed", "2017-01-01T08:00:00Z"),
+                                                   [], [], {}, {}, now))
+        message = bot.digest.format_digest("612345678", case("Cisco Pending", "2017-01-01T08:00:00Z", "84512345"),
+                                           ["84512345"], [], {}, {}, now)
+        self.assertIn("* **9 days, 0:00:00 since last update**", message)
+        self.assertIn("* New RMA 84512345: status unavailable", message)
+        message = bot.digest.format_digest("612345678", case("Cisco Pending", "2017-01-09T08:00:00Z"),
+                                           [], [], {}, {}, now)
+        self.assertIn("* 1 day, 0:00:00 since last update", message)
+
+        # Due once per day, inside the window, and only on the leader; windows may cross midnight
+        leader = [False]
+        scheduler = bot.digest.DigestScheduler(at="23:50", window=1800, is_leader=lambda: leader[0])
+        midnight = (bot.digest.datetime(2017, 1, 10) - bot.digest.datetime(1970, 1, 1)).total_seconds()
+        self.assertIsNone(scheduler.due(midnight + 300))
+        leader[0] = True
+        bot.digest.runs.delete("last")
+        self.assertEqual(scheduler.due(midnight + 300), "2017-01-09")
+        self.assertIsNone(scheduler.due(midnight + 1200))
+        bot.digest.runs.set("last", "2017-01-09")
+        self.assertIsNone(scheduler.due(midnight + 300))
+        self.assertEqual(scheduler.due(midnight + 86400 - 300), "2017-01-10")
+        bot.digest.runs.delete("last")
+
+        sent = []
+        send_message = bot.utilities.send_message
+        bot.utilities.send_message = lambda roomId, markdown: sent.append((roomId, time.time()))
+        try:
+            self.assertEqual(bot.digest.PacedSender(rate=20).deliver(
+                [("room{}".format(i), "612345678", "digest") for i in range(5)]), (5, 0, set()))
+        finally:
+            bot.utilities.send_message = send_message
+        self.assertEqual([room for room, at in sent], ["room0", "room1", "room2", "room3", "room4"])
+        self.assertGreaterEqual(sent[-1][1] - sent[0][1], 0.18)
+
+    def test_029_mycases_paged_cached_and_sorted_by_staleness(self):
+        pages = {1: [{"CASE_ID": "612345671", "TITLE": "BGP flap", "STATUS": "Cisco Pending", "SEVERITY": "3",
+                      "UPDATED_DATE": "2017-01-09T00:00:00Z"}],
+                 2: [{"CASE_ID": "612345672", "TITLE": "Fan failure on a very long case title that is cut short",
+                      "STATUS": "Customer Pending", "SEVERITY": "2", "UPDATED_DATE": "2017-01-01T00:00:00Z"}],
+                 3: [{"CASE_ID": "612345673", "TITLE": "No update yet", "STATUS": "New", "SEVERITY": "4",
+                      "UPDATED_DATE": None}]}
+        requested = []
+
+        def get_cases_page(user_id, page_index, access_token=None):
+            requested.append(page_index)
+            return list(pages[page_index]), 3
+
+        get_page, get_access_token = bot.mycases.get_cases_page, bot.utilities.get_access_token
+        bot.mycases.get_cases_page = get_cases_page
+        bot.utilities.get_access_token = lambda: "token"
+        bot.mycases.cache.delete("jsmith")
+        try:
+            cases, complete = bot.mycases.get_user_cases("jsmith")
+            self.assertEqual(bot.mycases.get_user_cases("jsmith"), (cases, complete))
+        finally:
+            bot.mycases.get_cases_page, bot.utilities.get_access_token = get_page, get_access_token
+            bot.mycases.cache.delete("jsmith")
+        self.assertEqual(sorted(requested), [1, 2, 3])
+        self.assertTrue(complete)
+        self.assertEqual(bot.mycases.user_id_for("JSmith@cisco.com"), "jsmith")
+        self.assertIsNone(bot.mycases.user_id_for("jsmith@example.com"))
+
+        now = (bot.digest.datetime(2017, 1, 10) - bot.digest.datetime(1970, 1, 1)).total_seconds()
+        lines = bot.mycases.format_cases("jsmith", cases, complete, now=now).splitlines()
+        self.assertEqual(lines[0], "Open cases owned by jsmith (3), longest without an update first:")
+        self.assertEqual([line.split()[0] for line in lines[3:6]], ["612345672", "612345671", "612345673"])
+        self.assertIn("9.0d  Fan failure on a very long case title...", lines[3])
+        self.assertIn("-  No update yet", lines[5])
+        self.assertIn("and 1 more", bot.mycases.format_cases("jsmith", cases, now=now, limit=2))
+        self.assertEqual(bot.mycases.format_cases("jsmith", []), "No open cases owned by jsmith")
+
+    def test_030_health_sso_check_bypasses_token_cache(self):
+        fetched = []
+        fetch_access_token = bot.utilities.fetch_access_token
+        bot.utilities.fetch_access_token = lambda client_id, client_secret: fetched.append(client_id)
+        environ = dict(os.environ)
+        os.environ.update({"CASE_API_CLIENT_ID": "probe-id", "CASE_API_CLIENT_SECRET": "probe-secret"})
+        bot.utilities.token_cache.set("probe-id", "cached-token")
+        try:
+            bot.health.check_sso()
+        finally:
+            bot.utilities.fetch_access_token = fetch_access_token
+            bot.utilities.token_cache.delete("probe-id")
+            os.environ.clear()
+            os.environ.update(environ)
+        self.assertEqual(fetched, ["probe-id"])
+
+    def test_031_invite_several_people_and_keywords(self):
+        class Member(object):
+            def __init__(self, email):
+                self.personEmail = email
+
+        class Memberships(object):
+            def __init__(self):
+                self.created = []
+
+            def list(self, roomId):
+                return [Member("Owner@cisco.com")]
+
+            def create(self, roomId, personEmail):
+                if personEmail == "gone@example.com":
+                    raise Exception("person not found")
+                self.created.append((roomId, personEmail))
+                return Member(personEmail)
+
+        class Spark(object):
+            memberships = Memberships()
+
+        class Message(object):
+            text = "/invite 612345678 cse, customer jo@example.com;gone@example.com jo@EXAMPLE.com nobody"
+
+        case = {"RESPONSE": {"COUNT": 1, "CASES": {"CASE_DETAIL": {
+            "OWNER_FIRST_NAME": "Case", "OWNER_LAST_NAME": "Owner", "OWNER_EMAIL_ADDRESS": "owner@cisco.com",
+            "CONTACT_USER_FIRST_NAME": "Customer", "CONTACT_USER_LAST_NAME": "Contact",
+            "CONTACT_EMAIL_IDS": {"ID": ["customer@example.com"]}}}}}
+        stubs = {"get_message": lambda message_id: Message(), "get_email": lambda person_id: "engineer@cisco.com",
+                 "get_case_details": lambda case_number: case}
+        saved = dict((name, getattr(bot.bot, name)) for name in stubs)
+        get_spark = bot.utilities.get_spark
+        for name, stub in stubs.items():
+            setattr(bot.bot, name, stub)
+        bot.utilities.get_spark = lambda: Spark
+        try:
+            reply = bot.bot.send_invite({"data": {"roomId": "room1", "id": "m1", "personId": "p1"}})
+        finally:
+            for name, func in saved.items():
+                setattr(bot.bot, name, func)
+            bot.utilities.get_spark = get_spark
+        self.assertEqual(sorted(Spark.memberships.created), [("room1", "customer@example.com"),
+                                                             ("room1", "jo@example.com")])
+        self.assertEqual(reply.split("<br>"), [
+            "Added to the room: Customer Customer Contact, jo@example.com",
+            "Already in the room: Case owner Case Owner",
+            "Could not add: nobody (not a valid email address), gone@example.com (unable to add to the room at "
+            "this time)"])
+
+    def test_032_redis_lease_renewed_only_by_holder(self):
+        class Client(object):
+            def __init__(self):
+                self.value = None
+                self.commands = []
+
+            def command(self, *args):
+                self.commands.append(args[0])
+                if args[0] == "SET":
+                    if self.value is not None:
+                        return None
+                    self.value = args[2].encode("utf-8")
+                    return "OK"
+                if self.value != args[4].encode("utf-8"):
+                    return 0
+                if args[1] == bot.leader.RELEASE_SCRIPT:
+                    self.value = None
+                return 1
+
+        client = Client()
+        lease = bot.leader.RedisLease(client, "tacbot:leader")
+        self.assertTrue(lease.acquire("first", 1))
+        self.assertTrue(lease.acquire("first", 1))
+        # The lease expired and was taken over; the old holder can neither renew nor release it
+        client.value = b"second"
+        self.assertFalse(lease.acquire("first", 1))
+        lease.release("first")
+        self.assertEqual(client.value, b"second")
+        lease.release("second")
+        self.assertIsNone(client.value)
+        self.assertNotIn("GET", client.commands)
+
+    def test_033_capture_redacts_case_content(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        recorder = bot.capture.Recorder(path)
+        recorder.install()
+        try:
+            with bot.tracing.start_request("webhook"):
+                recorder.begin({"data": {"roomId": "room1"}})
+                root = bot.tracing.current_span().root
+                for url, body in [(bot.utilities.case_api_url + "/cases/details/case_ids/612345678",
+                                   {"CASE_ID": "612345678", "TITLE": "Outage at ACME HQ", "STATUS": "Open",
+                                    "PROBLEM_DESCRIPTION": "Core down", "NOTES": ["call back"]}),
+                                  (bot.utilities.spark_api_url + "rooms/room1", {"title": "SR 612345678: ACME"})]:
+                    response = bot.capture.requests.models.Response()
+                    response.status_code = 200
+                    response._content = json.dumps(body).encode("utf-8")
+                    recorder.add_call(root, bot.capture.requests.Request("GET", url).prepare(), time.time(), response)
+                for method, resource, body in [
+                        ("GET", "messages/m1", {"text": "/invite 612345678 cse jo@cisco.com asap"}),
+                        ("POST", "messages", {"markdown": "Problem description for SR 612345678 is: <br>Core down",
+                                              "html": "<p>Core down at ACME</p>", "roomId": "room1"})]:
+                    response = bot.capture.requests.models.Response()
+                    response.status_code = 200
+                    response._content = json.dumps(body).encode("utf-8")
+                    prepared = bot.capture.requests.Request(method, bot.utilities.spark_api_url + resource).prepare()
+                    recorder.add_call(root, prepared, time.time(), response)
+        finally:
+            recorder.uninstall()
+        with open(path) as f:
+            record = json.loads(f.readline())
+        os.remove(path)
+        self.assertEqual(record["calls"][0]["body"], {"CASE_ID": "612345678", "TITLE": "REDACTED", "STATUS": "Open",
+                                                      "PROBLEM_DESCRIPTION": "REDACTED", "NOTES": "REDACTED"})
+        # Spark text keeps only the case numbers, commands, addresses and keywords the bot reads
+        self.assertEqual(record["calls"][1]["body"], {"title": "612345678"})
+        self.assertEqual(record["calls"][2]["body"]["text"],
+                         "/invite 612345678 cse " + bot.capture.mask_emails("jo@cisco.com"))
+        self.assertEqual(record["calls"][3]["body"], {"markdown": "612345678", "html": "REDACTED", "roomId": "room1"})
+        self.assertNotIn("ACME", json.dumps(record))
+
+    def test_034_journal_keeps_done_records_of_pending_segments(self):
+        path = tempfile.mkdtemp()
+        journal = bot.journal.Journal(path, segment_bytes=300, max_segments=100)
+        seqs = [journal.append({"data": {"roomId": "room1", "id": "m{}".format(i)}}) for i in range(6)]
+        for seq in seqs[1:]:
+            journal.done(seq)
+        # Later webhooks move the done records of m1 to m5 out of the newest segment
+        for i in range(6, 12):
+            journal.done(journal.append({"data": {"roomId": "room1", "id": "m{}".format(i)}}))
+        journal.compact()
+        restarted = bot.journal.Journal(path)
+        self.assertEqual([p["data"]["id"] for seq, p in restarted.unprocessed()], ["m0"])
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+
+    def test_035_digest_retried_after_failures(self):
+        def fail(*args, **kwargs):
+            raise Exception("Case API unavailable")
+
+        class Sender(object):
+            rate = 1
+
+            def deliver(self, digests):
+                return 1, 1, set(["612345672"])
+
+        announced = {"612345671": {"rmas": ["84512345"], "bugs": []},
+                     "612345672": {"rmas": ["84512346"], "bugs": []}}
+        case_rooms, build_digests = bot.digest.case_rooms, bot.digest.build_digests
+        scheduler = bot.digest.DigestScheduler(at="08:00", sender=Sender())
+        bot.digest.runs.set("last", "2017-01-09")
+        try:
+            # A failed build leaves the day's digest to post again
+            bot.digest.case_rooms = fail
+            scheduler.run("2017-01-10")
+            self.assertEqual(bot.digest.runs.get("last"), "2017-01-09")
+            self.assertIn("error", scheduler.last)
+
+            # RMAs and bugs are only recorded as announced for cases whose digests were sent
+            bot.digest.case_rooms = lambda: {"612345671": ["room1"], "612345672": ["room2"]}
+            bot.digest.build_digests = lambda rooms: ([("room1", "612345671", "digest"),
+                                                       ("room2", "612345672", "digest")], announced)
+            scheduler.run("2017-01-10")
+            self.assertEqual(bot.digest.runs.get("last"), "2017-01-10")
+            self.assertEqual(bot.digest.seen.get("612345671"), announced["612345671"])
+            self.assertIsNone(bot.digest.seen.get("612345672"))
+        finally:
+            bot.digest.case_rooms, bot.digest.build_digests = case_rooms, build_digests
+            bot.digest.runs.delete("last")
+            bot.digest.seen.delete("612345671")
+
+    def test_036_journal_numbering_survives_full_compaction(self):
+        path = tempfile.mkdtemp()
+        journal = bot.journal.Journal(path)
+        for i in range(5):
+            journal.done(journal.append({"data": {"roomId": "room1", "id": "m{}".format(i)}}))
+        journal.compact()
+        bot.journal.Journal(path).compact()
+        restarted = bot.journal.Journal(path)
+        seq = restarted.append({"data": {"roomId": "room1", "id": "m5"}})
+        self.assertEqual(seq, 6)
+        self.assertEqual([(s, p["data"]["id"]) for s, p in bot.journal.Journal(path).unprocessed()], [(6, "m5")])
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+
+    def test_037_digest_state_survives_restart(self):
+        class Sender(object):
+            rate = 1
+
+            def deliver(self, digests):
+                return len(digests), 0, set()
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        case_rooms, build_digests = bot.digest.case_rooms, bot.digest.build_digests
+        bot.digest.state_file = path
+        bot.digest.case_rooms = lambda: {"612345671": ["room1"]}
+        bot.digest.build_digests = lambda rooms: ([("room1", "612345671", "digest")],
+                                                  {"612345671": {"rmas": ["84512345"], "bugs": []}})
+        try:
+            self.assertTrue(bot.digest.DigestScheduler(at="08:00").enabled)
+            bot.digest.DigestScheduler(at="08:00", sender=Sender()).run("2017-01-10")
+            # A restarted instance reads the last run and the announced items back from the file
+            bot.digest.runs.clear()
+            bot.digest.seen.clear()
+            bot.digest.load_state()
+            self.assertEqual(bot.digest.runs.get("last"), "2017-01-10")
+            self.assertEqual(bot.digest.seen.get("612345671"), {"rmas": ["84512345"], "bugs": []})
+        finally:
+            bot.digest.case_rooms, bot.digest.build_digests = case_rooms, build_digests
+            bot.digest.state_file = None
+            bot.digest.runs.delete("last")
+            bot.digest.seen.delete("612345671")
+            os.remove(path)
+        self.assertFalse(bot.digest.DigestScheduler(at="08:00").enabled)
+
+    def test_038_history_and_search_keep_non_ascii_text(self):
+        detail = {"TITLE": u"Fallo de ventilaci\u00f3n en el chasis", "STATUS": "Cisco Pending",
+                  "OWNER_FIRST_NAME": u"Jos\u00e9", "OWNER_LAST_NAME": u"Mu\u00f1oz", "BUGS": {"ID": [u"CSCuv12345"]}}
+        index = bot.search.SearchIndex(capacity=1)
+        index.add("612345678", {"RESPONSE": {"COUNT": 1, "CASES": {"CASE_DETAIL": detail}}})
+        results = index.search(u"ventilaci\u00f3n chasis")
+        self.assertEqual([r["case_number"] for r in results], ["612345678"])
+        self.assertIn(u"Fallo de ventilaci\u00f3n", bot.search.format_results(u"chasis", results))
+        store = bot.history.CaseHistory()
+        store.record("612345678", {"RESPONSE": {"COUNT": 1, "CASES": {"CASE_DETAIL": detail}}}, seen=100)
+        changed = dict(detail, OWNER_LAST_NAME=u"Pe\u00f1a")
+        store.record("612345678", {"RESPONSE": {"COUNT": 1, "CASES": {"CASE_DETAIL": changed}}}, seen=200)
+        message = bot.history.format_timeline("612345678", store.timeline("612345678"))
+        self.assertIn(u"Owner Jos\u00e9 Mu\u00f1oz", message)
+        self.assertIn(u"Owner last name changed from Mu\u00f1oz to Pe\u00f1a", message)
+
+    def test_039_export_csv_encodes_non_ascii_titles(self):
+        row = dict.fromkeys(bot.export.COLUMNS, "")
+        row["case_number"] = "612345678"
+        row["owner"] = u"Jos\u00e9 Mu\u00f1oz"
+        row["room_title"] = u"SR 612345678: Ventilateur d\u00e9fectueux"
+        text = "".join(bot.export.to_csv(iter([row])))
+        if isinstance(text, bytes):
+            text = text.decode("utf-8")
+        line = text.splitlines()[1]
+        self.assertTrue(line.startswith(u"612345678,,,Jos\u00e9 Mu\u00f1oz,"))
+        self.assertTrue(line.endswith(u"SR 612345678: Ventilateur d\u00e9fectueux"))
+
+    def test_040_rma_details_from_api_with_misses_cached(self):
+        api = fakes.FakeCaseAPI().start()
+        api.missing_rmas.add("84500000")
+        rma_api_url, bot.rma.rma_api_url = bot.rma.rma_api_url, api.rma_api_url
+        bot.utilities.token_cache.set(os.environ.get("CASE_API_CLIENT_ID"), "fake-access-token", ttl=60)
+        try:
+            json = bot.rma.get_rma_details("84512345")
+            self.assertEqual(json["returns"]["RmaRecord"][0], fakes.rma_detail("84512345"))
+            details = bot.rma.get_rmas_details(["84512345", "84500000"], budget=5)
+            self.assertEqual(details["84512345"].status, fakes.rma_detail("84512345")["status"])
+            self.assertIsNone(details["84500000"])
+            self.assertEqual(api.calls["GET rma/details"], 3)
+            details = bot.rma.get_rmas_details(["84512345", "84500000"], budget=5)
+            self.assertEqual(details["84512345"].number, "84512345")
+            self.assertIsNone(details["84500000"])
+            self.assertEqual(api.calls["GET rma/details"], 3)
+        finally:
+            bot.rma.rma_api_url = rma_api_url
+            bot.utilities.token_cache.delete(os.environ.get("CASE_API_CLIENT_ID"))
+            for rma_number in ["84512345", "84500000"]:
+                bot.rma.cache.delete(rma_number)
+                bot.rma.misses.delete(rma_number)
+            api.stop()
+
+    def test_041_shard_forwarding_signed_and_peers_refreshed_in_background(self):
+        class Registry(object):
+            scans = 0
+
+            def register(self, url, ttl):
+                pass
+
+            def peers(self):
+                self.scans += 1
+                return ["http://peer"]
+
+        registry = Registry()
+        router = bot.sharding.ShardRouter("http://self", registry=registry, secret="s3cret")
+        self.assertFalse(bot.sharding.ShardRouter("http://self", secret=None).enabled)
+        body = b'{"data": {"roomId": "room1"}}'
+        forwarded = {bot.sharding.FORWARDED_HEADER: "http://peer"}
+        self.assertFalse(router.is_forwarded(body, forwarded))
+        forwarded[bot.sharding.SIGNATURE_HEADER] = bot.sharding.ShardRouter("http://peer", secret="other").sign(body)
+        self.assertFalse(router.is_forwarded(body, forwarded))
+        forwarded[bot.sharding.SIGNATURE_HEADER] = bot.sharding.ShardRouter("http://peer", secret="s3cret").sign(body)
+        self.assertTrue(router.is_forwarded(body, forwarded))
+        self.assertFalse(router.is_forwarded(body + b" ", forwarded))
+        for i in range(100):
+            router.owner("room{}".format(i))
+        self.assertEqual((registry.scans, router.ring.nodes), (0, ["http://self"]))
+        router.refresh_peers()
+        self.assertEqual((registry.scans, router.ring.nodes), (1, ["http://peer", "http://self"]))
+        self.assertTrue(bot.sharding.forward_timeout <= 2)
+
 unittest.main()
\ No newline at end of file